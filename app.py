@@ -1,4 +1,6 @@
 import sys
+import time
+_BOOT_STARTED = time.perf_counter()
 # Patch para contornar a ausência do módulo 'distutils'
 try:
     import distutils
@@ -10,51 +12,96 @@ except ImportError:
         pass
 
 import os
-import time
 import re
+import unicodedata
 import logging
 import requests
 import io
 import psutil
 import threading
+import queue
+import heapq
+import itertools
+import collections
+import codecs
+import gzip
+import json
+import csv
+import shutil
+import zipfile
+import tarfile
+import binascii
+import html
+import sqlite3
+import uuid
+import hashlib
+import mmap
+import struct
+import ipaddress
+import atexit
 import subprocess
-import nltk
+import cachetools
 import concurrent.futures
 import importlib.util
 import email
 from email import policy
 from email.parser import BytesParser
 import numpy as np
-from sklearn.ensemble import IsolationForest
-from flask import Flask, request, jsonify, render_template_string, Response
-from nltk.sentiment import SentimentIntensityAnalyzer
-from langdetect import detect
+from flask import Flask, request, jsonify, render_template_string, Response, stream_with_context
+from langdetect import DetectorFactory, detect_langs
 import emoji
-from llama_cpp import Llama
-from huggingface_hub import hf_hub_download
-from duckduckgo_search import DDGS
 from PIL import Image, ExifTags
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import tempfile
 import multiprocessing
 import socket  # Necessário para descoberta de IP
-import gradio as gr  # Integração com Gradio.live
-
-# Tenta importar pyshark para análise de tráfego de rede
-try:
-    import pyshark
-except ImportError:
-    pyshark = None
-    logging.warning("pyshark não está instalado. A funcionalidade de análise de rede não estará disponível.")
-
-# Configurações iniciais do NLTK (necessário apenas na primeira execução)
-nltk.download('punkt')
-nltk.download('vader_lexicon')
+from urllib.parse import urlparse
 
 # Configurações gerais e logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-sentiment_analyzer = SentimentIntensityAnalyzer()
+
+# ===== Inicialização Preguiçosa =====
+# Dependências pesadas (gradio, sklearn, pyshark, duckduckgo_search, llama_cpp, nltk) só são
+# importadas no primeiro uso ou pelo aquecimento em segundo plano; o tempo de cada fase
+# da inicialização fica registrado em startup_phases e é exposto em /ready.
+startup_phases = {'imports': round(time.perf_counter() - _BOOT_STARTED, 3)}
+_lazy_modules = {}
+_lazy_lock = threading.Lock()
+
+def record_startup_phase(name: str, started: float) -> None:
+    startup_phases[name] = round(time.perf_counter() - started, 3)
+
+def lazy_import(module_name: str, optional: bool = False):
+    # Importa o módulo na primeira chamada; com optional=True retorna None se não estiver instalado
+    if module_name in _lazy_modules:
+        return _lazy_modules[module_name]
+    with _lazy_lock:
+        if module_name not in _lazy_modules:
+            started = time.perf_counter()
+            try:
+                _lazy_modules[module_name] = importlib.import_module(module_name)
+            except ImportError:
+                if not optional:
+                    raise
+                _lazy_modules[module_name] = None
+                logger.warning(f"{module_name} não está instalado. A funcionalidade correspondente não estará disponível.")
+            record_startup_phase(f"import:{module_name}", started)
+    return _lazy_modules[module_name]
+
+_sentiment_analyzer = None
+
+def get_sentiment_analyzer():
+    # O léxico VADER só é baixado quando o analisador é usado pela primeira vez
+    global _sentiment_analyzer
+    if _sentiment_analyzer is None:
+        nltk = lazy_import('nltk')
+        try:
+            nltk.data.find('sentiment/vader_lexicon.zip')
+        except LookupError:
+            nltk.download('vader_lexicon', quiet=True)
+        _sentiment_analyzer = lazy_import('nltk.sentiment').SentimentIntensityAnalyzer()
+    return _sentiment_analyzer
 
 LANGUAGE_MAP = {
     'Português': {'code': 'pt-BR', 'instruction': 'Responda em português brasileiro'},
@@ -543,6 +590,9 @@ index_html = """
             <label>
               <input type="checkbox" id="streaming" name="streaming"> Ativar Streaming
             </label>
+            <label>
+              <input type="checkbox" id="autocorrect" name="autocorrect" checked> Autocorreção
+            </label>
             <!-- Novos campos para configuração de GPU/CPU -->
             <label for="gpu_layers">Camadas GPU:</label>
             <input type="number" id="gpu_layers" name="gpu_layers" placeholder="Automático">
@@ -555,6 +605,8 @@ index_html = """
             <input type="number" id="sites_meta" name="sites_meta" value="5" style="width: 60px;">
             <label for="investigation_focus">Foco (opcional):</label>
             <input type="text" id="investigation_focus" name="investigation_focus" placeholder="Ex: phishing, malware...">
+            <label for="aliases">Apelidos (opcional):</label>
+            <input type="text" id="aliases" name="aliases" placeholder="Separados por vírgula">
             <label>
               <input type="checkbox" id="search_news" name="search_news"> Ativar Notícias
             </label>
@@ -734,10 +786,12 @@ index_html = """
       formData.append('velocidade', document.getElementById("velocidade").value);
       formData.append('sites_meta', document.getElementById("sites_meta").value);
       formData.append('investigation_focus', document.getElementById("investigation_focus").value);
+      formData.append('aliases', document.getElementById("aliases").value);
       formData.append('search_news', document.getElementById("search_news").checked);
       formData.append('search_leaked_data', document.getElementById("search_leaked_data").checked);
       formData.append('gpu_layers', document.getElementById("gpu_layers").value);
       formData.append('n_batch', document.getElementById("n_batch").value);
+      formData.append('autocorrect', document.getElementById("autocorrect").checked);
       
       const streaming = document.getElementById("streaming").checked;
       showSpinner();
@@ -766,7 +820,7 @@ index_html = """
                 appendTimer(elapsed);
                 return;
               }
-              const chunk = decoder.decode(value);
+              const chunk = decoder.decode(value, { stream: true });
               bubbleDiv.innerHTML += chunk;
               chatWindow.scrollTop = chatWindow.scrollHeight;
               return readStream();
@@ -1042,16 +1096,98 @@ index_html = """
 def index():
     return render_template_string(index_html)
 
-# ===== Cache simples em memória =====
-cache = {}
+# ===== Cache em memória com TTL por entrada e limite LRU =====
+# Diretório base dos dados persistentes (buscas, lotes, anexos, modelos de UBA, hashes de imagens);
+# cada caminho abaixo também pode ser trocado pela variável de ambiente de mesmo nome
+CACHE_DIR = os.environ.get("CYBER_CACHE_DIR", "cache")
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 64 MB
+RESPONSE_CACHE_TTL = 3600
+
+CACHE_HITS = Counter('cache_hits_total', 'Acertos de cache', ['cache'])
+CACHE_MISSES = Counter('cache_misses_total', 'Faltas de cache', ['cache'])
+CACHE_EVICTIONS = Counter('cache_evictions_total', 'Entradas removidas do cache', ['cache', 'reason'])
+CACHE_ENTRIES = Gauge('cache_entries', 'Entradas atualmente no cache', ['cache'])
+CACHE_BYTES = Gauge('cache_bytes', 'Tamanho estimado do cache em bytes', ['cache'])
+
+def _estimate_size(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return sys.getsizeof(value)
+
+class _TLRUStore(cachetools.TLRUCache):
+    # Cada entrada é uma tupla (valor, ttl, bytes): o ttu usa o TTL da própria entrada e o
+    # maxsize do cachetools limita o total de bytes; o limite de entradas é aplicado aqui.
+    def __init__(self, name: str, max_entries: int, max_bytes: int):
+        super().__init__(maxsize=max_bytes, ttu=lambda key, entry, now: now + entry[1], getsizeof=lambda entry: entry[2])
+        self.name = name
+        self.max_entries = max_entries
+
+    def expire(self, time=None):
+        expired = super().expire(time) or []
+        if expired:
+            CACHE_EVICTIONS.labels(self.name, 'expired').inc(len(expired))
+        return expired
+
+    def popitem(self):
+        item = super().popitem()
+        CACHE_EVICTIONS.labels(self.name, 'capacity').inc()
+        return item
+
+    def __setitem__(self, key, entry):
+        super().__setitem__(key, entry)
+        while len(self) > self.max_entries:
+            self.popitem()
+
+class BoundedTTLCache:
+    # Cache thread-safe para o servidor Flask com threads: TTL por entrada, LRU por número de
+    # entradas e por bytes totais, com contadores exportados em /metrics.
+    def __init__(self, name: str, max_entries: int, max_bytes: int, default_ttl: int):
+        self.name = name
+        self.default_ttl = default_ttl
+        self._store = _TLRUStore(name, max_entries, max_bytes)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._store.get(key)
+        if entry is None:
+            CACHE_MISSES.labels(self.name).inc()
+            return None
+        CACHE_HITS.labels(self.name).inc()
+        return entry[0]
+
+    def set(self, key: str, value, ttl: int = None) -> None:
+        ttl = self.default_ttl if ttl is None else ttl
+        size = len(key.encode('utf-8')) + _estimate_size(value)
+        with self._lock:
+            try:
+                self._store[key] = (value, ttl, size)
+            except ValueError:
+                # Entrada maior que o limite total de bytes: não é armazenada
+                logger.warning(f"Entrada de {size} bytes excede o limite do cache '{self.name}'.")
+            self._update_gauges()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._store.clear()
+            self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        CACHE_ENTRIES.labels(self.name).set(len(self._store))
+        CACHE_BYTES.labels(self.name).set(self._store.currsize)
+
+response_cache = BoundedTTLCache('response', RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
 
 def get_cached_response(query: str, lang: str, style: str) -> str:
     key = f"response:{query}:{lang}:{style}"
-    return cache.get(key)
+    return response_cache.get(key)
 
-def set_cached_response(query: str, lang: str, style: str, response_text: str, ttl: int = 3600) -> None:
+def set_cached_response(query: str, lang: str, style: str, response_text: str, ttl: int = RESPONSE_CACHE_TTL) -> None:
     key = f"response:{query}:{lang}:{style}"
-    cache[key] = response_text  # TTL não implementado nesta versão
+    response_cache.set(key, response_text, ttl)
 
 # ===== Monitoramento com Prometheus =====
 REQUEST_COUNT = Counter('flask_request_count', 'Total de requisições', ['endpoint', 'method'])
@@ -1084,6 +1220,76 @@ COMPILED_REGEX_PATTERNS = {
     'domain': re.compile(r'\b(?:[a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}\b')
 }
 
+# ===== Extração Unificada de Indicadores =====
+
+class IndicatorScanner:
+    # Percorre o texto com um dicionário de padrões. Com candidate_chars, só as sequências de
+    # palavras que contêm algum desses caracteres são examinadas (pré-filtro), e cada padrão
+    # roda sozinho em cada trecho: o resultado é o mesmo de uma passada por padrão no texto
+    # inteiro. Aceita str ou bytes e deduplica mantendo a ordem de aparição.
+    def __init__(self, patterns: dict, candidate_chars: str = None):
+        self.patterns = {name: self._source(pattern) for name, pattern in patterns.items()}
+        candidate = rf'[{candidate_chars}]\S*' if candidate_chars else None
+        self._compiled = {}
+        for kind, convert in ((str, str), (bytes, lambda source: source.encode('ascii'))):
+            self._compiled[kind] = (
+                [(name, self._finder(re.compile(convert(source)))) for name, source in self.patterns.items()],
+                re.compile(convert(candidate)) if candidate else None,
+                convert(' ')
+            )
+
+    @staticmethod
+    def _source(pattern) -> str:
+        if isinstance(pattern, str):
+            return pattern
+        return f'(?i:{pattern.pattern})' if pattern.flags & re.IGNORECASE else pattern.pattern
+
+    @staticmethod
+    def _finder(pattern):
+        # findall devolve o match inteiro só quando o padrão não tem grupos de captura
+        if not pattern.groups:
+            return pattern.findall
+        return lambda data, start, end: [match.group() for match in pattern.finditer(data, start, end)]
+
+    def _regions(self, data, candidate, space):
+        # Agrupa palavras candidatas vizinhas (separadas só por espaço) numa mesma região.
+        # O pré-filtro acha o primeiro caractere candidato; o início da palavra é achado
+        # voltando até o espaço anterior (com outro separador a região só fica maior, nunca menor).
+        if candidate is None:
+            yield 0, len(data)
+            return
+        start = None
+        end = 0
+        for match in candidate.finditer(data):
+            first = max(end, data.rfind(space, end, match.start()) + 1)
+            if start is not None and (first == end or data[end:first].isspace()):
+                end = match.end()
+                continue
+            if start is not None:
+                yield start, end
+            start, end = first, match.end()
+        if start is not None:
+            yield start, end
+
+    def scan(self, data) -> dict:
+        kind = bytes if isinstance(data, (bytes, bytearray, memoryview)) else str
+        if kind is bytes and not isinstance(data, bytes):
+            data = bytes(data)
+        finders, candidate, space = self._compiled[kind]
+        found = {name: {} for name in self.patterns}
+        for start, end in self._regions(data, candidate, space):
+            for name, finder in finders:
+                for value in finder(data, start, end):
+                    found[name][value] = None
+        decode = (lambda value: value.decode('utf-8', errors='replace')) if kind is bytes else (lambda value: value)
+        return {name: [decode(value) for value in values] for name, values in found.items() if values}
+
+    def kinds(self, data) -> set:
+        return set(self.scan(data))
+
+# Todo padrão forense exige ao menos um destes caracteres (ponto, arroba, dois-pontos, dígito, parênteses ou hífen)
+FORENSIC_INDICATOR_SCANNER = IndicatorScanner(COMPILED_REGEX_PATTERNS, candidate_chars=r'.@:\d()-')
+
 # ===== Carregamento de Plugins (Módulos Externos) =====
 def load_plugins(plugin_dir="plugins"):
     plugins = {}
@@ -1105,12 +1311,35 @@ def load_plugins(plugin_dir="plugins"):
 plugins = load_plugins()
 
 # ===== Gerenciamento de GPU/CPU e Paralelização =====
-model_lock = threading.Lock()  # Para acesso thread-safe ao modelo
+INFERENCE_WORKERS = 2  # Processos de inferência, cada um com a sua instância Llama
+INFERENCE_QUEUE_MAX = 64  # Acima disso as requisições recebem HTTP 429
+INFERENCE_RETRY_AFTER = 5  # Segundos sugeridos ao cliente em caso de 429
+INFERENCE_BUSY_MESSAGE = "Servidor ocupado: fila de inferência cheia. Tente novamente em instantes."
+INFERENCE_OPEN_PROMPT_TIMEOUT = 120  # Prompt aberto sem ser concluído por mais que isso é abortado
+
+# Prioridades (menor valor = atendido primeiro)
+PRIORITY_CHAT = 0
+PRIORITY_INVESTIGATION = 10
+PRIORITY_BATCH = 20
 
-def load_model(custom_gpu_layers=None, custom_n_batch=None) -> Llama:
+INFERENCE_QUEUE_DEPTH = Gauge('inference_queue_depth', 'Requisições aguardando um worker de inferência')
+INFERENCE_INFLIGHT = Gauge('inference_inflight', 'Requisições em execução nos workers de inferência')
+INFERENCE_WORKERS_READY = Gauge('inference_workers_ready', 'Workers de inferência com modelo carregado')
+INFERENCE_REJECTED = Counter('inference_rejected_total', 'Requisições recusadas por fila cheia')
+INFERENCE_QUEUE_WAIT = Histogram('inference_queue_wait_seconds', 'Tempo de espera na fila de inferência', ['priority'])
+INFERENCE_TOKENS = Counter('inference_tokens_total', 'Tokens processados pelos workers de inferência', ['kind'])
+MODEL_RELOADS = Counter('model_reloads_total', 'Pedidos de troca de configuração do modelo', ['result'])
+MODEL_RELOAD_IN_PROGRESS = Gauge('model_reload_in_progress', 'Nova geração de workers sendo carregada em segundo plano')
+MODEL_SWAP_SECONDS = Histogram('model_swap_duration_seconds', 'Tempo entre o pedido de troca e a nova geração assumir o tráfego',
+                               buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+MODEL_SWAP_BLOCKED_SECONDS = Histogram('model_swap_blocked_seconds', 'Tempo em que o despacho de jobs ficou bloqueado pela troca',
+                                       buckets=(0.0001, 0.001, 0.01, 0.1, 1))
+
+def load_model(custom_gpu_layers=None, custom_n_batch=None, n_threads=None, n_ctx=4096):
+    Llama = lazy_import('llama_cpp').Llama
     model_path = os.path.join(DEFAULT_LOCAL_MODEL_DIR, DEFAULT_MODEL_FILE)
     if not os.path.exists(model_path):
-        hf_hub_download(
+        lazy_import('huggingface_hub').hf_hub_download(
             repo_id=DEFAULT_MODEL_NAME,
             filename=DEFAULT_MODEL_FILE,
             local_dir=DEFAULT_LOCAL_MODEL_DIR,
@@ -1120,6 +1349,7 @@ def load_model(custom_gpu_layers=None, custom_n_batch=None) -> Llama:
         # Detecta GPU ou utiliza valores customizados, se fornecidos
         n_gpu_layers = custom_gpu_layers if custom_gpu_layers is not None else 15
         n_batch = custom_n_batch if custom_n_batch is not None else 512
+        n_threads = n_threads if n_threads is not None else psutil.cpu_count(logical=True)
         try:
             import GPUtil
             gpus = GPUtil.getGPUs()
@@ -1133,44 +1363,976 @@ def load_model(custom_gpu_layers=None, custom_n_batch=None) -> Llama:
             logger.warning(f"Erro na detecção da GPU: {gpu_error}. Configuração para CPU será utilizada.")
         model_instance = Llama(
             model_path=model_path,
-            n_ctx=4096,
-            n_threads=psutil.cpu_count(logical=True),
+            n_ctx=n_ctx,
+            n_threads=n_threads,
             n_gpu_layers=n_gpu_layers,
             n_batch=n_batch
         )
-        logger.info(f"🤖 Modelo Neural Carregado com n_gpu_layers={n_gpu_layers}, n_batch={n_batch} e n_threads={psutil.cpu_count(logical=True)}")
+        logger.info(f"🤖 Modelo Neural Carregado com n_gpu_layers={n_gpu_layers}, n_batch={n_batch} e n_threads={n_threads}")
         return model_instance
     except Exception as e:
         logger.error(f"❌ Erro na Inicialização do Modelo: {e}")
         raise e
 
-# Inicializa o modelo globalmente
-model = load_model()
+class InferenceQueueFull(Exception):
+    pass
+
+class InferenceJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, params: dict, priority: int):
+        self.id = next(InferenceJob._ids)
+        self.params = params
+        self.priority = priority
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.worker = None
+        self.cancelled = False
+        self.done = False
+        self._events = queue.Queue()
+        self._lock = threading.Lock()  # Serializa extend() com o despacho para o worker
+
+    def __lt__(self, other):
+        # Desempate por ordem de chegada dentro da mesma prioridade
+        return (self.priority, self.id) < (other.priority, other.id)
+
+    def iter_tokens(self):
+        while True:
+            kind, payload = self._events.get()
+            if kind == 'token':
+                yield payload
+            elif kind == 'error':
+                raise RuntimeError(payload)
+            else:
+                return
+
+    def result(self) -> str:
+        return "".join(self.iter_tokens())
+
+    def cancel(self) -> None:
+        # Sob o mesmo lock do despacho: ou o worker já recebeu o job, ou o despacho verá o cancelamento
+        with self._lock:
+            if self.done or self.cancelled:
+                return
+            self.cancelled = True
+            worker = self.worker
+        if worker is not None:
+            worker.send(('cancel', self.id, None))
+
+    def extend(self, text: str, final: bool = False) -> None:
+        # Prompt aberto: acrescenta texto ao final. Se o job já está num worker o trecho é
+        # avaliado (prefill) enquanto o chamador prepara o resto; a geração só começa com final=True.
+        with self._lock:
+            if self.done or self.cancelled or not self.params.get('open'):
+                return
+            self.params['prompt'] += text
+            if final:
+                self.params['open'] = False
+            if self.worker is not None:
+                self.worker.send(('extend', self.id, {'text': text, 'final': final}))
+
+def _common_prefix_length(a: list, b: list) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+def _prefill_open_prompt(llm, conn, job_id: int, prompt: str, pending: collections.deque):
+    # Modo sequencial: avalia o prompt aberto à medida que chega e espera o trecho final.
+    # Retorna o prompt completo, ou None se o job foi cancelado.
+    def evaluate(text: str) -> None:
+        tokens = llm.tokenize(text.encode('utf-8'), add_bos=True, special=True)
+        if len(tokens) >= llm.n_ctx():
+            raise ValueError(f"Prompt com {len(tokens)} tokens excede o contexto de {llm.n_ctx()}")
+        # Reavalia só a partir do ponto em que a nova tokenização diverge do que já está no cache KV
+        llm.n_tokens = _common_prefix_length(llm.input_ids[:llm.n_tokens].tolist(), tokens)
+        if len(tokens) > llm.n_tokens:
+            llm.eval(tokens[llm.n_tokens:])
+
+    evaluate(prompt)
+    # Trechos que chegaram enquanto o job aguardava na fila local
+    for msg in [m for m in pending if m[0] == 'extend' and m[1] == job_id]:
+        pending.remove(msg)
+        prompt += msg[2]['text']
+        if msg[2]['final']:
+            return prompt
+        evaluate(prompt)
+    while conn.poll(INFERENCE_OPEN_PROMPT_TIMEOUT):
+        msg = conn.recv()
+        if msg[1] != job_id or msg[0] not in ('extend', 'cancel'):
+            pending.append(msg)
+            continue
+        if msg[0] == 'cancel':
+            return None
+        prompt += msg[2]['text']
+        if msg[2]['final']:
+            return prompt
+        evaluate(prompt)
+    raise TimeoutError("Prompt aberto não foi concluído a tempo")
+
+def _run_inference_job(llm, conn, job_id: int, params: dict, pending: collections.deque,
+                       prompt_cache=None) -> None:
+    cancelled = False
+    try:
+        # Mesmo formato de prompt do modo em lote, para que os prefixos em cache coincidam
+        prompt = params.get('prompt') or format_chat_prompt(params['messages'])
+        tokens = llm.tokenize(prompt.encode('utf-8'), add_bos=True, special=True)
+        n_reused = prompt_cache.restore(tokens) if prompt_cache else 0
+        if params.get('open'):
+            prompt = _prefill_open_prompt(llm, conn, job_id, prompt, pending)
+            if prompt is None:
+                conn.send(('done', job_id, {'cancelled': True}))
+                return
+            tokens = llm.tokenize(prompt.encode('utf-8'), add_bos=True, special=True)
+        stream = llm.create_completion(prompt, max_tokens=params.get('max_tokens'),
+                                       temperature=params.get('temperature', 0.7), stop=params.get('stop'),
+                                       top_k=SAMPLING_TOP_K, top_p=SAMPLING_TOP_P, stream=True)
+        generated = []
+        try:
+            for chunk in stream:
+                content = chunk['choices'][0].get('text')
+                if content:
+                    generated.append(content)
+                    conn.send(('token', job_id, content))
+                # Verifica cancelamentos entre tokens; outras mensagens ficam para depois
+                while conn.poll():
+                    msg = conn.recv()
+                    if msg[0] == 'cancel' and msg[1] == job_id:
+                        cancelled = True
+                    else:
+                        pending.append(msg)
+                if cancelled:
+                    break
+        finally:
+            stream.close()
+        # O stream entrega texto; os tokens gerados são contados retokenizando a saída
+        completion_tokens = len(llm.tokenize("".join(generated).encode('utf-8'), add_bos=False)) if generated else 0
+        stats = {'cancelled': cancelled, 'prompt_tokens': len(tokens), 'completion_tokens': completion_tokens}
+        if prompt_cache:
+            stats.update(_prefix_stats(n_reused, prompt_cache.seconds_per_token))
+        conn.send(('done', job_id, stats))
+    except Exception as e:
+        conn.send(('error', job_id, str(e)))
+
+def _serial_worker_loop(conn, llm, prompt_cache=None) -> None:
+    # Modo sem batching: atende um job por vez pela API de alto nível do llama_cpp
+    pending = collections.deque()
+    while True:
+        try:
+            msg = pending.popleft() if pending else conn.recv()
+        except EOFError:
+            break
+        kind, job_id, payload = msg
+        if kind == 'stop':
+            break
+        if kind == 'run':
+            _run_inference_job(llm, conn, job_id, payload, pending, prompt_cache)
+        elif kind == 'extend':
+            pass  # Trecho de um job que já terminou ou foi cancelado
+        elif kind == 'cancel':
+            # Job ainda não iniciado: descarta sem gerar
+            for queued in list(pending):
+                if queued[0] == 'run' and queued[1] == job_id:
+                    pending.remove(queued)
+                    conn.send(('done', job_id, {'cancelled': True}))
+
+# ===== Cache de Prefixo de Prompt (estado KV das instruções de sistema) =====
+PROMPT_PREFIX_CACHE = True  # Pré-avalia as instruções de sistema conhecidas em cada worker
+PROMPT_PREFIX_MIN_TOKENS = 16  # Prefixos comuns menores que isso não contam como acerto
+PROMPT_PREFIX_STATE_BYTES = 2 << 30  # Limite dos snapshots de estado no modo sequencial
+
+PREFIX_CACHE_LOOKUPS = Counter('prompt_prefix_cache_lookups_total', 'Consultas ao cache de prefixo de prompt', ['result'])
+PREFIX_CACHE_TOKENS = Counter('prompt_prefix_tokens_reused_total', 'Tokens de prompt reaproveitados do cache de prefixo')
+PREFIX_CACHE_SECONDS = Counter('prompt_prefix_eval_seconds_saved_total', 'Tempo estimado de avaliação de prompt economizado')
+
+def known_system_prompts() -> list:
+    # As 10 instruções de build_messages (idiomas x estilos) e a do modo investigação
+    prompts = [build_messages("", config, style)[0][0]['content']
+               for config in LANGUAGE_MAP.values() for style in ("Técnico", "Livre")]
+    prompts.append(INVESTIGATION_SYSTEM_PROMPT)
+    return prompts
+
+def system_prompt_prefix(system: str) -> str:
+    # Início do prompt formatado compartilhado por todas as requisições com a mesma instrução
+    return f"[INST] {system}\n\n"
+
+def _match_prefix(prefix_tokens: list, tokens: list) -> tuple:
+    # Retorna (índice, tamanho) do prefixo conhecido com maior trecho em comum com o prompt;
+    # sempre sobra ao menos um token do prompt para ser avaliado e gerar logits.
+    best_index, best_length = None, 0
+    for index, prefix in enumerate(prefix_tokens):
+        length = 0
+        for a, b in zip(prefix, tokens[:-1]):
+            if a != b:
+                break
+            length += 1
+        if length > best_length:
+            best_index, best_length = index, length
+    if best_length < PROMPT_PREFIX_MIN_TOKENS:
+        return None, 0
+    return best_index, best_length
+
+def _prefix_stats(n_reused: int, seconds_per_token: float) -> dict:
+    return {'prefix_hit': n_reused > 0, 'prefix_tokens': n_reused,
+            'seconds_saved': n_reused * seconds_per_token}
+
+class PromptStateCache:
+    # Modo sequencial: snapshot do estado do llama.cpp após cada prefixo conhecido, guardado
+    # num LlamaRAMCache; o Llama reaproveita os tokens em comum ao gerar a partir do estado.
+    def __init__(self, llm, prefixes: list, capacity_bytes: int = PROMPT_PREFIX_STATE_BYTES):
+        from llama_cpp import LlamaRAMCache
+        self.llm = llm
+        self.states = LlamaRAMCache(capacity_bytes=capacity_bytes)
+        self.prefix_tokens = []
+        evaluated, elapsed = 0, 0.0
+        for prefix in prefixes:
+            tokens = llm.tokenize(system_prompt_prefix(prefix).encode('utf-8'), add_bos=True, special=True)
+            if len(tokens) >= llm.n_ctx():
+                continue
+            llm.reset()
+            start = time.perf_counter()
+            llm.eval(tokens)
+            elapsed += time.perf_counter() - start
+            evaluated += len(tokens)
+            self.states[tokens] = llm.save_state()
+            self.prefix_tokens.append(tokens)
+        llm.reset()
+        self.seconds_per_token = elapsed / evaluated if evaluated else 0.0
+
+    def restore(self, tokens: list) -> int:
+        index, length = _match_prefix(self.prefix_tokens, tokens)
+        if index is None:
+            return 0
+        # Busca exata: o LlamaRAMCache devolveria o snapshot de outro prefixo com início em comum
+        state = self.states.cache_state.get(tuple(self.prefix_tokens[index]))
+        if state is None:
+            return 0  # Snapshot descartado pelo limite de memória
+        self.llm.load_state(state)
+        return length
+
+# ===== Batching Contínuo (várias sequências por passo de decodificação) =====
+INFERENCE_BATCH_SEQUENCES = 4  # Sequências decodificadas juntas em cada worker (1 = sem batching)
+INFERENCE_SEQUENCE_CTX = 4096  # Contexto máximo por sequência
+SAMPLING_TOP_K = 40
+SAMPLING_TOP_P = 0.95
+
+def format_chat_prompt(messages: list) -> str:
+    # Formato Mistral-Instruct; a instrução de sistema é incorporada ao primeiro turno do usuário
+    system = "\n\n".join(m['content'] for m in messages if m['role'] == 'system')
+    prompt = ""
+    for message in messages:
+        if message['role'] == 'user':
+            start = system_prompt_prefix(system) if system and not prompt else "[INST] "
+            prompt += f"{start}{message['content']} [/INST]"
+        elif message['role'] == 'assistant':
+            prompt += f"{message['content']}</s>"
+    return prompt
+
+def _sample_token(logits: np.ndarray, temperature: float, rng) -> int:
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    top_k = min(SAMPLING_TOP_K, logits.shape[0])
+    candidates = np.argpartition(logits, -top_k)[-top_k:]
+    scaled = logits[candidates].astype(np.float64) / temperature
+    probs = np.exp(scaled - scaled.max())
+    probs /= probs.sum()
+    order = np.argsort(-probs)
+    cutoff = int(np.searchsorted(np.cumsum(probs[order]), SAMPLING_TOP_P)) + 1
+    keep = order[:cutoff]
+    keep_probs = probs[keep] / probs[keep].sum()
+    return int(candidates[keep[rng.choice(len(keep), p=keep_probs)]])
+
+class _BatchSequence:
+    def __init__(self, job_id: int, seq_id: int, prompt_tokens: list, params: dict, n_reused: int = 0):
+        self.job_id = job_id
+        self.seq_id = seq_id
+        self.prompt = params.get('prompt')
+        self.open = bool(params.get('open'))  # Prompt ainda recebendo trechos: só prefill, sem geração
+        self.opened_at = time.monotonic()
+        self.tokens = list(prompt_tokens)  # Tokens do prompt (avaliados + pendentes)
+        self.pending = list(prompt_tokens[n_reused:])  # Tokens ainda não avaliados
+        self.n_past = n_reused
+        self.n_reused = n_reused  # Tokens copiados de um prefixo em cache
+        self.n_prompt = len(prompt_tokens)
+        self.n_generated = 0
+        self.max_tokens = params.get('max_tokens') or 256
+        self.temperature = params.get('temperature', 0.7)
+        self.stop = [s for s in (params.get('stop') or []) if s]
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.text = ""  # Texto gerado ainda não enviado (retido por possível stop string)
+        self.batch_index = None
+
+class BatchDecoder:
+    # Motor de batching contínuo sobre a API multi-sequência do llama.cpp: cada job ocupa um
+    # seq_id no cache KV, novos jobs entram entre passos de decodificação e cada sequência
+    # emite seus tokens de forma independente. Prefixos de sistema conhecidos ficam avaliados
+    # em seq_ids reservados e são copiados para as novas sequências.
+    def __init__(self, llm, max_sequences: int, n_ctx_per_sequence: int, n_batch: int, n_threads: int,
+                 prefixes: list = ()):
+        import llama_cpp
+        from llama_cpp import _internals
+        self.llm = llm
+        self.max_sequences = max_sequences
+        self.n_ctx_per_sequence = n_ctx_per_sequence
+        self.n_batch = n_batch
+        self.prefix_tokens = []
+        for prefix in prefixes:
+            tokens = llm.tokenize(system_prompt_prefix(prefix).encode('utf-8'), add_bos=True, special=True)
+            if len(tokens) < n_ctx_per_sequence:
+                self.prefix_tokens.append(tokens)
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx_per_sequence * max_sequences + sum(len(tokens) for tokens in self.prefix_tokens)
+        params.n_batch = n_batch
+        params.n_ubatch = min(n_batch, 512)
+        params.n_seq_max = max_sequences + len(self.prefix_tokens)
+        params.n_threads = n_threads
+        params.n_threads_batch = n_threads
+        if hasattr(params, 'kv_unified'):
+            params.kv_unified = True
+        self.ctx = _internals.LlamaContext(model=llm._model, params=params, verbose=False)
+        self.batch = _internals.LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=1, verbose=False)
+        self.n_vocab = llm.n_vocab()
+        self.eos = llm.token_eos()
+        self.free_seq_ids = list(range(max_sequences))
+        self.sequences = {}
+        self.rng = np.random.default_rng()
+        self.seconds_per_token = self._warm_prefixes()
+
+    def _warm_prefixes(self) -> float:
+        # Avalia cada prefixo no seu seq_id reservado e mede o custo de prefill por token
+        evaluated, elapsed = 0, 0.0
+        for index, tokens in enumerate(self.prefix_tokens):
+            seq_id = self.max_sequences + index
+            for offset in range(0, len(tokens), self.n_batch):
+                self.batch.reset()
+                for pos, token in enumerate(tokens[offset:offset + self.n_batch], start=offset):
+                    self._add_token(token, pos, seq_id, False)
+                start = time.perf_counter()
+                self.ctx.decode(self.batch)
+                elapsed += time.perf_counter() - start
+            evaluated += len(tokens)
+        return elapsed / evaluated if evaluated else 0.0
+
+    @property
+    def active(self) -> bool:
+        # Há trabalho de decodificação (prompts abertos já avaliados só aguardam novos trechos)
+        return any(seq.pending or not seq.open for seq in self.sequences.values())
+
+    def _tokenize_prompt(self, prompt: str) -> list:
+        tokens = self.llm.tokenize(prompt.encode('utf-8'), add_bos=True, special=True)
+        if len(tokens) >= self.n_ctx_per_sequence:
+            raise ValueError(f"Prompt com {len(tokens)} tokens excede o contexto de {self.n_ctx_per_sequence}")
+        return tokens
+
+    def admit(self, job_id: int, params: dict) -> None:
+        tokens = self._tokenize_prompt(params.get('prompt') or format_chat_prompt(params['messages']))
+        seq_id = self.free_seq_ids.pop()
+        index, n_reused = _match_prefix(self.prefix_tokens, tokens)
+        if index is not None:
+            self.ctx.kv_cache_seq_cp(self.max_sequences + index, seq_id, 0, n_reused)
+        self.sequences[job_id] = _BatchSequence(job_id, seq_id, tokens, params, n_reused)
+
+    def extend(self, job_id: int, payload: dict) -> None:
+        # Acrescenta um trecho ao prompt aberto; a nova tokenização é comparada com a anterior e
+        # só a parte divergente volta a ser avaliada.
+        seq = self.sequences.get(job_id)
+        if seq is None or not seq.open:
+            return
+        seq.prompt += payload['text']
+        try:
+            tokens = self._tokenize_prompt(seq.prompt)
+        except ValueError:
+            self._release(seq)
+            raise
+        keep = _common_prefix_length(seq.tokens, tokens)
+        if keep < seq.n_past:
+            self.ctx.kv_cache_seq_rm(seq.seq_id, keep, -1)
+            seq.n_past = keep
+        seq.tokens = tokens
+        seq.n_prompt = len(tokens)
+        seq.pending = tokens[seq.n_past:]
+        seq.open = not payload['final']
+        if not seq.open and not seq.pending:
+            # Tudo já avaliado: reavalia o último token para obter os logits da geração
+            seq.n_past -= 1
+            self.ctx.kv_cache_seq_rm(seq.seq_id, seq.n_past, -1)
+            seq.pending = tokens[seq.n_past:]
+
+    def expire_open(self, timeout: float) -> list:
+        # Prompts abertos abandonados pelo chamador liberam o seu seq_id
+        now = time.monotonic()
+        expired = [seq for seq in self.sequences.values() if seq.open and now - seq.opened_at > timeout]
+        for seq in expired:
+            self._release(seq)
+        return [seq.job_id for seq in expired]
+
+    def cancel(self, job_id: int) -> bool:
+        seq = self.sequences.get(job_id)
+        if seq is None:
+            return False
+        self._release(seq)
+        return True
+
+    def _release(self, seq: _BatchSequence) -> None:
+        del self.sequences[seq.job_id]
+        self.ctx.kv_cache_seq_rm(seq.seq_id, -1, -1)
+        self.free_seq_ids.append(seq.seq_id)
+
+    def _add_token(self, token: int, pos: int, seq_id: int, logits: bool) -> int:
+        batch = self.batch.batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.seq_id[i][0] = seq_id
+        batch.n_seq_id[i] = 1
+        batch.logits[i] = logits
+        batch.n_tokens = i + 1
+        return i
+
+    def _fill_batch(self) -> list:
+        # Sequências em geração (1 token cada) entram primeiro; o restante do orçamento de
+        # n_batch é usado para avaliar prompts em blocos.
+        self.batch.reset()
+        scheduled = []
+        budget = self.n_batch
+        decoding = [seq for seq in self.sequences.values()
+                    if seq.n_generated > 0 or (len(seq.pending) == 1 and not seq.open)]
+        prefilling = [seq for seq in self.sequences.values() if seq not in decoding and seq.pending]
+        for seq in decoding:
+            if budget == 0:
+                break
+            seq.batch_index = self._add_token(seq.pending.pop(0), seq.n_past, seq.seq_id, True)
+            seq.n_past += 1
+            budget -= 1
+            scheduled.append(seq)
+        for seq in prefilling:
+            if budget == 0:
+                break
+            chunk = seq.pending[:budget]
+            del seq.pending[:len(chunk)]
+            for j, token in enumerate(chunk):
+                last = not seq.pending and not seq.open and j == len(chunk) - 1
+                index = self._add_token(token, seq.n_past, seq.seq_id, last)
+                seq.n_past += 1
+            seq.batch_index = index if not seq.pending and not seq.open else None
+            budget -= len(chunk)
+            scheduled.append(seq)
+        return scheduled
+
+    def _emit(self, seq: _BatchSequence, final: bool) -> tuple:
+        for stop in seq.stop:
+            position = seq.text.find(stop)
+            if position != -1:
+                return seq.text[:position], True
+        # Retém o final do texto que ainda pode ser o início de uma stop string
+        hold = 0
+        if not final:
+            for stop in seq.stop:
+                for size in range(min(len(stop) - 1, len(seq.text)), 0, -1):
+                    if seq.text.endswith(stop[:size]):
+                        hold = max(hold, size)
+                        break
+        cut = len(seq.text) - hold
+        text, seq.text = seq.text[:cut], seq.text[cut:]
+        return text, False
+
+    def step(self) -> list:
+        events = []
+        scheduled = self._fill_batch()
+        if not scheduled:
+            return events
+        try:
+            self.ctx.decode(self.batch)
+        except Exception as e:
+            for seq in scheduled:
+                self._release(seq)
+                events.append(('error', seq.job_id, f"Falha na decodificação em lote: {e}"))
+            return events
+        for seq in scheduled:
+            if seq.batch_index is None:
+                continue  # Prompt ainda em avaliação
+            logits = np.ctypeslib.as_array(self.ctx.get_logits_ith(seq.batch_index), shape=(self.n_vocab,))
+            token = _sample_token(logits, seq.temperature, self.rng)
+            finished = token == self.eos
+            if not finished:
+                seq.n_generated += 1
+                seq.text += seq.decoder.decode(self.llm.detokenize([token]))
+                seq.pending.append(token)
+                finished = seq.n_generated >= seq.max_tokens or seq.n_past + 1 >= self.n_ctx_per_sequence
+            text, stopped = self._emit(seq, finished)
+            if text:
+                events.append(('token', seq.job_id, text))
+            if finished or stopped:
+                self._release(seq)
+                stats = {'cancelled': False, 'prompt_tokens': seq.n_prompt, 'completion_tokens': seq.n_generated}
+                stats.update(_prefix_stats(seq.n_reused, self.seconds_per_token))
+                events.append(('done', seq.job_id, stats))
+        return events
+
+def _batch_worker_loop(conn, decoder: BatchDecoder) -> None:
+    stopping = False
+    while True:
+        # Entre passos de decodificação: admite novos jobs e processa cancelamentos.
+        # Sem sequências o worker bloqueia aguardando a próxima mensagem; com apenas prompts
+        # abertos aguardando trechos, acorda periodicamente para expirar os abandonados.
+        while (conn.poll() or (not decoder.active and not decoder.sequences and not stopping)
+               or (not decoder.active and decoder.sequences and conn.poll(1.0))):
+            try:
+                kind, job_id, payload = conn.recv()
+            except EOFError:
+                return
+            if kind == 'stop':
+                stopping = True
+            elif kind == 'run':
+                try:
+                    decoder.admit(job_id, payload)
+                except Exception as e:
+                    conn.send(('error', job_id, str(e)))
+            elif kind == 'extend':
+                try:
+                    decoder.extend(job_id, payload)
+                except Exception as e:
+                    conn.send(('error', job_id, str(e)))
+            elif kind == 'cancel':
+                if decoder.cancel(job_id):
+                    conn.send(('done', job_id, {'cancelled': True}))
+        for job_id in decoder.expire_open(INFERENCE_OPEN_PROMPT_TIMEOUT):
+            conn.send(('error', job_id, "Prompt aberto não foi concluído a tempo"))
+        if stopping and not decoder.sequences:
+            return
+        for event in decoder.step():
+            conn.send(event)
+
+def _inference_worker_main(conn, model_config: dict) -> None:
+    # Processo worker: carrega a sua própria instância do modelo e, se possível, decodifica
+    # várias sequências em lote; caso contrário atende um job por vez.
+    batch_sequences = model_config.get('batch_sequences', 1)
+    prefixes = model_config.get('prompt_prefixes') or []
+    model_args = (model_config.get('gpu_layers'), model_config.get('n_batch'), model_config.get('n_threads'))
+    try:
+        # Com batching, o contexto próprio do Llama só é usado para tokenizar: fica pequeno e o
+        # cache KV das sequências é alocado pelo BatchDecoder.
+        llm = load_model(*model_args, n_ctx=512 if batch_sequences > 1 else 4096)
+    except Exception as e:
+        conn.send(('failed', None, str(e)))
+        return
+    decoder = None
+    if batch_sequences > 1:
+        try:
+            decoder = BatchDecoder(llm, batch_sequences, INFERENCE_SEQUENCE_CTX, model_config.get('n_batch') or 512,
+                                   model_config.get('n_threads') or 1, prefixes)
+        except Exception as e:
+            logger.warning(f"Batching contínuo indisponível ({e}). Usando decodificação sequencial.")
+            llm = load_model(*model_args)
+    prompt_cache = None
+    if decoder is None and prefixes:
+        try:
+            prompt_cache = PromptStateCache(llm, prefixes)
+        except Exception as e:
+            logger.warning(f"Cache de prefixo de prompt indisponível: {e}")
+    capacity = decoder.max_sequences if decoder else 1
+    conn.send(('ready', None, {'pid': os.getpid(), 'capacity': capacity}))
+    if decoder:
+        _batch_worker_loop(conn, decoder)
+    else:
+        _serial_worker_loop(conn, llm, prompt_cache)
+
+class InferenceWorker:
+    def __init__(self, scheduler, index: int, model_config: dict, standby: bool = False):
+        self.scheduler = scheduler
+        self.index = index
+        self.model_config = model_config
+        self.slots = None  # Definido quando o worker informa quantas sequências decodifica em lote
+        self.capacity = 0
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.ready = threading.Event()
+        self.active = threading.Event()  # Em espera (standby) até a troca de geração do modelo
+        if not standby:
+            self.active.set()
+        self.failed = None
+        self.stopping = False
+        self.process = None
+        self.conn = None
+
+    def start(self) -> None:
+        ctx = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = ctx.Pipe()
+        self.conn = parent_conn
+        self.process = ctx.Process(target=_inference_worker_main, args=(child_conn, self.model_config),
+                                   name=f"inference-worker-{self.index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        threading.Thread(target=self._reader_loop, daemon=True).start()
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
+    def send(self, msg: tuple) -> None:
+        try:
+            with self.send_lock:
+                self.conn.send(msg)
+        except (OSError, ValueError) as e:
+            logger.error(f"Falha ao enviar mensagem ao worker {self.index}: {e}")
+
+    def stop(self) -> None:
+        self.stopping = True
+        self.send(('stop', None, None))
+
+    def _reader_loop(self) -> None:
+        while True:
+            try:
+                kind, job_id, payload = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == 'ready':
+                self.capacity = payload.get('capacity', 1)
+                self.slots = threading.BoundedSemaphore(self.capacity)
+                INFERENCE_WORKERS_READY.inc()
+                logger.info(f"Worker de inferência {self.index} pronto (pid={payload['pid']}, sequências em lote={payload.get('capacity', 1)}).")
+                self.ready.set()
+                continue
+            if kind == 'failed':
+                self.failed = payload
+                logger.error(f"❌ Worker de inferência {self.index} falhou ao carregar o modelo: {payload}")
+                self.ready.set()
+                self.scheduler.fail_queued_if_unavailable()
+                break
+            with self.jobs_lock:
+                job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            if kind == 'token':
+                job._events.put(('token', payload))
+            else:
+                if kind == 'done':
+                    INFERENCE_TOKENS.labels('prompt').inc(payload.get('prompt_tokens', 0))
+                    INFERENCE_TOKENS.labels('completion').inc(payload.get('completion_tokens', 0))
+                    if 'prefix_hit' in payload:
+                        PREFIX_CACHE_LOOKUPS.labels('hit' if payload['prefix_hit'] else 'miss').inc()
+                        PREFIX_CACHE_TOKENS.inc(payload['prefix_tokens'])
+                        PREFIX_CACHE_SECONDS.inc(payload['seconds_saved'])
+                self._finish(job, payload if kind == 'error' else None)
+        # Processo encerrado: falha os jobs pendentes para não bloquear os clientes
+        if not self.ready.is_set():
+            # Morreu antes de carregar o modelo: não reinicia para não entrar em laço
+            self.failed = "Processo de inferência encerrado antes de carregar o modelo"
+            logger.error(f"❌ Worker de inferência {self.index}: {self.failed}")
+            self.ready.set()
+            self.scheduler.fail_queued_if_unavailable()
+        elif self.failed is None:
+            INFERENCE_WORKERS_READY.dec()
+        with self.jobs_lock:
+            orphans = list(self.jobs.values())
+        for job in orphans:
+            self._finish(job, "Worker de inferência encerrado")
+        if not self.stopping and self.failed is None:
+            logger.warning(f"Worker de inferência {self.index} encerrou inesperadamente. Reiniciando...")
+            self.scheduler.replace_worker(self)
+
+    def _finish(self, job: InferenceJob, error: str = None) -> None:
+        with self.jobs_lock:
+            if self.jobs.pop(job.id, None) is None:
+                return
+        job.done = True
+        job._events.put(('error', error) if error else ('done', None))
+        INFERENCE_INFLIGHT.dec()
+        self.slots.release()
+
+    def _dispatch_loop(self) -> None:
+        self.ready.wait()
+        if self.failed is not None:
+            return
+        while not self.active.wait(timeout=0.5):
+            if self.stopping:
+                return
+        while not self.stopping and self.process.is_alive():
+            if not self.slots.acquire(timeout=0.5):
+                continue
+            job = self.scheduler.next_job(timeout=0.5)
+            if job is None or job.cancelled or self.stopping:
+                if job is not None and not job.cancelled:
+                    self.scheduler.requeue(job)
+                self.slots.release()
+                continue
+            job.started_at = time.time()
+            INFERENCE_QUEUE_WAIT.labels(str(job.priority)).observe(job.started_at - job.submitted_at)
+            INFERENCE_INFLIGHT.inc()
+            with self.jobs_lock:
+                self.jobs[job.id] = job
+            with job._lock:
+                # Cancelado depois da retirada da fila: não chega ao worker e libera a vaga
+                dispatched = not job.cancelled
+                if dispatched:
+                    job.worker = self
+                    self.send(('run', job.id, dict(job.params)))
+            if not dispatched:
+                self._finish(job)
+
+class InferenceScheduler:
+    # Fila de prioridade limitada na frente de N processos worker; o número de threads de
+    # cada worker é dividido a partir de psutil.cpu_count para não haver disputa de núcleos.
+    def __init__(self, num_workers: int = INFERENCE_WORKERS, queue_size: int = INFERENCE_QUEUE_MAX):
+        self.num_workers = max(1, num_workers)
+        self._queue = queue.PriorityQueue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self.workers = []
+        self.model_config = {'gpu_layers': None, 'n_batch': None}
+        self.started = False
+        self.standby = []  # Geração de workers carregando em segundo plano
+        self._reload_target = None
+
+    def _worker_config(self, model_config: dict = None) -> dict:
+        n_threads = max(1, (psutil.cpu_count(logical=True) or 1) // self.num_workers)
+        prefixes = known_system_prompts() if PROMPT_PREFIX_CACHE else []
+        return dict(model_config or self.model_config, n_threads=n_threads, batch_sequences=INFERENCE_BATCH_SEQUENCES,
+                    prompt_prefixes=prefixes)
+
+    def start(self) -> None:
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+            config = self._worker_config()
+            for index in range(self.num_workers):
+                worker = InferenceWorker(self, index, config)
+                worker.start()
+                self.workers.append(worker)
+            atexit.register(self.shutdown)
+        logger.info(f"Escalonador de inferência iniciado com {self.num_workers} workers e {config['n_threads']} threads cada.")
+
+    def shutdown(self) -> None:
+        # Na saída do processo os workers são encerrados sem serem recriados
+        with self._lock:
+            for worker in self.workers + self.standby:
+                worker.stop()
+
+    def replace_worker(self, worker: InferenceWorker) -> None:
+        with self._lock:
+            if worker not in self.workers:
+                return
+            replacement = InferenceWorker(self, worker.index, worker.model_config)
+            self.workers[self.workers.index(worker)] = replacement
+            replacement.start()
+
+    def reconfigure(self, custom_gpu_layers, custom_n_batch) -> None:
+        # Troca com buffer duplo: a nova geração de workers carrega em segundo plano enquanto a
+        # atual continua atendendo; quando fica pronta assume a fila e a antiga termina os seus jobs.
+        model_config = {'gpu_layers': custom_gpu_layers, 'n_batch': custom_n_batch}
+        with self._lock:
+            target = self._reload_target or self.model_config
+            if model_config == target:
+                MODEL_RELOADS.labels('unchanged').inc()
+                return
+            if not self.started:
+                self.model_config = model_config
+                return
+            reloading = self._reload_target is not None
+            self._reload_target = model_config
+        if reloading:
+            logger.info("Troca de modelo já em andamento; a nova configuração será aplicada em seguida.")
+            return
+        threading.Thread(target=self._reload_loop, name="model-reload", daemon=True).start()
+
+    def _reload_loop(self) -> None:
+        MODEL_RELOAD_IN_PROGRESS.set(1)
+        try:
+            while True:
+                with self._lock:
+                    target = self._reload_target
+                    if target is None or target == self.model_config:
+                        self._reload_target = None
+                        return
+                self._swap_generation(target)
+                with self._lock:
+                    if self._reload_target == target:
+                        self._reload_target = None
+                        return
+        finally:
+            MODEL_RELOAD_IN_PROGRESS.set(0)
+
+    def _swap_generation(self, model_config: dict) -> None:
+        start = time.time()
+        logger.info(f"Carregando nova geração do modelo em segundo plano: {model_config}")
+        config = self._worker_config(model_config)
+        with self._lock:
+            self.standby = [InferenceWorker(self, index, config, standby=True) for index in range(self.num_workers)]
+            generation = list(self.standby)
+        for worker in generation:
+            worker.start()
+        for worker in generation:
+            worker.ready.wait()
+        if all(worker.failed is not None for worker in generation):
+            with self._lock:
+                self.standby = []
+            for worker in generation:
+                worker.stop()
+            MODEL_RELOADS.labels('failed').inc()
+            logger.error("❌ Nova configuração do modelo falhou em todos os workers; mantendo a geração atual.")
+            return
+        # Troca atômica: o despacho só é bloqueado pelo tempo de trocar as listas
+        blocked_start = time.perf_counter()
+        with self._lock:
+            retired, self.workers = self.workers, generation
+            self.model_config = model_config
+            self.standby = []
+        for worker in generation:
+            worker.active.set()
+        MODEL_SWAP_BLOCKED_SECONDS.observe(time.perf_counter() - blocked_start)
+        # A geração antiga para de retirar jobs da fila e encerra após concluir os que já recebeu
+        for worker in retired:
+            worker.stop()
+        MODEL_SWAP_SECONDS.observe(time.time() - start)
+        MODEL_RELOADS.labels('swapped').inc()
+        logger.info(f"✅ Nova configuração do modelo ativa em {time.time() - start:.2f}s.")
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        # Aguarda cada worker da geração atual carregar o modelo (ou falhar)
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in list(self.workers):
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            if not worker.ready.wait(remaining):
+                return False
+        return True
+
+    def available(self) -> bool:
+        return not self.workers or any(worker.failed is None for worker in self.workers)
+
+    def batched(self) -> bool:
+        # Todos os workers prontos decodificam várias sequências: um prompt aberto ocupa só uma
+        # delas. No modo sequencial ele tomaria o worker inteiro enquanto espera o restante.
+        workers = [worker for worker in self.workers if worker.ready.is_set() and worker.failed is None]
+        return bool(workers) and all(worker.capacity > 1 for worker in workers)
+
+    def fail_queued_if_unavailable(self) -> None:
+        # Sem nenhum worker capaz de carregar o modelo, os jobs na fila nunca seriam atendidos
+        if self.available():
+            return
+        while True:
+            job = self.next_job(timeout=0)
+            if job is None:
+                break
+            job.done = True
+            job._events.put(('error', "Nenhum worker de inferência disponível"))
+
+    def ensure_capacity(self) -> None:
+        if not self.available():
+            raise RuntimeError("Nenhum worker de inferência disponível")
+        if self._queue.full():
+            INFERENCE_REJECTED.inc()
+            raise InferenceQueueFull("Fila de inferência cheia")
+
+    def submit(self, messages: list, temperature: float, max_tokens: int, stop: list = None,
+               priority: int = PRIORITY_CHAT, prompt: str = None, open_prompt: bool = False) -> InferenceJob:
+        # Com prompt/open_prompt=True o job recebe o início de um prompt já formatado e o
+        # restante chega por job.extend(); o worker faz o prefill enquanto isso.
+        self.start()
+        if not self.available():
+            raise RuntimeError("Nenhum worker de inferência disponível")
+        params = {'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens, 'stop': stop}
+        if prompt is not None:
+            params.update(prompt=prompt, open=open_prompt)
+        job = InferenceJob(params, priority)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            INFERENCE_REJECTED.inc()
+            raise InferenceQueueFull("Fila de inferência cheia")
+        INFERENCE_QUEUE_DEPTH.set(self._queue.qsize())
+        return job
+
+    def requeue(self, job: InferenceJob) -> None:
+        # Devolve um job retirado por um worker que está sendo desligado (ignora o limite da fila)
+        with self._queue.mutex:
+            heapq.heappush(self._queue.queue, job)
+            self._queue.unfinished_tasks += 1
+            self._queue.not_empty.notify()
+
+    def next_job(self, timeout: float):
+        try:
+            job = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        INFERENCE_QUEUE_DEPTH.set(self._queue.qsize())
+        return job
+
+# Os workers são iniciados pelo aquecimento (warm_up) ou na primeira requisição; processos filhos (spawn)
+# reimportam este módulo e nunca enviam jobs, portanto não criam workers próprios.
+inference_scheduler = InferenceScheduler()
 
 def update_model_config(custom_gpu_layers, custom_n_batch):
-    global model
-    with model_lock:
-        logger.info("Atualizando configuração do modelo...")
-        model = load_model(custom_gpu_layers, custom_n_batch)
-        logger.info("Configuração do modelo atualizada.")
+    inference_scheduler.reconfigure(custom_gpu_layers, custom_n_batch)
+
+def run_chat_completion(messages: list, temperature: float, max_tokens: int, stop: list = None,
+                        priority: int = PRIORITY_CHAT) -> str:
+    job = inference_scheduler.submit(messages, temperature, max_tokens, stop, priority)
+    try:
+        return job.result()
+    finally:
+        job.cancel()
+
+@app.errorhandler(InferenceQueueFull)
+def inference_queue_full(e):
+    # Backpressure: a fila de inferência está cheia, o cliente deve tentar novamente depois
+    response = jsonify({'error': INFERENCE_BUSY_MESSAGE})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(INFERENCE_RETRY_AFTER)
+    return response
 
 # ===== Função Autocorretora =====
-def autocorrect_text(text: str, lang: str) -> str:
+def autocorrect_text(text: str, lang: str, priority: int = PRIORITY_CHAT) -> str:
     prompt = f"Corrija os erros de digitação e melhore a gramática do seguinte texto, mantendo o mesmo significado:\n\n{text}"
     try:
-        with model_lock:
-            correction_response = model.create_chat_completion(
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                max_tokens=200,
-                stop=["</s>"]
-            )
-        corrected_text = correction_response['choices'][0]['message']['content'].strip()
+        corrected_text = run_chat_completion(
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.3,
+            max_tokens=200,
+            stop=["</s>"],
+            priority=priority
+        ).strip()
         return corrected_text
     except Exception as e:
         logger.error(f"Erro na autocorreção: {e}")
         return text
 
+# ===== Consulta em Dois Níveis (consulta normalizada -> consulta corrigida) =====
+AUTOCORRECT_CACHE_MAX_ENTRIES = 4096
+AUTOCORRECT_CACHE_MAX_BYTES = 8 * 1024 * 1024  # 8 MB
+AUTOCORRECT_CACHE_TTL = 24 * 3600
+
+autocorrect_cache = BoundedTTLCache('autocorrect', AUTOCORRECT_CACHE_MAX_ENTRIES, AUTOCORRECT_CACHE_MAX_BYTES, AUTOCORRECT_CACHE_TTL)
+
+def normalize_query(text: str) -> str:
+    # Forma canônica usada como chave: Unicode NFKC, sem distinção de caixa e espaços colapsados
+    return " ".join(unicodedata.normalize('NFKC', text).casefold().split())
+
+def cached_autocorrect(text: str, lang: str, priority: int = PRIORITY_CHAT) -> str:
+    key = f"{lang}:{normalize_query(text)}"
+    corrected_text = autocorrect_cache.get(key)
+    if corrected_text is None:
+        corrected_text = autocorrect_text(text, lang, priority)
+        autocorrect_cache.set(key, corrected_text)
+    return corrected_text
+
+def resolve_query(query: str, lang: str, style: str, autocorrect: bool = True, priority: int = PRIORITY_CHAT) -> tuple:
+    # Nível 1: resposta em cache pela consulta bruta normalizada (nenhuma chamada ao modelo).
+    # Nível 2: consulta corrigida memoizada; só em caso de falta a autocorreção usa o modelo.
+    raw_key = normalize_query(query)
+    cached_text = get_cached_response(raw_key, lang, style)
+    if cached_text:
+        return query, [raw_key], cached_text
+    corrected_query = cached_autocorrect(query, lang, priority) if autocorrect else query
+    cache_keys = [raw_key]
+    corrected_key = normalize_query(corrected_query)
+    if corrected_key != raw_key:
+        cache_keys.append(corrected_key)
+        cached_text = get_cached_response(corrected_key, lang, style)
+        if cached_text:
+            set_cached_response(raw_key, lang, style, cached_text)
+            return corrected_query, cache_keys, cached_text
+    return corrected_query, cache_keys, None
+
 # ===== Funções para Geração de Resposta e Validação de Idioma =====
 def build_messages(query: str, lang_config: dict, style: str, custom_temperature: float = None) -> tuple[list, float]:
     if style == "Técnico":
@@ -1186,59 +2348,196 @@ def build_messages(query: str, lang_config: dict, style: str, custom_temperature
     temperature = custom_temperature if custom_temperature is not None else default_temp
     return messages, temperature
 
-def generate_response(query: str, lang: str, style: str, custom_temperature: float = None, fast_mode: bool = False) -> str:
-    corrected_query = autocorrect_text(query, lang)
+def complete_response(query: str, lang: str, style: str, custom_temperature: float = None, fast_mode: bool = False,
+                      autocorrect: bool = True, priority: int = PRIORITY_CHAT) -> str:
+    # Como generate_response, mas falhas do modelo propagam como exceção (usado pelos lotes)
     start_time = time.time()
-    cached_text = get_cached_response(corrected_query, lang, style)
+    corrected_query, cache_keys, cached_text = resolve_query(query, lang, style, autocorrect, priority)
     if cached_text:
         logger.info(f"✅ Resposta obtida do cache em {time.time() - start_time:.2f}s")
         return cached_text
     lang_config = LANGUAGE_MAP.get(lang, LANGUAGE_MAP['Português'])
     messages, temperature = build_messages(corrected_query, lang_config, style, custom_temperature)
     max_tokens = 400 if fast_mode else 800
+    raw_response = run_chat_completion(
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stop=["</s>"],
+        priority=priority
+    )
+    final_response = validate_language(raw_response, lang_config)
+    logger.info(f"✅ Resposta gerada em {time.time() - start_time:.2f}s")
+    for key in cache_keys:
+        set_cached_response(key, lang, style, final_response)
+    return final_response
+
+def generate_response(query: str, lang: str, style: str, custom_temperature: float = None, fast_mode: bool = False,
+                      autocorrect: bool = True, priority: int = PRIORITY_CHAT) -> str:
     try:
-        with model_lock:
-            response = model.create_chat_completion(
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stop=["</s>"]
-            )
-        raw_response = response['choices'][0]['message']['content']
-        final_response = validate_language(raw_response, lang_config)
-        logger.info(f"✅ Resposta gerada em {time.time() - start_time:.2f}s")
-        set_cached_response(corrected_query, lang, style, final_response)
-        return final_response
+        return complete_response(query, lang, style, custom_temperature, fast_mode, autocorrect, priority)
+    except InferenceQueueFull:
+        raise
     except Exception as e:
         logger.error(f"❌ Erro ao gerar resposta: {e}")
         return f"Erro ao gerar resposta: {e}"
 
+# ===== Streaming Real de Tokens =====
+def stream_chat_completion(messages: list, temperature: float, max_tokens: int, stop: list = None,
+                           priority: int = PRIORITY_CHAT):
+    # O job só é enfileirado quando o consumidor pede o primeiro token e ocupa o worker apenas
+    # enquanto o stream está vivo; se o gerador for fechado (ex.: cliente desconectou ->
+    # GeneratorExit) o job é cancelado e o worker interrompe a geração.
+    job = inference_scheduler.submit(messages, temperature, max_tokens, stop, priority)
+    try:
+        yield from job.iter_tokens()
+    finally:
+        job.cancel()
+
+def generate_response_stream(query: str, lang: str, style: str, custom_temperature: float = None, fast_mode: bool = False,
+                             autocorrect: bool = True, resolved: tuple = None):
+    # resolved: resultado de resolve_query já obtido pela rota (para checar o cache antes da capacidade)
+    start_time = time.time()
+    corrected_query, cache_keys, cached_text = resolved or resolve_query(query, lang, style, autocorrect)
+    if cached_text:
+        logger.info(f"✅ Resposta obtida do cache em {time.time() - start_time:.2f}s")
+        yield cached_text
+        return
+    lang_config = LANGUAGE_MAP.get(lang, LANGUAGE_MAP['Português'])
+    messages, temperature = build_messages(corrected_query, lang_config, style, custom_temperature)
+    max_tokens = 400 if fast_mode else 800
+    parts = []
+    token_stream = stream_chat_completion(messages, temperature, max_tokens, stop=["</s>"])
+    try:
+        first_token_time = None
+        for token in token_stream:
+            if first_token_time is None:
+                first_token_time = time.time()
+                logger.info(f"⚡ Primeiro token em {first_token_time - start_time:.2f}s")
+            parts.append(token)
+            yield token
+    except Exception as e:
+        logger.error(f"❌ Erro ao gerar resposta (streaming): {e}")
+        yield f"Erro ao gerar resposta: {e}"
+        return
+    finally:
+        # Garante a liberação do modelo mesmo quando o cliente desconecta no meio do stream
+        token_stream.close()
+    raw_response = "".join(parts)
+    final_response = validate_language(raw_response, lang_config)
+    if final_response != raw_response:
+        # O texto já foi enviado ao cliente; a tradução é anexada ao final
+        yield "<br><br>" + final_response
+    logger.info(f"✅ Resposta gerada (streaming) em {time.time() - start_time:.2f}s")
+    for key in cache_keys:
+        set_cached_response(key, lang, style, final_response)
+
+# ===== Validação de Idioma (amostra, detector determinístico e caches) =====
+LANGUAGE_SAMPLE_CHARS = 1200  # a detecção usa no máximo isso, em três janelas (início, meio e fim)
+LANGUAGE_MIN_SAMPLE_CHARS = 40  # abaixo disso (após limpar URLs/código) a detecção não é confiável
+LANGUAGE_MIN_CONFIDENCE = 0.9  # só traduz quando o idioma errado é detectado com essa probabilidade
+LANGUAGE_DETECTION_SEED = 0
+LANGUAGE_CACHE_MAX_ENTRIES = 8192
+LANGUAGE_CACHE_MAX_BYTES = 4 * 1024 * 1024  # 4 MB
+LANGUAGE_CACHE_TTL = 24 * 3600
+TRANSLATION_CACHE_MAX_ENTRIES = 512
+TRANSLATION_CACHE_MAX_BYTES = 16 * 1024 * 1024  # 16 MB
+TRANSLATION_CACHE_TTL = 24 * 3600
+
+# O langdetect sorteia a ordem das n-gramas a cada chamada; com semente fixa o mesmo texto
+# sempre recebe o mesmo resultado, o que torna o cache por conteúdo correto.
+DetectorFactory.seed = LANGUAGE_DETECTION_SEED
+
+LANGUAGE_NEUTRAL_PATTERN = re.compile(
+    r'```.*?```|`[^`]*`|<[^>]+>|https?://\S+|www\.\S+|\S+@\S+|[\d\W_]+(?=\s|$)', re.DOTALL)
+
+LANGUAGE_CHECKS = Counter('language_checks_total', 'Validações de idioma das respostas', ['result'])
+LANGUAGE_DETECT_SECONDS = Histogram('language_detect_seconds', 'Tempo de detecção de idioma (sem acerto de cache)',
+                                    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+TRANSLATION_PASSES = Counter('translation_passes_total', 'Passadas de tradução pelo modelo', ['result'])
+TRANSLATION_SECONDS = Histogram('translation_seconds', 'Tempo adicionado às respostas pela tradução',
+                                buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 20, 40, 80))
+
+language_cache = BoundedTTLCache('language', LANGUAGE_CACHE_MAX_ENTRIES, LANGUAGE_CACHE_MAX_BYTES, LANGUAGE_CACHE_TTL)
+translation_cache = BoundedTTLCache('translation', TRANSLATION_CACHE_MAX_ENTRIES, TRANSLATION_CACHE_MAX_BYTES,
+                                    TRANSLATION_CACHE_TTL)
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+def language_sample(text: str) -> str:
+    # Remove trechos sem idioma (código, tags, URLs, e-mails, números) e limita o tamanho:
+    # textos longos viram três janelas, para que o custo não cresça com a resposta.
+    cleaned = " ".join(LANGUAGE_NEUTRAL_PATTERN.sub(' ', text).split())
+    if len(cleaned) <= LANGUAGE_SAMPLE_CHARS:
+        return cleaned
+    window = LANGUAGE_SAMPLE_CHARS // 3
+    middle = (len(cleaned) - window) // 2
+    return " ".join((cleaned[:window], cleaned[middle:middle + window], cleaned[-window:]))
+
+def detect_language(text: str) -> list:
+    # Lista [(idioma, probabilidade)] em ordem decrescente; vazia se a amostra for curta demais
+    sample = language_sample(text)
+    if len(sample) < LANGUAGE_MIN_SAMPLE_CHARS:
+        return []
+    key = _content_hash(sample)
+    cached = language_cache.get(key)
+    if cached is not None:
+        return cached
+    started = time.perf_counter()
+    detected = tuple((item.lang.split('-')[0], item.prob) for item in detect_langs(sample))
+    LANGUAGE_DETECT_SECONDS.observe(time.perf_counter() - started)
+    language_cache.set(key, detected)
+    return detected
+
 def validate_language(text: str, lang_config: dict) -> str:
+    expected_lang = lang_config['code'].split('-')[0]
     try:
-        detected_lang = detect(text)
-        expected_lang = lang_config['code'].split('-')[0]
-        if detected_lang != expected_lang:
-            logger.info(f"Idioma detectado ({detected_lang}) difere do esperado ({expected_lang}). Corrigindo...")
-            return correct_language(text, lang_config)
-        return text
+        detected = detect_language(text)
     except Exception as e:
+        LANGUAGE_CHECKS.labels('error').inc()
         logger.warning(f"⚠️ Falha na detecção de idioma: {e}. Retornando texto original.")
         return text
+    if not detected:
+        LANGUAGE_CHECKS.labels('skipped').inc()
+        return text
+    detected_lang, probability = detected[0]
+    if detected_lang == expected_lang:
+        LANGUAGE_CHECKS.labels('match').inc()
+        return text
+    if probability < LANGUAGE_MIN_CONFIDENCE:
+        # Detecção ambígua (texto curto, técnico ou misto): não vale uma segunda geração
+        LANGUAGE_CHECKS.labels('uncertain').inc()
+        logger.info(f"Idioma incerto ({detected_lang} {probability:.2f}); mantendo o texto original.")
+        return text
+    LANGUAGE_CHECKS.labels('mismatch').inc()
+    logger.info(f"Idioma detectado ({detected_lang} {probability:.2f}) difere do esperado ({expected_lang}). Corrigindo...")
+    return correct_language(text, lang_config)
 
 def correct_language(text: str, lang_config: dict) -> str:
+    key = f"{lang_config['code']}:{_content_hash(text)}"
+    cached = translation_cache.get(key)
+    if cached is not None:
+        TRANSLATION_PASSES.labels('cached').inc()
+        return cached
+    started = time.perf_counter()
     try:
         correction_prompt = f"Traduza para {lang_config['instruction']}:\n{text}"
-        with model_lock:
-            corrected = model.create_chat_completion(
-                messages=[{"role": "user", "content": correction_prompt}],
-                temperature=0.3,
-                max_tokens=1000
-            )
-        corrected_text = corrected['choices'][0]['message']['content']
-        return f"[Traduzido]\n{corrected_text}"
+        corrected_text = run_chat_completion(
+            messages=[{"role": "user", "content": correction_prompt}],
+            temperature=0.3,
+            max_tokens=1000
+        )
     except Exception as e:
+        TRANSLATION_PASSES.labels('error').inc()
         logger.error(f"❌ Erro na correção de idioma: {e}")
         return text
+    finally:
+        TRANSLATION_SECONDS.observe(time.perf_counter() - started)
+    TRANSLATION_PASSES.labels('generated').inc()
+    translated = f"[Traduzido]\n{corrected_text}"
+    translation_cache.set(key, translated)
+    return translated
 
 # ===== Novo Modo: Descoberta de IP =====
 def discover_ip(target: str) -> dict:
@@ -1277,6 +2576,8 @@ def ask():
     temp_input = request.form.get('temperature', None)
     custom_temperature = float(temp_input) if temp_input is not None and temp_input != "" else None
     fast_mode = request.form.get('fast_mode', 'false').lower() == 'true'
+    stream = request.args.get('stream', 'false').lower() == 'true'
+    autocorrect = request.form.get('autocorrect', 'true').lower() != 'false'
     
     if mode == "Investigação":
         if not user_input.strip():
@@ -1286,9 +2587,15 @@ def ask():
             investigation_focus = request.form.get('investigation_focus', '')
             search_news = request.form.get('search_news', 'false').lower() == 'true'
             search_leaked_data = request.form.get('search_leaked_data', 'false').lower() == 'true'
-            report, links_table = process_investigation(user_input, sites_meta, investigation_focus, search_news, search_leaked_data, custom_temperature, lang, fast_mode)
+            aliases = [alias.strip() for alias in request.form.get('aliases', '').split(',') if alias.strip()]
+            if stream:
+                inference_scheduler.ensure_capacity()
+                return streamed_text_response(stream_investigation(user_input, sites_meta, investigation_focus, search_news, search_leaked_data, custom_temperature, lang, fast_mode, autocorrect, aliases))
+            report, links_table = process_investigation(user_input, sites_meta, investigation_focus, search_news, search_leaked_data, custom_temperature, lang, fast_mode, autocorrect, aliases)
             final_report = report + "<br><br>Links encontrados:<br>" + links_table
             return jsonify({'response': final_report})
+        except InferenceQueueFull:
+            raise
         except Exception as e:
             logger.error(f"Erro no modo Investigação: {e}")
             return jsonify({'error': str(e)}), 500
@@ -1296,44 +2603,519 @@ def ask():
         if not user_input.strip():
             return jsonify({'response': "Erro: Por favor, insira um link de imagem."})
         try:
-            meta = analyze_image_metadata(user_input)
+            meta = analyze_image_metadata(user_input, request.form.get('case') or PHASH_DEFAULT_CASE,
+                                          _as_bool(request.form.get('phash')))
             formatted_meta = "<br>".join(f"{k}: {v}" for k, v in meta.items())
+            if stream:
+                # O cliente em modo streaming lê o corpo como texto
+                return Response(formatted_meta, mimetype='text/html')
             return jsonify({'response': formatted_meta})
         except Exception as e:
             logger.error(f"Erro no modo Metadados: {e}")
             return jsonify({'error': str(e)}), 500
     else:  # Modo Chat
         try:
-            response_text = generate_response(user_input, lang, style, custom_temperature, fast_mode)
+            if stream:
+                resolved = resolve_query(user_input, lang, style, autocorrect)
+                if resolved[2] is None:
+                    # Só uma resposta fora do cache precisa de worker livre
+                    inference_scheduler.ensure_capacity()
+                return streamed_text_response(generate_response_stream(user_input, lang, style, custom_temperature, fast_mode,
+                                                                       autocorrect, resolved))
+            response_text = generate_response(user_input, lang, style, custom_temperature, fast_mode, autocorrect)
             return jsonify({'response': response_text})
+        except InferenceQueueFull:
+            raise
         except Exception as e:
             logger.error(f"Erro no modo Chat: {e}")
             return jsonify({'error': str(e)}), 500
 
 # ===== Função para Streaming de Respostas (para feedback em tempo real) =====
-def streaming_response(text: str, chunk_size: int = 200):
-    for i in range(0, len(text), chunk_size):
-        yield text[i:i+chunk_size]
-        time.sleep(0.1)
+def streamed_text_response(generator, mimetype: str = 'text/html') -> Response:
+    # Resposta HTTP chunked: cada token é enviado assim que sai do modelo.
+    # Se o cliente desconectar, o Werkzeug fecha o gerador e a geração é cancelada.
+    response = Response(stream_with_context(generator), mimetype=mimetype)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# ===== Jobs em Lote (fila durável em SQLite) =====
+BATCH_JOBS_PATH = os.environ.get("BATCH_JOBS_PATH", os.path.join(CACHE_DIR, "batch_jobs.sqlite3"))
+BATCH_CONCURRENCY = INFERENCE_WORKERS  # itens em execução ao mesmo tempo (um por worker de inferência)
+BATCH_MAX_ITEMS = 500  # itens por lote
+BATCH_MAX_PENDING = 5000  # itens aguardando em todos os lotes; acima disso o POST recebe 429
+BATCH_ITEM_MAX_ATTEMPTS = 3  # itens interrompidos por reinício são retomados até esse limite
+BATCH_IDLE_POLL = 5.0
+BATCH_PROGRESS_INTERVAL = 1.0
+BATCH_JOB_TTL = 7 * 24 * 3600  # lotes concluídos são apagados depois disso
+
+BATCH_ITEMS = Counter('batch_items_total', 'Itens de lote processados', ['mode', 'result'])
+BATCH_QUEUE_DEPTH = Gauge('batch_queue_depth', 'Itens de lote aguardando execução')
+BATCH_ITEM_SECONDS = Histogram('batch_item_seconds', 'Tempo de execução dos itens de lote', ['mode'],
+                               buckets=(0.01, 0.1, 1, 5, 10, 20, 40, 80, 160, 320))
+
+BATCH_MODES = {'chat': 'Chat', 'investigação': 'Investigação', 'investigacao': 'Investigação',
+               'investigation': 'Investigação'}
+BATCH_TERMINAL_STATUSES = ('done', 'error', 'cancelled')
+
+def _as_bool(value, default: bool = False) -> bool:
+    if value is None or value == "":
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes', 'sim', 'on')
+    return bool(value)
+
+def normalize_batch_item(item, defaults: dict) -> dict:
+    # Aceita os mesmos campos do /ask (user_input, mode, language, style, ...); um item pode
+    # ser só o texto da consulta. Campos ausentes vêm de `defaults`.
+    if isinstance(item, str):
+        item = {'user_input': item}
+    if not isinstance(item, dict):
+        raise ValueError("cada item deve ser um texto ou um objeto")
+    fields = dict(defaults, **item)
+    mode = BATCH_MODES.get(str(fields.get('mode', 'Chat')).strip().lower())
+    if mode is None:
+        raise ValueError(f"modo não suportado: {fields.get('mode')}")
+    user_input = str(fields.get('user_input') or fields.get('query') or fields.get('target') or '').strip()
+    if not user_input:
+        raise ValueError("consulta vazia")
+    temperature = fields.get('temperature')
+    params = {
+        'mode': mode,
+        'user_input': user_input,
+        'language': fields.get('language') if fields.get('language') in LANGUAGE_MAP else 'Português',
+        'style': str(fields.get('style') or 'Técnico'),
+        'temperature': float(temperature) if temperature not in (None, "") else None,
+        'fast_mode': _as_bool(fields.get('fast_mode')),
+        'autocorrect': _as_bool(fields.get('autocorrect'), True)
+    }
+    if mode == 'Investigação':
+        aliases = fields.get('aliases') or []
+        if isinstance(aliases, str):
+            aliases = aliases.split(',')
+        params.update({
+            'sites_meta': int(fields.get('sites_meta') or 5),
+            'investigation_focus': str(fields.get('investigation_focus') or ''),
+            'search_news': _as_bool(fields.get('search_news')),
+            'search_leaked_data': _as_bool(fields.get('search_leaked_data')),
+            'aliases': [alias.strip() for alias in aliases if str(alias).strip()]
+        })
+    return params
+
+def batch_cache_key(params: dict) -> tuple:
+    # (consulta, idioma, estilo) no cache de respostas; a chave do chat é a mesma usada pelo /ask
+    if params['mode'] == 'Chat':
+        return normalize_query(params['user_input']), params['language'], params['style']
+    aliases = ",".join(sorted(normalize_query(alias) for alias in params['aliases']))
+    query = "|".join((normalize_query(params['user_input']), normalize_query(params['investigation_focus']),
+                      str(params['sites_meta']), str(params['search_news']), str(params['search_leaked_data']),
+                      aliases))
+    return f"investigation:{query}", params['language'], 'Investigação'
+
+class BatchJobStore:
+    # Lotes e itens em SQLite: sobrevivem a reinícios e itens 'running' de uma execução
+    # interrompida voltam para a fila na abertura (até BATCH_ITEM_MAX_ATTEMPTS tentativas).
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS batches (
+                    id TEXT PRIMARY KEY, created_at REAL NOT NULL, finished_at REAL, cancelled INTEGER NOT NULL DEFAULT 0)""")
+                conn.execute("""CREATE TABLE IF NOT EXISTS batch_items (
+                    batch_id TEXT NOT NULL, idx INTEGER NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL,
+                    duplicate_of INTEGER, cached INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT, error TEXT, queued_at REAL NOT NULL, started_at REAL, finished_at REAL,
+                    PRIMARY KEY (batch_id, idx))""")
+                conn.execute("CREATE INDEX IF NOT EXISTS batch_items_status ON batch_items (status, queued_at)")
+                conn.execute("UPDATE batch_items SET status = 'error', error = 'Interrompido repetidamente', "
+                             "finished_at = ? WHERE status = 'running' AND attempts >= ?",
+                             (time.time(), BATCH_ITEM_MAX_ATTEMPTS))
+                resumed = conn.execute("UPDATE batch_items SET status = 'queued' WHERE status = 'running'").rowcount
+            if resumed:
+                logger.info(f"♻️ {resumed} itens de lote interrompidos voltaram para a fila.")
+            self._conn = conn
+        return self._conn
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM batch_items WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def create(self, items: list) -> str:
+        batch_id = uuid.uuid4().hex
+        now = time.time()
+        rows, first_by_key = [], {}
+        for idx, params in enumerate(items):
+            # Itens repetidos no mesmo lote não geram de novo: apontam para o primeiro
+            original = first_by_key.setdefault(batch_cache_key(params), idx)
+            duplicate_of = original if original != idx else None
+            rows.append((batch_id, idx, json.dumps(params, ensure_ascii=False),
+                         'duplicate' if duplicate_of is not None else 'queued', duplicate_of, now))
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT INTO batches (id, created_at) VALUES (?, ?)", (batch_id, now))
+                conn.executemany("INSERT INTO batch_items (batch_id, idx, params, status, duplicate_of, queued_at) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._prune(conn, now)
+        return batch_id
+
+    def claim(self):
+        # Próximo item da fila (FIFO entre lotes), marcado como 'running'
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT batch_id, idx, params FROM batch_items WHERE status = 'queued' "
+                               "ORDER BY queued_at, idx LIMIT 1").fetchone()
+            if row is None:
+                return None
+            with conn:
+                conn.execute("UPDATE batch_items SET status = 'running', started_at = ?, attempts = attempts + 1 "
+                             "WHERE batch_id = ? AND idx = ?", (time.time(), row[0], row[1]))
+        return row[0], row[1], json.loads(row[2])
+
+    def requeue(self, batch_id: str, idx: int) -> None:
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("UPDATE batch_items SET status = 'queued', attempts = attempts - 1 "
+                             "WHERE batch_id = ? AND idx = ? AND status = 'running'", (batch_id, idx))
+
+    def finish(self, batch_id: str, idx: int, status: str, result: str = None, error: str = None,
+               cached: bool = False) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("UPDATE batch_items SET status = ?, result = ?, error = ?, cached = ?, finished_at = ? "
+                             "WHERE batch_id = ? AND idx = ? AND status = 'running'",
+                             (status, result, error, int(cached), now, batch_id, idx))
+                self._close_if_finished(conn, batch_id, now)
+
+    def cancel(self, batch_id: str) -> int:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("UPDATE batches SET cancelled = 1 WHERE id = ?", (batch_id,))
+                cancelled = conn.execute("UPDATE batch_items SET status = 'cancelled', finished_at = ? "
+                                         "WHERE batch_id = ? AND status = 'queued'", (now, batch_id)).rowcount
+                self._close_if_finished(conn, batch_id, now)
+        return cancelled
+
+    def _close_if_finished(self, conn, batch_id: str, now: float) -> None:
+        remaining = conn.execute("SELECT COUNT(*) FROM batch_items WHERE batch_id = ? AND status IN ('queued', 'running')",
+                                 (batch_id,)).fetchone()[0]
+        if not remaining:
+            conn.execute("UPDATE batches SET finished_at = ? WHERE id = ? AND finished_at IS NULL", (now, batch_id))
+
+    def _prune(self, conn, now: float) -> None:
+        with conn:
+            expired = [row[0] for row in conn.execute("SELECT id FROM batches WHERE finished_at < ?",
+                                                      (now - BATCH_JOB_TTL,))]
+            for batch_id in expired:
+                conn.execute("DELETE FROM batch_items WHERE batch_id = ?", (batch_id,))
+                conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+
+    def snapshot(self, batch_id: str, include_results: bool = True, select=None):
+        # select(índice, estado) escolhe os itens devolvidos por completo; os demais só entram nos
+        # contadores, lidos sem os resultados (o stream de progresso busca apenas os itens novos)
+        with self._lock:
+            conn = self._connection()
+            batch = conn.execute("SELECT created_at, finished_at, cancelled FROM batches WHERE id = ?",
+                                 (batch_id,)).fetchone()
+            if batch is None:
+                return None
+            states = conn.execute("SELECT idx, status, duplicate_of FROM batch_items WHERE batch_id = ? ORDER BY idx",
+                                  (batch_id,)).fetchall()
+            # Duplicados herdam o estado do item original
+            statuses = [states[duplicate_of][1] if duplicate_of is not None else status
+                        for idx, status, duplicate_of in states]
+            selected = [idx for idx, _, _ in states if select is None or select(idx, statuses[idx])]
+            needed = sorted(set(selected) | {states[idx][2] for idx in selected if states[idx][2] is not None})
+            query = ("SELECT idx, params, status, duplicate_of, cached, attempts, result, error, queued_at, "
+                     "started_at, finished_at FROM batch_items WHERE batch_id = ?")
+            if select is None:
+                rows = conn.execute(query, (batch_id,)).fetchall()
+            elif needed:
+                rows = conn.execute(query + f" AND idx IN ({', '.join('?' * len(needed))})",
+                                    (batch_id, *needed)).fetchall()
+            else:
+                rows = []
+        created_at, finished_at, cancelled = batch
+        items = {}
+        for idx, params, status, duplicate_of, cached, attempts, result, error, queued_at, started_at, done_at in rows:
+            params = json.loads(params)
+            items[idx] = {
+                'index': idx, 'mode': params['mode'], 'user_input': params['user_input'], 'status': status,
+                'cached': bool(cached), 'duplicate_of': duplicate_of, 'attempts': attempts,
+                'result': result, 'error': error,
+                'timings': {
+                    'queue_wait': round(started_at - queued_at, 3) if started_at else None,
+                    'run': round(done_at - started_at, 3) if started_at and done_at else None,
+                    'total': round(done_at - queued_at, 3) if done_at else None
+                }
+            }
+        for item in items.values():
+            if item['duplicate_of'] is not None:
+                original = items[item['duplicate_of']]
+                item.update(status=original['status'], result=original['result'], error=original['error'],
+                            cached=True)
+        items = [items[idx] for idx in selected]
+        if not include_results:
+            for item in items:
+                item.pop('result')
+        counts = collections.Counter(statuses)
+        if finished_at is None:
+            status = 'running' if counts['running'] or counts['done'] or counts['error'] else 'queued'
+        else:
+            status = 'cancelled' if cancelled else 'done'
+        return {
+            'batch_id': batch_id,
+            'status': status,
+            'total': len(statuses),
+            'counts': dict(counts),
+            'elapsed': round((finished_at or time.time()) - created_at, 3),
+            'items': items
+        }
+
+class BatchJobRunner:
+    # Executa os itens da fila com BATCH_CONCURRENCY threads; cada uma ocupa no máximo um job
+    # nos workers de inferência, com prioridade abaixo do chat e das investigações interativas.
+    def __init__(self, store: BatchJobStore, concurrency: int):
+        self.store = store
+        self.concurrency = concurrency
+        self.threads = []
+        self._wake = threading.Condition()
+
+    def start(self) -> None:
+        with self._wake:
+            if not self.threads:
+                for i in range(self.concurrency):
+                    thread = threading.Thread(target=self._run, name=f"batch-runner-{i}", daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+                logger.info(f"Executor de lotes iniciado com {self.concurrency} threads.")
+            self._wake.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                claimed = self.store.claim()
+                BATCH_QUEUE_DEPTH.set(self.store.pending())
+            except Exception as e:
+                logger.error(f"❌ Erro ao ler a fila de lotes: {e}")
+                claimed = None
+            if claimed is None:
+                with self._wake:
+                    self._wake.wait(timeout=BATCH_IDLE_POLL)
+                continue
+            self._process(*claimed)
+
+    def _process(self, batch_id: str, idx: int, params: dict) -> None:
+        mode = params['mode']
+        key = batch_cache_key(params)
+        cached = get_cached_response(*key)
+        if cached is not None:
+            self.store.finish(batch_id, idx, 'done', cached, cached=True)
+            BATCH_ITEMS.labels(mode, 'cached').inc()
+            return
+        started = time.monotonic()
+        failed = False
+        try:
+            # As versões que propagam exceções: a falha vem do erro, não do texto da resposta
+            if mode == 'Investigação':
+                report, links = collect_investigation(
+                    params['user_input'], params['sites_meta'], params['investigation_focus'], params['search_news'],
+                    params['search_leaked_data'], params['temperature'], params['language'], params['fast_mode'],
+                    params['autocorrect'], params['aliases'], priority=PRIORITY_BATCH)
+                text = report + "<br><br>Links encontrados:<br>" + links
+                set_cached_response(*key, text)
+            else:
+                text = complete_response(params['user_input'], params['language'], params['style'],
+                                         params['temperature'], params['fast_mode'], params['autocorrect'],
+                                         priority=PRIORITY_BATCH)
+        except InferenceQueueFull:
+            # Fila de inferência cheia: o item volta para a fila e a thread espera um pouco
+            self.store.requeue(batch_id, idx)
+            time.sleep(INFERENCE_RETRY_AFTER)
+            return
+        except Exception as e:
+            logger.error(f"❌ Erro no item {idx} do lote {batch_id}: {e}")
+            failed, text = True, str(e)
+        BATCH_ITEM_SECONDS.labels(mode).observe(time.monotonic() - started)
+        BATCH_ITEMS.labels(mode, 'error' if failed else 'done').inc()
+        if failed:
+            self.store.finish(batch_id, idx, 'error', error=text)
+        else:
+            self.store.finish(batch_id, idx, 'done', text)
+
+batch_store = BatchJobStore(BATCH_JOBS_PATH)
+batch_runner = BatchJobRunner(batch_store, BATCH_CONCURRENCY)
+
+def _batch_links(batch_id: str) -> dict:
+    return {
+        'batch_id': batch_id,
+        'status_url': f"/jobs/{batch_id}",
+        'stream_url': f"/jobs/{batch_id}/stream"
+    }
+
+@app.route('/jobs', methods=['POST'])
+def create_batch_job():
+    # Corpo JSON: {"items": [...], "defaults": {...}}; cada item usa os campos do /ask
+    payload = request.get_json(silent=True) or {}
+    items = payload.get('items')
+    defaults = payload.get('defaults') or {}
+    if not isinstance(items, list) or not items or not isinstance(defaults, dict):
+        return jsonify({'error': 'Envie um JSON com a lista "items" (e opcionalmente "defaults").'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Máximo de {BATCH_MAX_ITEMS} itens por lote.'}), 413
+    try:
+        normalized = []
+        for idx, item in enumerate(items):
+            try:
+                normalized.append(normalize_batch_item(item, defaults))
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Item {idx}: {e}")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if batch_store.pending() + len(normalized) > BATCH_MAX_PENDING:
+        response = jsonify({'error': 'Fila de lotes cheia. Tente novamente mais tarde.'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(INFERENCE_RETRY_AFTER)
+        return response
+    batch_id = batch_store.create(normalized)
+    batch_runner.start()
+    logger.info(f"📥 Lote {batch_id} recebido com {len(normalized)} itens.")
+    snapshot = batch_store.snapshot(batch_id, include_results=False)
+    return jsonify(dict(_batch_links(batch_id), **snapshot)), 202
+
+@app.route('/jobs/<batch_id>', methods=['GET'])
+def batch_job_status(batch_id):
+    include_results = request.args.get('results', 'true').lower() != 'false'
+    snapshot = batch_store.snapshot(batch_id, include_results)
+    if snapshot is None:
+        return jsonify({'error': 'Lote não encontrado'}), 404
+    return jsonify(snapshot)
+
+@app.route('/jobs/<batch_id>', methods=['DELETE'])
+def cancel_batch_job(batch_id):
+    # Cancela os itens ainda na fila; os que já estão em execução terminam normalmente
+    if batch_store.snapshot(batch_id, include_results=False) is None:
+        return jsonify({'error': 'Lote não encontrado'}), 404
+    batch_store.cancel(batch_id)
+    return jsonify(batch_store.snapshot(batch_id, include_results=False))
+
+@app.route('/jobs/<batch_id>/stream', methods=['GET'])
+def stream_batch_job(batch_id):
+    # NDJSON: uma linha por item assim que ele termina ({"type": "item", ...}) e uma linha final
+    # com o resumo do lote ({"type": "batch", ...})
+    if batch_store.snapshot(batch_id, include_results=False) is None:
+        return jsonify({'error': 'Lote não encontrado'}), 404
+
+    def generate():
+        sent = set()
+        while True:
+            # A cada volta só os contadores e os itens que terminaram desde a anterior são lidos
+            snapshot = batch_store.snapshot(
+                batch_id, select=lambda idx, status: status in BATCH_TERMINAL_STATUSES and idx not in sent)
+            finished = snapshot['status'] in ('done', 'cancelled')
+            for item in snapshot.pop('items'):
+                sent.add(item['index'])
+                yield json.dumps(dict(type='item', **item), ensure_ascii=False) + "\n"
+            if finished:
+                yield json.dumps(dict(type='batch', **snapshot), ensure_ascii=False) + "\n"
+                break
+            time.sleep(BATCH_PROGRESS_INTERVAL)
+
+    return streamed_text_response(generate(), mimetype='application/x-ndjson')
 
 # ===== Funções para Análise Forense e Processamento de Texto =====
 def advanced_forensic_analysis(text: str) -> dict:
     forensic_info = {}
     try:
-        for key, pattern in COMPILED_REGEX_PATTERNS.items():
-            matches = pattern.findall(text)
-            if matches:
-                forensic_info[key] = list(set(matches))
+        forensic_info = FORENSIC_INDICATOR_SCANNER.scan(text)
     except Exception as e:
         logger.error(f"❌ Erro durante a análise forense: {e}")
     return forensic_info
 
 # --- SISTEMA DE METADADOS ---
+METADATA_INITIAL_BYTES = 64 * 1024  # primeira faixa pedida; EXIF/XMP costumam estar nos primeiros KB
+METADATA_MAX_BYTES = 8 * 1024 * 1024  # nunca baixa mais que isso de uma imagem
+METADATA_STREAM_CHUNK = 16 * 1024
+METADATA_TIMEOUT = 10
+METADATA_POOL_CONNECTIONS = 32  # hosts com pool de conexões mantido
+METADATA_POOL_MAXSIZE = 4  # conexões keep-alive por host
+METADATA_XMP_MAX_CHARS = 8192
+EXIF_IFD_TAG = 0x8769
+GPS_IFD_TAG = 0x8825
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+XMP_JPEG_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+METADATA_BULK_MAX_URLS = 1000
+METADATA_BULK_FETCH_WORKERS = 32  # downloads simultâneos no total; por host o limite é METADATA_POOL_MAXSIZE
+METADATA_BULK_INFLIGHT = 32  # imagens em memória por requisição (baixando ou aguardando o parsing)
+METADATA_CACHE_MAX_ENTRIES = 20000
+METADATA_CACHE_MAX_BYTES = 64 * 1024 * 1024
+METADATA_CACHE_TTL = 7 * 24 * 3600  # entradas são revalidadas por ETag/Last-Modified a cada uso
+PHASH_MAX_BYTES = 32 * 1024 * 1024  # hash perceptual (opcional) baixa a imagem inteira, até este limite
+PHASH_SIZE = 32  # lado da imagem reduzida para a DCT
+PHASH_LOW_FREQ = 8  # 8x8 coeficientes de menor frequência -> 64 bits
+PHASH_INDEX_DIR = os.environ.get("PHASH_INDEX_DIR", os.path.join(CACHE_DIR, "image_hashes"))
+PHASH_DEFAULT_CASE = "default"
+PHASH_DEFAULT_DISTANCE = 10  # bits diferentes (de 64) para considerar quase idêntica
+PHASH_MAX_RESULTS = 50
+PHASH_MAX_RESULTS_LIMIT = 1000
+
+IMAGE_METADATA_BYTES = Counter('image_metadata_bytes_total', 'Bytes baixados para extrair metadados de imagens')
+IMAGE_METADATA_FETCH_BYTES = Histogram('image_metadata_fetch_bytes', 'Bytes baixados por imagem na extração de metadados',
+                                       buckets=(4096, 16384, 65536, 262144, 1048576, 4194304, 8388608))
+IMAGE_METADATA_BULK = Counter('image_metadata_bulk_total', 'Imagens processadas em /image_metadata/bulk', ['result'])
+IMAGE_METADATA_BULK_SECONDS = Histogram('image_metadata_bulk_seconds', 'Duração das requisições de metadados em lote',
+                                        buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+IMAGE_HASH_INDEX_SIZE = Gauge('image_hash_index_entries', 'Imagens no índice de hashes perceptuais')
+IMAGE_HASH_SEARCH_SECONDS = Histogram('image_hash_search_seconds', 'Duração da busca por distância de Hamming no índice',
+                                      buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5))
+IMAGE_METADATA_REQUESTS = Counter('image_metadata_http_requests_total', 'Requisições HTTP da extração de metadados', ['status'])
+
+_metadata_session = None
+_metadata_session_lock = threading.Lock()
+_metadata_fetch_pool = None
+_metadata_fetch_pool_lock = threading.Lock()
+
+image_metadata_cache = BoundedTTLCache('image_metadata', METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_MAX_BYTES,
+                                       METADATA_CACHE_TTL)
+
+def get_metadata_session() -> requests.Session:
+    # Sessão compartilhada: conexões keep-alive reaproveitadas, até METADATA_POOL_MAXSIZE por host
+    global _metadata_session
+    with _metadata_session_lock:
+        if _metadata_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=METADATA_POOL_CONNECTIONS,
+                                                    pool_maxsize=METADATA_POOL_MAXSIZE, pool_block=True)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _metadata_session = session
+        return _metadata_session
+
+def _rational_value(value) -> float:
+    # Pillow antigo devolve (numerador, denominador); o atual, IFDRational
+    if isinstance(value, tuple):
+        return value[0] / value[1]
+    return float(value)
+
 def get_decimal_from_dms(dms, ref):
     try:
-        degrees = dms[0][0] / dms[0][1]
-        minutes = dms[1][0] / dms[1][1]
-        seconds = dms[2][0] / dms[2][1]
+        degrees = _rational_value(dms[0])
+        minutes = _rational_value(dms[1])
+        seconds = _rational_value(dms[2])
         decimal = degrees + (minutes / 60.0) + (seconds / 3600.0)
         if ref in ['S', 'W']:
             decimal = -decimal
@@ -1341,61 +3123,1140 @@ def get_decimal_from_dms(dms, ref):
     except Exception as e:
         raise ValueError("Erro ao converter coordenadas DMS para decimal: " + str(e))
 
-def analyze_image_metadata(url: str) -> dict:
+def _jpeg_segments(data):
+    # Percorre os segmentos do JPEG até o SOS; gera (marcador, início do conteúdo, fim) e, se o
+    # buffer acabar antes, ('need', bytes necessários, None)
+    pos = 2
+    while True:
+        if pos + 4 > len(data):
+            yield 'need', pos + 4, None
+            return
+        if data[pos] != 0xFF:
+            return
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            return
+        end = pos + 2 + int.from_bytes(data[pos + 2:pos + 4], 'big')
+        yield marker, pos + 4, end
+        if marker in JPEG_SOF_MARKERS:
+            return
+        pos = end
+
+def _png_chunks(data):
+    pos = 8
+    while True:
+        if pos + 8 > len(data):
+            yield 'need', pos + 8, None
+            return
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        kind = bytes(data[pos + 4:pos + 8])
+        if kind in (b'IDAT', b'IEND'):
+            return
+        yield kind, pos + 8, pos + 8 + length
+        pos += 12 + length
+
+def image_metadata_need(data) -> int:
+    # Quantos bytes (a partir do início) são necessários para ler os metadados: 0 quando o
+    # buffer já basta. Segmentos de metadados precisam estar completos; os demais são pulados.
+    if data[:2] == b'\xff\xd8':
+        for marker, start, end in _jpeg_segments(data):
+            if marker == 'need':
+                return start
+            if (0xE0 <= marker <= 0xEF or marker in JPEG_SOF_MARKERS) and end > len(data):
+                return end
+        return 0
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        for kind, start, end in _png_chunks(data):
+            if kind == 'need':
+                return start
+            if kind in (b'IHDR', b'eXIf', b'iTXt', b'tEXt') and end > len(data):
+                return end
+        return 0
+    # Outros formatos: o Pillow decide; se falhar com o buffer parcial, dobra o tamanho
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        image_data = response.content
-        image = Image.open(io.BytesIO(image_data))
-        meta = {}
-        exif_data = image.getexif()
-        if exif_data:
-            for tag_id, value in exif_data.items():
-                tag = Image.ExifTags.TAGS.get(tag_id, tag_id)
-                meta[tag] = value
-            if "GPSInfo" in meta:
-                gps_info = meta["GPSInfo"]
-                try:
-                    lat = get_decimal_from_dms(gps_info.get(2), gps_info.get(1))
-                    lon = get_decimal_from_dms(gps_info.get(4), gps_info.get(3))
-                    meta["GPS Coordinates"] = f"{lat}, {lon} (Google Maps: https://maps.google.com/?q={lat},{lon})"
-                except Exception as e:
-                    meta["GPS Extraction Error"] = str(e)
-        else:
-            meta["info"] = "Nenhum metadado EXIF encontrado."
+        Image.open(io.BytesIO(bytes(data))).getexif()
+        return 0
+    except Exception:
+        return len(data) * 2
+
+def fetch_image_head(url: str, session: requests.Session = None, max_bytes: int = METADATA_MAX_BYTES,
+                     validators: dict = None, whole: bool = False) -> dict:
+    # Baixa só o início da imagem: pede METADATA_INITIAL_BYTES com Range e amplia conforme
+    # image_metadata_need. Servidor sem suporte a Range (200) tem o corpo lido em streaming até
+    # o necessário e a conexão é fechada. Retorna dados, bytes transferidos e requisições.
+    # Com validators (ETag/Last-Modified de uma leitura anterior) a primeira requisição é
+    # condicional; um 304 volta com not_modified e nenhum byte. Com whole, depois dos
+    # metadados o restante do arquivo (até max_bytes) vem numa única faixa.
+    session = session or get_metadata_session()
+    conditional = {}
+    if validators and validators.get('ETag'):
+        conditional['If-None-Match'] = validators['ETag']
+    if validators and validators.get('Last-Modified'):
+        conditional['If-Modified-Since'] = validators['Last-Modified']
+    data = bytearray()
+    requests_made = 0
+    total_size = None
+    ranged = True
+    not_modified = False
+    response = None
+    body = None
+    headers = {}
+    try:
+        need = METADATA_INITIAL_BYTES
+        while need and len(data) < max_bytes and (total_size is None or len(data) < total_size):
+            target = min(max(need, len(data) * 2), max_bytes)
+            if ranged:
+                request_headers = {'Range': f"bytes={len(data)}-{target - 1}"}
+                if not requests_made:
+                    request_headers.update(conditional)
+                response = session.get(url, headers=request_headers, stream=True, timeout=METADATA_TIMEOUT)
+                requests_made += 1
+                IMAGE_METADATA_REQUESTS.labels(str(response.status_code)).inc()
+                if requests_made == 1:
+                    headers = {key: response.headers.get(key) for key in ('Content-Type', 'ETag', 'Last-Modified')}
+                if response.status_code == 304 and conditional:
+                    not_modified = True
+                    break
+                if response.status_code == 416:
+                    break
+                response.raise_for_status()
+                if response.status_code == 206:
+                    content_range = response.headers.get('Content-Range', '')
+                    if '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+                        total_size = int(content_range.rsplit('/', 1)[1])
+                    for chunk in response.iter_content(METADATA_STREAM_CHUNK):
+                        data += chunk[:target - len(data)]
+                        if len(data) >= target:
+                            break
+                    response.close()
+                    response = None
+                    if len(data) < target:
+                        total_size = len(data)
+                else:
+                    # Range ignorado: o corpo inteiro vem a partir do byte 0
+                    ranged = False
+                    data.clear()
+                    body = response.iter_content(METADATA_STREAM_CHUNK)
+                    if response.headers.get('Content-Length', '').isdigit():
+                        total_size = int(response.headers['Content-Length'])
+            if not ranged:
+                for chunk in body:
+                    data += chunk
+                    if len(data) >= target:
+                        break
+                else:
+                    total_size = len(data)
+            need = image_metadata_need(data)
+            if whole and not need:
+                need = max_bytes
+    finally:
+        if response is not None:
+            response.close()
+    del data[max_bytes:]
+    IMAGE_METADATA_BYTES.inc(len(data))
+    IMAGE_METADATA_FETCH_BYTES.observe(len(data))
+    return {
+        'data': bytes(data),
+        'bytes_transferred': len(data),
+        'requests': requests_made,
+        'ranged': ranged,
+        'total_size': total_size,
+        'complete': (total_size is not None and len(data) >= total_size) if whole else not need,
+        'not_modified': not_modified,
+        'headers': headers
+    }
+
+def exif_to_metadata(exif) -> dict:
+    meta = {}
+    for tag_id, value in exif.items():
+        meta[ExifTags.TAGS.get(tag_id, tag_id)] = value
+    # Sub-IFD EXIF (data original, câmera, exposição) e GPS ficam fora do IFD0
+    for tag_id, value in exif.get_ifd(EXIF_IFD_TAG).items():
+        meta[ExifTags.TAGS.get(tag_id, tag_id)] = value
+    gps_info = exif.get_ifd(GPS_IFD_TAG)
+    if gps_info:
+        meta["GPSInfo"] = {ExifTags.GPSTAGS.get(tag_id, tag_id): value for tag_id, value in gps_info.items()}
+        try:
+            lat = get_decimal_from_dms(gps_info.get(2), gps_info.get(1))
+            lon = get_decimal_from_dms(gps_info.get(4), gps_info.get(3))
+            meta["GPS Coordinates"] = f"{lat}, {lon} (Google Maps: https://maps.google.com/?q={lat},{lon})"
+            meta["GPS Decimal"] = {"latitude": lat, "longitude": lon}
+        except Exception as e:
+            meta["GPS Extraction Error"] = str(e)
+    return meta
+
+def parse_image_metadata(data: bytes) -> dict:
+    # Lê EXIF e XMP direto dos segmentos (JPEG APP1, PNG eXIf/iTXt) do buffer parcial; para
+    # os demais formatos usa o Pillow sobre o mesmo buffer
+    exif_data, xmp, size = None, None, None
+    if data[:2] == b'\xff\xd8':
+        for marker, start, end in _jpeg_segments(data):
+            if marker == 'need' or end > len(data):
+                break
+            segment = data[start:end]
+            if marker == 0xE1 and segment.startswith(b'Exif\x00\x00') and exif_data is None:
+                exif_data = segment
+            elif marker == 0xE1 and segment.startswith(XMP_JPEG_HEADER):
+                xmp = segment[len(XMP_JPEG_HEADER):]
+            elif marker in JPEG_SOF_MARKERS and len(segment) >= 5:
+                size = (int.from_bytes(segment[3:5], 'big'), int.from_bytes(segment[1:3], 'big'))
+    elif data[:8] == b'\x89PNG\r\n\x1a\n':
+        for kind, start, end in _png_chunks(data):
+            if kind == 'need' or end > len(data):
+                break
+            chunk = data[start:end]
+            if kind == b'IHDR' and len(chunk) >= 8:
+                size = (int.from_bytes(chunk[0:4], 'big'), int.from_bytes(chunk[4:8], 'big'))
+            elif kind == b'eXIf':
+                exif_data = chunk
+            elif kind == b'iTXt' and chunk.startswith(b'XML:com.adobe.xmp\x00'):
+                # keyword\0, flag de compressão, método, idioma\0, palavra-chave traduzida\0, texto
+                header = len(b'XML:com.adobe.xmp\x00')
+                if len(chunk) > header + 2 and chunk[header] == 0:
+                    _, _, rest = chunk[header + 2:].partition(b'\x00')
+                    xmp = rest.partition(b'\x00')[2]
+    else:
+        image = Image.open(io.BytesIO(data))
+        exif = image.getexif()
+        meta = exif_to_metadata(exif) if exif else {}
+        meta["Dimensions"] = f"{image.size[0]}x{image.size[1]}"
+        xmp = image.info.get('xmp') or image.info.get('XML:com.adobe.xmp')
+        if xmp:
+            meta["XMP"] = (xmp.decode('utf-8', 'replace') if isinstance(xmp, bytes) else str(xmp))[:METADATA_XMP_MAX_CHARS]
         return meta
+    meta = {}
+    if exif_data:
+        exif = Image.Exif()
+        exif.load(exif_data)
+        meta = exif_to_metadata(exif)
+    if size:
+        meta["Dimensions"] = f"{size[0]}x{size[1]}"
+    if xmp:
+        meta["XMP"] = xmp.decode('utf-8', 'replace')[:METADATA_XMP_MAX_CHARS]
+    return meta
+
+def metadata_value(value):
+    # Valores do Pillow (IFDRational, bytes, tuplas) em tipos JSON; também atravessam o pool de processos
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, bytes):
+        return value.rstrip(b'\x00').decode('utf-8', 'replace')[:METADATA_XMP_MAX_CHARS]
+    if isinstance(value, dict):
+        return {str(key): metadata_value(item) for key, item in value.items()}
+    if isinstance(value, (tuple, list)):
+        return [metadata_value(item) for item in value]
+    try:
+        number = float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return str(value)
+    return number if np.isfinite(number) else str(value)
+
+def image_metadata_from_bytes(data: bytes, complete: bool = False, phash: bool = False) -> dict:
+    # Etapa de parsing (EXIF, XMP, conversão GPS e, com phash, hashes perceptuais), executada no
+    # pool de processos no modo em lote. Os hashes precisam da imagem inteira (complete).
+    meta = {str(key): metadata_value(value) for key, value in parse_image_metadata(data).items()}
+    if not any(key not in ("Dimensions", "XMP") for key in meta):
+        meta["info"] = "Nenhum metadado EXIF encontrado."
+    if phash and complete:
+        try:
+            phash, dhash = image_hashes(Image.open(io.BytesIO(data)))
+            meta["SHA-256"] = hashlib.sha256(data).hexdigest()
+            meta["pHash"] = f"{phash:016x}"
+            meta["dHash"] = f"{dhash:016x}"
+        except Exception as e:
+            meta["Hash perceptual"] = f"Erro ao calcular: {e}"
+    elif phash:
+        meta["Hash perceptual"] = f"Não calculado: imagem incompleta ou maior que {PHASH_MAX_BYTES} bytes"
+    return meta
+
+def fetch_image_for_metadata(url: str, session: requests.Session = None, phash: bool = False) -> dict:
+    # Leitura com cache: se a URL já foi analisada com ETag/Last-Modified, a requisição é
+    # condicional e um 304 reaproveita os metadados guardados em 'cached'. Só com phash a
+    # imagem inteira é baixada (até PHASH_MAX_BYTES); sem ele, apenas o cabeçalho.
+    cached = image_metadata_cache.get(url)
+    if cached and phash and "pHash" not in cached['metadata']:
+        cached = None
+    fetched = fetch_image_head(url, session, max_bytes=PHASH_MAX_BYTES if phash else METADATA_MAX_BYTES,
+                               validators=cached['validators'] if cached else None, whole=phash)
+    fetched['cached'] = cached['metadata'] if cached and fetched['not_modified'] else None
+    return fetched
+
+def store_image_metadata(url: str, fetched: dict, meta: dict) -> None:
+    # Sem ETag nem Last-Modified não há como revalidar; nesse caso nada é guardado
+    validators = {key: fetched['headers'].get(key) for key in ('ETag', 'Last-Modified') if fetched['headers'].get(key)}
+    if validators and fetched['cached'] is None:
+        image_metadata_cache.set(url, {'validators': validators, 'metadata': meta})
+
+def image_metadata_report(meta: dict, fetched: dict) -> dict:
+    report = dict(meta)
+    report["Bytes transferidos"] = fetched['bytes_transferred']
+    report["Requisições HTTP"] = fetched['requests']
+    if fetched['total_size']:
+        report["Tamanho do arquivo"] = fetched['total_size']
+    if fetched['cached'] is not None:
+        report["Cache"] = "revalidado (304)"
+    return report
+
+def analyze_image_metadata(url: str, case: str = PHASH_DEFAULT_CASE, phash: bool = False) -> dict:
+    try:
+        fetched = fetch_image_for_metadata(url, phash=phash)
+        meta = fetched['cached']
+        if meta is None:
+            meta = image_metadata_from_bytes(fetched['data'], fetched['complete'], phash)
+            store_image_metadata(url, fetched, meta)
+        if phash:
+            index_image_hashes(url, case, meta)
+        logger.info(f"🖼️ Metadados de {url}: {fetched['bytes_transferred']} bytes em {fetched['requests']} requisições "
+                    f"({'cache' if fetched['cached'] is not None else 'Range' if fetched['ranged'] else 'streaming'})")
+        return image_metadata_report(meta, fetched)
     except Exception as e:
         logger.error(f"❌ Erro ao analisar metadados da imagem: {e}")
         return {"error": str(e)}
-# --- Fim do sistema de metadados ---
 
-# ===== Funcionalidades de Investigação Online =====
-def perform_search(query: str, search_type: str, max_results: int) -> list:
+# ----- Metadados em lote -----
+def get_metadata_fetch_pool() -> concurrent.futures.ThreadPoolExecutor:
+    # Threads de rede compartilhadas entre as requisições; o parsing vai para o pool de processos
+    global _metadata_fetch_pool
+    with _metadata_fetch_pool_lock:
+        if _metadata_fetch_pool is None:
+            _metadata_fetch_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=METADATA_BULK_FETCH_WORKERS, thread_name_prefix='metadata-fetch')
+        return _metadata_fetch_pool
+
+def metadata_host(url: str) -> str:
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError("URL inválida (esperado http ou https)")
+    return f"{parsed.scheme}://{parsed.hostname}:{parsed.port or ''}"
+
+def stream_image_metadata(urls: list, case: str = PHASH_DEFAULT_CASE, phash: bool = False):
+    # Busca concorrente com no máximo METADATA_POOL_MAXSIZE conexões por host; cada imagem
+    # baixada vai para o pool de processos (EXIF, XMP, GPS) e sai em NDJSON assim que fica
+    # pronta, fora da ordem de entrada (o campo index aponta a posição original). Termina com
+    # uma linha de resumo.
+    started = time.perf_counter()
+    session = get_metadata_session()
+    fetch_pool = get_metadata_fetch_pool()
+    parse_pool = get_analysis_pool()
+    waiting = collections.OrderedDict()  # host -> deque de (índice, url)
+    active_hosts = collections.Counter()
+    running = {}  # future -> (etapa, índice, url, host, fetched)
+    summary = {'type': 'summary', 'urls': len(urls), 'ok': 0, 'errors': 0, 'cache_hits': 0, 'bytes_transferred': 0}
+
+    def finish(index: int, url: str, record: dict) -> str:
+        record = {'index': index, 'url': url, **record}
+        if 'error' in record:
+            summary['errors'] += 1
+            IMAGE_METADATA_BULK.labels('error').inc()
+        else:
+            summary['ok'] += 1
+            summary['bytes_transferred'] += record['bytes_transferred']
+            summary['cache_hits'] += record['cache'] == 'hit'
+            IMAGE_METADATA_BULK.labels('cached' if record['cache'] == 'hit' else 'ok').inc()
+        return json.dumps(record, ensure_ascii=False, default=str) + "\n"
+
+    def result_record(meta: dict, fetched: dict, cache: str) -> dict:
+        return {'metadata': meta, 'gps': meta.get("GPS Decimal"), 'phash': meta.get("pHash"), 'dhash': meta.get("dHash"),
+                'bytes_transferred': fetched['bytes_transferred'],
+                'requests': fetched['requests'], 'size': fetched['total_size'], 'ranged': fetched['ranged'],
+                'cache': cache}
+
+    def dispatch() -> None:
+        # Downloads e parsings pendentes contam juntos: um buffer só é liberado quando o parsing
+        # termina, então a memória depende de METADATA_BULK_INFLIGHT e não do tamanho da lista
+        fetching = sum(1 for stage, *_ in running.values() if stage == 'fetch')
+        inflight = len(running)
+        for host in list(waiting):
+            queue_ = waiting[host]
+            while (queue_ and active_hosts[host] < METADATA_POOL_MAXSIZE and fetching < METADATA_BULK_FETCH_WORKERS
+                   and inflight < METADATA_BULK_INFLIGHT):
+                index, url = queue_.popleft()
+                running[fetch_pool.submit(fetch_image_for_metadata, url, session, phash)] = ('fetch', index, url, host, None)
+                active_hosts[host] += 1
+                fetching += 1
+                inflight += 1
+            if not queue_:
+                del waiting[host]
+
     try:
-        # Utiliza o gerenciador de contexto para garantir que a sessão seja finalizada corretamente
-        with DDGS() as ddgs:
-            if search_type == 'web':
-                results = list(ddgs.text(keywords=query, max_results=max_results))
-            elif search_type == 'news':
-                results = list(ddgs.news(keywords=query, max_results=max_results))
-            elif search_type == 'leaked':
-                results = list(ddgs.text(keywords=f"{query} leaked", max_results=max_results))
-            else:
-                results = []
-        # Pequeno delay para evitar possíveis rate limits
-        time.sleep(1)
-        return results
-    except Exception as e:
-        logger.error(f"Erro na busca ({search_type}): {e}")
-        return []
+        for index, url in enumerate(urls):
+            try:
+                waiting.setdefault(metadata_host(url), collections.deque()).append((index, url))
+            except ValueError as e:
+                yield finish(index, url, {'error': str(e)})
+        dispatch()
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage, index, url, host, fetched = running.pop(future)
+                if stage == 'fetch':
+                    active_hosts[host] -= 1
+                    try:
+                        fetched = future.result()
+                    except Exception as e:
+                        yield finish(index, url, {'error': str(e)})
+                        continue
+                    if fetched['cached'] is not None:
+                        if phash:
+                            index_image_hashes(url, case, fetched['cached'])
+                        yield finish(index, url, result_record(fetched['cached'], fetched, 'hit'))
+                        continue
+                    data = fetched.pop('data')
+                    running[parse_pool.submit(image_metadata_from_bytes, data, fetched['complete'], phash)] = (
+                        'parse', index, url, host, fetched)
+                else:
+                    try:
+                        meta = future.result()
+                    except Exception as e:
+                        yield finish(index, url, {'error': f"Erro ao analisar metadados: {e}"})
+                        continue
+                    store_image_metadata(url, fetched, meta)
+                    if phash:
+                        index_image_hashes(url, case, meta)
+                    yield finish(index, url, result_record(meta, fetched, 'miss'))
+            dispatch()
+    finally:
+        for future in running:
+            future.cancel()
+    summary['elapsed'] = round(time.perf_counter() - started, 3)
+    IMAGE_METADATA_BULK_SECONDS.observe(summary['elapsed'])
+    logger.info(f"🖼️ Metadados em lote: {summary['ok']} imagens, {summary['errors']} erros, "
+                f"{summary['cache_hits']} do cache em {summary['elapsed']:.2f}s")
+    yield json.dumps(summary, ensure_ascii=False) + "\n"
 
-def format_search_results(results: list, section_title: str) -> tuple:
-    count = len(results)
-    info_message = f"Apenas {count} resultados encontrados para '{section_title}'.<br>" if count < 1 else ""
-    formatted_text = "<br>".join(
-        f"• {res.get('title', 'Sem título')}<br>&nbsp;&nbsp;{res.get('href', 'Sem link')}<br>&nbsp;&nbsp;{res.get('body', '')}"
-        for res in results
-    )
+@app.route('/image_metadata/bulk', methods=['POST'])
+def image_metadata_bulk():
+    # URLs em JSON ({"urls": [...], "case": ..., "phash": true} ou lista) ou em texto, uma por
+    # linha. Com phash (também em ?phash=true) cada imagem é baixada inteira, recebe hashes
+    # perceptuais e entra no índice sob o caso (?case=)
+    payload = request.get_json(silent=True)
+    options = payload if isinstance(payload, dict) else {}
+    case = request.args.get('case') or options.get('case') or PHASH_DEFAULT_CASE
+    phash = _as_bool(request.args.get('phash', options.get('phash')))
+    if payload is None:
+        urls = [line.strip() for line in request.get_data(as_text=True).splitlines() if line.strip()]
+    else:
+        urls = payload.get('urls') if isinstance(payload, dict) else payload
+    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+        return jsonify({'error': 'Lista de URLs não fornecida'}), 400
+    if len(urls) > METADATA_BULK_MAX_URLS:
+        return jsonify({'error': f'Máximo de {METADATA_BULK_MAX_URLS} URLs por requisição'}), 400
+    return streamed_text_response(stream_image_metadata([url.strip() for url in urls], str(case), phash),
+                                  mimetype='application/x-ndjson')
+# ----- Índice de hashes perceptuais -----
+# Base DCT-II para o pHash: coeficientes = D · pixels · Dᵀ
+PHASH_DCT = np.cos(np.pi * np.outer(np.arange(PHASH_SIZE), 2 * np.arange(PHASH_SIZE) + 1) / (2 * PHASH_SIZE))
+
+if hasattr(np, 'bitwise_count'):
+    def popcount64(values: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(values)
+else:
+    # NumPy < 2.0: contagem por byte com tabela
+    _POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount64(values: np.ndarray) -> np.ndarray:
+        return _POPCOUNT8[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+def image_hashes(image) -> tuple:
+    # pHash (sinal dos 8x8 coeficientes DCT de menor frequência em relação à mediana) e dHash
+    # (gradiente horizontal 9x8), ambos com 64 bits. Em JPEG, draft decodifica já reduzido.
+    image.draft('L', (PHASH_SIZE * 2, PHASH_SIZE * 2))
+    gray = image.convert('L')
+    pixels = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.LANCZOS), dtype=np.float64)
+    coeffs = (PHASH_DCT @ pixels @ PHASH_DCT.T)[:PHASH_LOW_FREQ, :PHASH_LOW_FREQ].ravel()
+    # O termo DC (brilho médio) fica fora da mediana
+    phash = _bits_to_int(coeffs > np.median(coeffs[1:]))
+    small = np.asarray(gray.resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+    dhash = _bits_to_int(small[:, 1:] > small[:, :-1])
+    return phash, dhash
+
+class ImageHashIndex:
+    # Hashes de todas as imagens analisadas, de todos os casos. Os detalhes (URL, caso, SHA-256)
+    # ficam em SQLite; a busca roda sobre arrays uint64 em memória, espelhados num arquivo
+    # binário só de acréscimo (id, pHash, dHash em 24 bytes por imagem) lido de uma vez na abertura.
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.db_path = os.path.join(directory, "images.sqlite3")
+        self.array_path = os.path.join(directory, "hashes.u64")
+        self._conn = None
+        self._lock = threading.Lock()
+        self._ids = np.empty(0, dtype=np.int64)
+        self._phash = np.empty(0, dtype=np.uint64)
+        self._dhash = np.empty(0, dtype=np.uint64)
+        self._size = 0
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS image_hashes (
+                id INTEGER PRIMARY KEY, url TEXT NOT NULL, case_id TEXT NOT NULL, sha256 TEXT NOT NULL,
+                phash TEXT NOT NULL, dhash TEXT NOT NULL, dimensions TEXT, added_at REAL NOT NULL,
+                UNIQUE (case_id, url, sha256))""")
+            self._conn = conn
+            self._load()
+        return self._conn
+
+    def _load(self) -> None:
+        records = np.empty((0, 3), dtype=np.uint64)
+        if os.path.exists(self.array_path):
+            raw = np.fromfile(self.array_path, dtype='<u8')
+            records = raw[:len(raw) - len(raw) % 3].reshape(-1, 3).astype(np.uint64)
+            # Descarta um registro final incompleto antes de novos acréscimos
+            os.truncate(self.array_path, len(records) * 24)
+        last_id = int(records[-1, 0]) if len(records) else 0
+        self._append(records)
+        # Linhas gravadas no SQLite mas não no arquivo (queda entre as duas escritas)
+        missing = self._conn.execute("SELECT id, phash, dhash FROM image_hashes WHERE id > ? ORDER BY id",
+                                     (last_id,)).fetchall()
+        if missing:
+            self._persist(np.array([(row_id, int(p, 16), int(d, 16)) for row_id, p, d in missing], dtype=np.uint64))
+        IMAGE_HASH_INDEX_SIZE.set(self._size)
+        logger.info(f"🧬 Índice de hashes perceptuais: {self._size} imagens")
+
+    def _append(self, records: np.ndarray) -> None:
+        # Capacidade dobra quando enche; quem já fez a busca segue com a visão antiga
+        needed = self._size + len(records)
+        if needed > len(self._ids):
+            capacity = max(needed, 2 * len(self._ids), 1024)
+            for name in ('_ids', '_phash', '_dhash'):
+                old = getattr(self, name)
+                grown = np.empty(capacity, dtype=old.dtype)
+                grown[:self._size] = old[:self._size]
+                setattr(self, name, grown)
+        self._ids[self._size:needed] = records[:, 0].astype(np.int64)
+        self._phash[self._size:needed] = records[:, 1]
+        self._dhash[self._size:needed] = records[:, 2]
+        self._size = needed
+
+    def _persist(self, records: np.ndarray) -> None:
+        with open(self.array_path, 'ab') as f:
+            f.write(records.astype('<u8').tobytes())
+        self._append(records)
+
+    def add_many(self, entries: list) -> int:
+        # entries: (url, caso, sha256, phash, dhash, dimensões); repetidos no mesmo caso são ignorados
+        added = []
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                for url, case, sha256, phash, dhash, dimensions in entries:
+                    cursor = conn.execute(
+                        "INSERT OR IGNORE INTO image_hashes (url, case_id, sha256, phash, dhash, dimensions, added_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)", (url, case, sha256, f"{phash:016x}", f"{dhash:016x}", dimensions, now))
+                    if cursor.rowcount:
+                        added.append((cursor.lastrowid, phash, dhash))
+            if added:
+                self._persist(np.array(added, dtype=np.uint64))
+            IMAGE_HASH_INDEX_SIZE.set(self._size)
+        return len(added)
+
+    def add(self, url: str, case: str, sha256: str, phash: int, dhash: int, dimensions: str = None) -> bool:
+        return self.add_many([(url, case, sha256, phash, dhash, dimensions)]) > 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._connection()
+            return self._size
+
+    def search(self, phash: int, dhash: int = None, max_distance: int = PHASH_DEFAULT_DISTANCE,
+               limit: int = PHASH_MAX_RESULTS) -> dict:
+        # Distância de Hamming do pHash contra todo o índice (XOR + popcount vetorizados); o dHash
+        # desempata e é informado. Devolve as 'limit' imagens mais próximas dentro de max_distance.
+        started = time.perf_counter()
+        with self._lock:
+            self._connection()
+            size = self._size
+            ids, phashes, dhashes = self._ids[:size], self._phash[:size], self._dhash[:size]
+        distances = popcount64(phashes ^ np.uint64(phash))
+        candidates = np.flatnonzero(distances <= max_distance)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(distances[candidates], limit - 1)[:limit]]
+        d_distances = popcount64(dhashes[candidates] ^ np.uint64(dhash)) if dhash is not None else None
+        order = np.lexsort((d_distances if d_distances is not None else candidates, distances[candidates]))
+        elapsed = time.perf_counter() - started
+        IMAGE_HASH_SEARCH_SECONDS.observe(elapsed)
+        matches = []
+        if len(candidates):
+            selected = candidates[order]
+            with self._lock:
+                rows = {row[0]: row for row in self._connection().execute(
+                    f"SELECT id, url, case_id, sha256, phash, dhash, dimensions, added_at FROM image_hashes "
+                    f"WHERE id IN ({','.join('?' * len(selected))})", [int(ids[i]) for i in selected])}
+            for position, i in zip(order, selected):
+                row = rows.get(int(ids[i]))
+                if row is None:
+                    continue
+                matches.append({
+                    'url': row[1], 'case': row[2], 'sha256': row[3], 'phash': row[4], 'dhash': row[5],
+                    'dimensions': row[6], 'added_at': row[7],
+                    'phash_distance': int(distances[i]),
+                    'dhash_distance': int(d_distances[position]) if d_distances is not None else None
+                })
+        return {'matches': matches, 'searched': size, 'search_ms': round(elapsed * 1000, 3)}
+
+image_hash_index = ImageHashIndex(PHASH_INDEX_DIR)
+
+def index_image_hashes(url: str, case: str, meta: dict) -> None:
+    if "pHash" not in meta:
+        return
+    try:
+        image_hash_index.add(url, case, meta["SHA-256"], int(meta["pHash"], 16), int(meta["dHash"], 16),
+                             meta.get("Dimensions"))
+    except Exception as e:
+        logger.error(f"❌ Erro ao indexar hash perceptual de {url}: {e}")
+
+def _parse_hash(value) -> int:
+    if value is None or value == "":
+        return None
+    number = int(str(value), 16)
+    if not 0 <= number < 2 ** 64:
+        raise ValueError("Hash fora de 64 bits")
+    return number
+
+@app.route('/image_metadata/similar', methods=['POST'])
+def image_metadata_similar():
+    # Imagens quase idênticas em todos os casos já analisados. A consulta pode ser uma imagem
+    # enviada ('image_file'), uma URL ou hashes prontos ({"phash": "...", "dhash": "..."});
+    # max_distance, limit e case vêm no JSON, no formulário ou na query string. Uma URL
+    # consultada entra no índice (sob case) depois da busca.
+    payload = request.get_json(silent=True) or {}
+    params = {**request.form.to_dict(), **payload, **request.args.to_dict()}
+    try:
+        max_distance = min(max(int(params.get('max_distance', PHASH_DEFAULT_DISTANCE)), 0), 64)
+        limit = min(max(int(params.get('limit', PHASH_MAX_RESULTS)), 1), PHASH_MAX_RESULTS_LIMIT)
+        upload = request.files.get('image_file')
+        if upload is not None:
+            data = upload.read(PHASH_MAX_BYTES + 1)
+            if len(data) > PHASH_MAX_BYTES:
+                return jsonify({'error': f'Imagem maior que {PHASH_MAX_BYTES} bytes'}), 400
+            phash, dhash = image_hashes(Image.open(io.BytesIO(data)))
+            query = {'sha256': hashlib.sha256(data).hexdigest()}
+        elif params.get('url'):
+            fetched = fetch_image_for_metadata(params['url'], phash=True)
+            meta = fetched['cached']
+            if meta is None:
+                meta = image_metadata_from_bytes(fetched['data'], fetched['complete'], phash=True)
+                store_image_metadata(params['url'], fetched, meta)
+            if "pHash" not in meta:
+                return jsonify({'error': meta.get("Hash perceptual", "Hash perceptual indisponível")}), 400
+            phash, dhash = int(meta["pHash"], 16), int(meta["dHash"], 16)
+            query = {'url': params['url'], 'sha256': meta["SHA-256"]}
+        elif params.get('phash'):
+            phash, dhash = _parse_hash(params['phash']), _parse_hash(params.get('dhash'))
+            query = {}
+        else:
+            return jsonify({'error': 'Envie image_file, url ou phash'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"❌ Erro ao calcular o hash da consulta: {e}")
+        return jsonify({'error': str(e)}), 500
+    query.update({'phash': f"{phash:016x}", 'dhash': f"{dhash:016x}" if dhash is not None else None})
+    result = image_hash_index.search(phash, dhash, max_distance, limit)
+    if 'url' in query:
+        index_image_hashes(query['url'], str(params.get('case') or PHASH_DEFAULT_CASE), meta)
+    logger.info(f"🧬 Busca por hash perceptual: {len(result['matches'])} semelhantes entre {result['searched']} "
+                f"imagens em {result['search_ms']:.2f} ms")
+    return jsonify({'query': query, 'max_distance': max_distance, **result})
+
+# --- Fim do sistema de metadados ---
+
+# ===== Cache Persistente de Buscas (SQLite) =====
+SEARCH_CACHE_PATH = os.environ.get("SEARCH_CACHE_PATH", os.path.join(CACHE_DIR, "search_cache.sqlite3"))
+SEARCH_CACHE_TTL = 6 * 3600
+SEARCH_CACHE_NEGATIVE_TTL = 15 * 60  # buscas sem resultado expiram mais cedo
+SEARCH_CACHE_STALE_TTL = 24 * 3600  # após vencer, o resultado ainda é servido enquanto é atualizado
+SEARCH_CACHE_MAX_ENTRIES = 10000
+SEARCH_CACHE_PRUNE_EVERY = 200  # gravações entre limpezas do arquivo
+SEARCH_RATE_PER_SECOND = 1.0
+SEARCH_RATE_BURST = 3
+
+SEARCH_CACHE_LOOKUPS = Counter('search_cache_lookups_total', 'Consultas ao cache persistente de buscas', ['result'])
+SEARCH_CACHE_REVALIDATIONS = Counter('search_cache_revalidations_total', 'Atualizações em segundo plano de buscas vencidas', ['result'])
+SEARCH_RATE_LIMIT_WAIT = Histogram('search_rate_limit_wait_seconds', 'Espera imposta pelo limitador de taxa de buscas',
+                                   buckets=(0, 0.1, 0.25, 0.5, 1, 2, 5, 10))
+
+class TokenBucket:
+    # Limitador de taxa: permite rajadas de até `capacity` chamadas e repõe `rate` fichas por
+    # segundo. try_acquire nunca espera; a espera (acquire ou wait_time) fica com quem chama,
+    # para que nenhuma thread de pool durma segurando uma vaga. clock é injetável nos testes.
+    def __init__(self, rate: float, capacity: int, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = float(capacity)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def wait_time(self) -> float:
+        # Segundos até haver uma ficha (0 se já houver)
+        with self._lock:
+            self._refill()
+            return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def available_within(self, seconds: float) -> int:
+        # Fichas que o balde consegue entregar nos próximos `seconds`, sem contar outros consumidores
+        with self._lock:
+            self._refill()
+            return int(self._tokens + self.rate * seconds)
+
+    def acquire(self) -> float:
+        # Versão bloqueante, para chamadas feitas na própria thread da requisição
+        waited = 0.0
+        while not self.try_acquire():
+            wait = self.wait_time()
+            time.sleep(wait)
+            waited += wait
+        SEARCH_RATE_LIMIT_WAIT.observe(waited)
+        return waited
+
+class SearchResultCache:
+    # Resultados de busca em SQLite, chaveados por (backend, consulta normalizada, tipo, max_results).
+    # get devolve (resultados, estado), com estado 'fresh', 'stale' ou None (falta).
+    def __init__(self, path: str, ttl: int, negative_ttl: int, stale_ttl: int, max_entries: int, clock=time.time):
+        self.path = path
+        self._clock = clock
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _connection(self):
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS search_cache (
+                backend TEXT NOT NULL, query TEXT NOT NULL, search_type TEXT NOT NULL, max_results INTEGER NOT NULL,
+                results TEXT NOT NULL, fetched_at REAL NOT NULL, expires_at REAL NOT NULL,
+                PRIMARY KEY (backend, query, search_type, max_results))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS search_cache_expires ON search_cache (expires_at)")
+            self._conn = conn
+        return self._conn
+
+    def get(self, backend: str, query: str, search_type: str, max_results: int) -> tuple:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT results, expires_at FROM search_cache "
+                "WHERE backend = ? AND query = ? AND search_type = ? AND max_results = ?",
+                (backend, query, search_type, max_results)).fetchone()
+        if row is None:
+            return None, None
+        results, expires_at = json.loads(row[0]), row[1]
+        now = self._clock()
+        if now < expires_at:
+            return results, 'fresh'
+        # Buscas vazias não são servidas vencidas: a próxima consulta tenta de novo
+        if results and now < expires_at + self.stale_ttl:
+            return results, 'stale'
+        return None, None
+
+    def set(self, backend: str, query: str, search_type: str, max_results: int, results: list) -> None:
+        now = self._clock()
+        ttl = self.ttl if results else self.negative_ttl
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (backend, query, search_type, max_results, json.dumps(results, ensure_ascii=False),
+                              now, now + ttl))
+            self._writes += 1
+            if self._writes % SEARCH_CACHE_PRUNE_EVERY == 0:
+                self._prune(conn, now)
+
+    def _prune(self, conn, now: float) -> None:
+        with conn:
+            expired = conn.execute("DELETE FROM search_cache WHERE expires_at < ?", (now - self.stale_ttl,)).rowcount
+            excess = conn.execute(
+                "DELETE FROM search_cache WHERE rowid IN (SELECT rowid FROM search_cache ORDER BY fetched_at DESC "
+                "LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+        if expired:
+            CACHE_EVICTIONS.labels('search', 'expired').inc(expired)
+        if excess:
+            CACHE_EVICTIONS.labels('search', 'capacity').inc(excess)
+
+    def clear(self) -> None:
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("DELETE FROM search_cache")
+
+search_cache = SearchResultCache(SEARCH_CACHE_PATH, SEARCH_CACHE_TTL, SEARCH_CACHE_NEGATIVE_TTL,
+                                 SEARCH_CACHE_STALE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+search_rate_limiter = TokenBucket(SEARCH_RATE_PER_SECOND, SEARCH_RATE_BURST)
+search_revalidations = set()
+search_revalidations_lock = threading.Lock()
+
+# ===== Backends de Busca Plugáveis e Fan-out com Prazos =====
+SEARCH_BACKEND = "duckduckgo"
+SEARCH_FANOUT_WORKERS = 8
+SEARCH_REVALIDATION_WORKERS = 2  # atualizações de buscas vencidas não disputam o pool das investigações
+SEARCH_SOURCE_TIMEOUTS = {'web': 8.0, 'news': 8.0, 'leaked': 10.0}
+SEARCH_DEFAULT_SOURCE_TIMEOUT = 8.0
+SEARCH_GLOBAL_DEADLINE = 15.0  # a etapa de busca inteira nunca passa disso
+SEARCH_MAX_VARIANTS = 6
+
+SEARCH_SOURCE_RESULTS = Counter('search_source_results_total', 'Buscas por fonte na etapa de investigação', ['source', 'result'])
+SEARCH_FANOUT_SECONDS = Histogram('search_fanout_seconds', 'Duração da etapa de buscas da investigação')
+
+class SearchBackend:
+    # Interface dos backends de busca: search(consulta, tipo, max_results) -> lista de dicts com
+    # 'title', 'href' e 'body'. Exceções indicam falha da fonte (não são cacheadas).
+    name = "base"
+    rate_limited = False
+
+    def search(self, query: str, search_type: str, max_results: int) -> list:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+class DuckDuckGoBackend(SearchBackend):
+    # Uma sessão DDGS por thread do pool de buscas, reaproveitada entre requisições
+    name = "duckduckgo"
+    rate_limited = True
+
+    def __init__(self, timeout: float = SEARCH_DEFAULT_SOURCE_TIMEOUT):
+        self.timeout = timeout
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def _session(self):
+        ddgs = getattr(self._local, 'ddgs', None)
+        if ddgs is None:
+            ddgs = lazy_import('duckduckgo_search').DDGS(timeout=int(self.timeout))
+            self._local.ddgs = ddgs
+            with self._lock:
+                self._sessions.append(ddgs)
+        return ddgs
+
+    def _discard_session(self) -> None:
+        ddgs = getattr(self._local, 'ddgs', None)
+        self._local.ddgs = None
+        if ddgs is not None:
+            with self._lock:
+                if ddgs in self._sessions:
+                    self._sessions.remove(ddgs)
+            try:
+                ddgs.__exit__(None, None, None)
+            except Exception:
+                pass
+
+    def search(self, query: str, search_type: str, max_results: int) -> list:
+        ddgs = self._session()
+        try:
+            if search_type == 'web':
+                return list(ddgs.text(keywords=query, max_results=max_results))
+            if search_type == 'news':
+                return list(ddgs.news(keywords=query, max_results=max_results))
+            if search_type == 'leaked':
+                return list(ddgs.text(keywords=f"{query} leaked", max_results=max_results))
+            return []
+        except Exception:
+            # Sessão possivelmente quebrada: a próxima busca desta thread abre outra
+            self._discard_session()
+            raise
+
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for ddgs in sessions:
+            try:
+                ddgs.__exit__(None, None, None)
+            except Exception:
+                pass
+
+class StaticSearchBackend(SearchBackend):
+    # Backend local para testes e benchmarks sem rede: devolve os resultados registrados em
+    # `results` ({(tipo, consulta): [...]}) ou resultados sintéticos determinísticos. `delays`
+    # ({tipo: segundos}) simula fontes lentas e `failures` (conjunto de tipos) fontes com erro.
+    name = "static"
+
+    def __init__(self, results: dict = None, delays: dict = None, failures: set = None, latency: float = 0.0):
+        self.results = results or {}
+        self.delays = delays or {}
+        self.failures = failures or set()
+        self.latency = latency
+        self.calls = 0
+
+    def search(self, query: str, search_type: str, max_results: int) -> list:
+        self.calls += 1
+        delay = self.delays.get(search_type, self.latency)
+        if delay:
+            time.sleep(delay)
+        if search_type in self.failures:
+            raise RuntimeError(f"falha simulada na fonte '{search_type}'")
+        if (search_type, query) in self.results:
+            return list(self.results[(search_type, query)])[:max_results]
+        slug = re.sub(r'\W+', '-', normalize_query(query)).strip('-') or 'alvo'
+        return [{'title': f"{query} ({search_type} {i})",
+                 'href': f"https://{search_type}.example.com/{slug}/{i}",
+                 'body': f"Resultado {i} para {query}."} for i in range(1, max_results + 1)]
+
+SEARCH_BACKENDS = {
+    "duckduckgo": DuckDuckGoBackend,
+    "static": StaticSearchBackend,
+}
+
+_search_backend = None
+_search_executor = None
+_revalidation_executor = None
+_search_lock = threading.Lock()
+
+def get_search_backend() -> SearchBackend:
+    global _search_backend
+    with _search_lock:
+        if _search_backend is None:
+            _search_backend = SEARCH_BACKENDS[SEARCH_BACKEND]()
+        return _search_backend
+
+def set_search_backend(backend: SearchBackend) -> SearchBackend:
+    # Troca o backend em tempo de execução (ex.: StaticSearchBackend em testes); devolve o anterior
+    global _search_backend
+    with _search_lock:
+        previous, _search_backend = _search_backend, backend
+    return previous
+
+def get_search_executor() -> concurrent.futures.ThreadPoolExecutor:
+    # Pool de longa duração: as threads (e suas sessões de busca) são reaproveitadas entre requisições
+    global _search_executor
+    with _search_lock:
+        if _search_executor is None:
+            _search_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=SEARCH_FANOUT_WORKERS, thread_name_prefix="search")
+        return _search_executor
+
+def get_revalidation_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _revalidation_executor
+    with _search_lock:
+        if _revalidation_executor is None:
+            _revalidation_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=SEARCH_REVALIDATION_WORKERS, thread_name_prefix="search-revalidate")
+        return _revalidation_executor
+
+def fetch_search_results(query: str, search_type: str, max_results: int, backend: SearchBackend = None,
+                         acquire: bool = True) -> list:
+    # Consulta o backend (respeitando o limitador de taxa se ele acessar a rede); exceções sobem.
+    # acquire=False quando quem chamou já obteve a ficha antes de enviar a busca ao pool.
+    backend = backend or get_search_backend()
+    if backend.rate_limited and acquire:
+        search_rate_limiter.acquire()
+    return backend.search(query, search_type, max_results)
+
+def _revalidate_search(query: str, search_type: str, max_results: int, key: tuple, backend: SearchBackend) -> None:
+    try:
+        search_cache.set(*key, fetch_search_results(query, search_type, max_results, backend, acquire=False))
+        SEARCH_CACHE_REVALIDATIONS.labels('ok').inc()
+    except Exception as e:
+        SEARCH_CACHE_REVALIDATIONS.labels('error').inc()
+        logger.warning(f"Falha ao atualizar busca em cache ({search_type}): {e}")
+    finally:
+        with search_revalidations_lock:
+            search_revalidations.discard(key)
+
+def lookup_cached_search(query: str, search_type: str, max_results: int, backend: SearchBackend) -> tuple:
+    # (resultados, chave); resultados None indica falta. Um resultado vencido é servido e, se o
+    # limitador tiver ficha livre, atualizado em segundo plano (uma atualização por chave);
+    # sem ficha, fica para a próxima consulta.
+    key = (backend.name, normalize_query(query), search_type, max_results)
+    try:
+        cached, state = search_cache.get(*key)
+    except Exception as e:
+        logger.warning(f"Cache de buscas indisponível: {e}")
+        cached, state = None, None
+    if state == 'fresh':
+        SEARCH_CACHE_LOOKUPS.labels('hit' if cached else 'negative_hit').inc()
+        return cached, key
+    if state == 'stale':
+        SEARCH_CACHE_LOOKUPS.labels('stale').inc()
+        with search_revalidations_lock:
+            refresh = key not in search_revalidations
+            if refresh and (not backend.rate_limited or search_rate_limiter.try_acquire()):
+                search_revalidations.add(key)
+            else:
+                refresh = False
+        if refresh:
+            get_revalidation_executor().submit(_revalidate_search, query, search_type, max_results, key, backend)
+        return cached, key
+    SEARCH_CACHE_LOOKUPS.labels('miss').inc()
+    return None, key
+
+def store_search_results(key: tuple, results: list) -> None:
+    try:
+        search_cache.set(*key, results)
+    except Exception as e:
+        logger.warning(f"Não foi possível gravar a busca no cache: {e}")
+
+def _search_and_store(query: str, search_type: str, max_results: int, key: tuple, backend: SearchBackend) -> list:
+    # Executada no pool de buscas, com a ficha do limitador já obtida
+    results = fetch_search_results(query, search_type, max_results, backend, acquire=False)
+    store_search_results(key, results)
+    return results
+
+def cached_search(query: str, search_type: str, max_results: int) -> list:
+    # Busca com cache persistente; diferente de perform_search, erros da fonte sobem
+    backend = get_search_backend()
+    cached, key = lookup_cached_search(query, search_type, max_results, backend)
+    if cached is not None:
+        return cached
+    results = fetch_search_results(query, search_type, max_results, backend)
+    store_search_results(key, results)
+    return results
+
+def investigation_query_variants(target: str, investigation_focus: str = "", aliases: list = None) -> list:
+    # Alvo, apelidos informados e alvo + foco, sem repetições e limitados a SEARCH_MAX_VARIANTS
+    variants = [target] + list(aliases or [])
+    if investigation_focus and investigation_focus.strip():
+        variants.append(f"{target} {investigation_focus.strip()}")
+    unique = {}
+    for variant in variants:
+        if variant and variant.strip():
+            unique.setdefault(normalize_query(variant), variant.strip())
+    return list(unique.values())[:SEARCH_MAX_VARIANTS]
+
+def iter_searches(queries: list, search_types: list, max_results: int,
+                  deadline: float = SEARCH_GLOBAL_DEADLINE, source_timeouts: dict = None):
+    # Produz (tipo, consulta, status, resultados) na ordem em que terminam. O cache é consultado
+    # aqui; só as faltas vão ao pool de buscas, a primeira variação de cada tipo antes das demais.
+    # Com backend limitado por taxa, a ficha é obtida antes do envio (a espera acontece neste
+    # gerador, nunca numa thread do pool), e as buscas que o limitador não consegue atender
+    # dentro do prazo saem como 'rate_limited'. Cada fonte tem o seu prazo, nunca além do
+    # global; as que estouram saem como 'timeout' e a busca continua em segundo plano,
+    # alimentando o cache.
+    source_timeouts = source_timeouts or SEARCH_SOURCE_TIMEOUTS
+    started = time.monotonic()
+    backend = get_search_backend()
+    executor = get_search_executor()
+    limits = {search_type: started + min(source_timeouts.get(search_type, SEARCH_DEFAULT_SOURCE_TIMEOUT), deadline)
+              for search_type in search_types}
+    waiting = collections.deque()
+    pending = {}
+
+    def rate_limited(search_type: str, query: str) -> tuple:
+        logger.warning(f"🚦 Busca '{search_type}' para {query!r} não coube no limite de taxa; seguindo sem ela.")
+        SEARCH_SOURCE_RESULTS.labels(search_type, 'rate_limited').inc()
+        return search_type, query, 'rate_limited', []
+
+    try:
+        for query in queries:
+            for search_type in search_types:
+                cached, key = lookup_cached_search(query, search_type, max_results, backend)
+                if cached is None:
+                    waiting.append((search_type, query, key))
+                else:
+                    SEARCH_SOURCE_RESULTS.labels(search_type, 'ok').inc()
+                    yield search_type, query, 'ok', cached
+        if backend.rate_limited:
+            # Corta as últimas variações que o balde não atenderia antes do prazo global
+            budget = search_rate_limiter.available_within(max(limits.values(), default=started) - time.monotonic())
+            while len(waiting) > budget:
+                search_type, query, _ = waiting.pop()
+                yield rate_limited(search_type, query)
+        while waiting or pending:
+            now = time.monotonic()
+            while waiting:
+                search_type, query, key = waiting[0]
+                if now >= limits[search_type]:
+                    waiting.popleft()
+                    yield rate_limited(search_type, query)
+                    continue
+                if backend.rate_limited and not search_rate_limiter.try_acquire():
+                    break
+                waiting.popleft()
+                if backend.rate_limited:
+                    SEARCH_RATE_LIMIT_WAIT.observe(now - started)
+                future = executor.submit(_search_and_store, query, search_type, max_results, key, backend)
+                pending[future] = (search_type, query, limits[search_type])
+            for future, (search_type, query, limit) in list(pending.items()):
+                if now >= limit and not future.done():
+                    del pending[future]
+                    logger.warning(f"⏱️ Busca '{search_type}' para {query!r} excedeu o prazo; seguindo com resultados parciais.")
+                    SEARCH_SOURCE_RESULTS.labels(search_type, 'timeout').inc()
+                    yield search_type, query, 'timeout', []
+            if not waiting and not pending:
+                break
+            events = [limit for _, _, limit in pending.values()]
+            if waiting:
+                events += [limits[waiting[0][0]], now + search_rate_limiter.wait_time()]
+            wait = max(0.0, min(events) - time.monotonic())
+            if pending:
+                done, _ = concurrent.futures.wait(pending, timeout=wait, return_when=concurrent.futures.FIRST_COMPLETED)
+            else:
+                time.sleep(wait)
+                done = ()
+            for future in done:
+                search_type, query, _ = pending.pop(future)
+                try:
+                    found, outcome = future.result(), 'ok'
+                except Exception as e:
+                    found, outcome = [], 'error'
+                    logger.error(f"Erro na busca ({search_type}): {e}")
+                SEARCH_SOURCE_RESULTS.labels(search_type, outcome).inc()
+                yield search_type, query, outcome, found
+    finally:
+        SEARCH_FANOUT_SECONDS.observe(time.monotonic() - started)
+
+def merge_search_results(merged: list, seen: set, found: list) -> list:
+    # Acrescenta a `merged` os resultados com link ainda não visto; devolve só os novos
+    added = []
+    for item in found:
+        link = item.get('href') or item.get('url') or repr(sorted(item.items()))
+        if link not in seen:
+            seen.add(link)
+            merged.append(item)
+            added.append(item)
+    return added
+
+def source_status(outcomes: list) -> str:
+    # Status da fonte: 'ok' se alguma consulta respondeu; senão o motivo da falha
+    return 'ok' if not outcomes or 'ok' in outcomes else outcomes[0]
+
+# ===== Funcionalidades de Investigação Online =====
+def perform_search(query: str, search_type: str, max_results: int) -> list:
+    try:
+        return cached_search(query, search_type, max_results)
+    except Exception as e:
+        # Erros não são cacheados (só buscas concluídas sem resultado)
+        logger.error(f"Erro na busca ({search_type}): {e}")
+        return []
+
+def format_search_results(results: list, section_title: str) -> tuple:
+    count = len(results)
+    info_message = f"Apenas {count} resultados encontrados para '{section_title}'.<br>" if count < 1 else ""
+    formatted_text = "<br>".join(
+        f"• {res.get('title', 'Sem título')}<br>&nbsp;&nbsp;{res.get('href', 'Sem link')}<br>&nbsp;&nbsp;{res.get('body', '')}"
+        for res in results
+    )
     links_table = (
         f"<h3>{section_title}</h3>"
         "<table border='1' style='width:100%; border-collapse: collapse; text-align: left;'>"
@@ -1408,91 +4269,682 @@ def format_search_results(results: list, section_title: str) -> tuple:
     links_table += "</tbody></table>"
     return formatted_text, links_table, info_message
 
+INVESTIGATION_SYSTEM_PROMPT = "Você é um perito policial e forense digital, experiente em métodos policiais de investigação. Utilize técnicas de análise de evidências, protocolos forenses e investigação digital para identificar padrões, rastrear conexões e coletar evidências relevantes. Seja minucioso, preciso e detalhado."
+
+# ===== Empacotamento do Contexto da Investigação por Orçamento de Tokens =====
+PROMPT_CONTEXT_TOKENS = INFERENCE_SEQUENCE_CTX  # Contexto por sequência nos workers
+PROMPT_SAFETY_TOKENS = 64  # Folga para diferenças de tokenização entre blocos
+PROMPT_FORENSIC_MAX_TOKENS = 384
+PROMPT_SNIPPET_MAX_TOKENS = 192  # Cada resultado é truncado a isso antes de entrar no orçamento
+PROMPT_DUPLICATE_SIMILARITY = 0.8  # Jaccard de trigramas de palavras acima disso = trecho repetido
+PROMPT_CHARS_PER_TOKEN = 4  # Estimativa usada quando o tokenizador do modelo não está disponível
+
+CONTEXT_PACK_TOKENS = Counter('investigation_context_tokens_total', 'Tokens de resultados de busca no prompt da investigação', ['result'])
+CONTEXT_PACK_SNIPPETS = Counter('investigation_context_snippets_total', 'Resultados de busca considerados pelo empacotador de contexto', ['result'])
+
+_prompt_tokenizer = None
+_prompt_tokenizer_lock = threading.Lock()
+
+def get_prompt_tokenizer():
+    # Só o vocabulário do modelo (vocab_only), sem pesos: barato o bastante para o processo web.
+    # Retorna None se o modelo ainda não foi baixado ou o llama_cpp não está instalado.
+    global _prompt_tokenizer
+    with _prompt_tokenizer_lock:
+        if _prompt_tokenizer is None:
+            model_path = os.path.join(DEFAULT_LOCAL_MODEL_DIR, DEFAULT_MODEL_FILE)
+            llama_cpp = lazy_import('llama_cpp', optional=True)
+            if llama_cpp is None or not os.path.exists(model_path):
+                return None
+            try:
+                _prompt_tokenizer = llama_cpp.Llama(model_path=model_path, vocab_only=True, verbose=False)
+            except Exception as e:
+                logger.warning(f"Tokenizador do modelo indisponível, usando estimativa: {e}")
+                return None
+        return _prompt_tokenizer
+
+def count_tokens(text: str) -> int:
+    tokenizer = get_prompt_tokenizer()
+    if tokenizer is None:
+        return -(-len(text) // PROMPT_CHARS_PER_TOKEN)
+    with _prompt_tokenizer_lock:
+        return len(tokenizer.tokenize(text.encode('utf-8'), add_bos=False, special=False))
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    tokenizer = get_prompt_tokenizer()
+    if tokenizer is None:
+        return text[:max_tokens * PROMPT_CHARS_PER_TOKEN]
+    with _prompt_tokenizer_lock:
+        tokens = tokenizer.tokenize(text.encode('utf-8'), add_bos=False, special=False)
+        if len(tokens) <= max_tokens:
+            return text
+        return tokenizer.detokenize(tokens[:max_tokens]).decode('utf-8', errors='ignore').strip()
+
+def strip_markup(text: str) -> str:
+    # Remove tags e entidades HTML e colapsa espaços
+    return " ".join(html.unescape(re.sub(r'<[^>]+>', ' ', text or '')).split())
+
+def _relevance_terms(text: str) -> set:
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+    return {term for term in re.findall(r'\w+', text.casefold()) if len(term) > 1}
+
+def _shingles(text: str) -> set:
+    words = re.findall(r'\w+', text.casefold())
+    return {tuple(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+class ContextPacker:
+    # Monta os blocos de resultados do prompt dentro de um orçamento de tokens. Como as fontes
+    # chegam aos poucos (pipeline), cada bloco recebe uma fatia justa do que resta
+    # (restante / blocos ainda esperados); o que um bloco não usa fica para os seguintes.
+    # Em cada bloco: remove markup, descarta trechos quase idênticos aos já incluídos, ordena
+    # por relevância para o alvo e o foco e inclui os melhores enquanto couberem.
+    def __init__(self, target: str, focus: str, budget_tokens: int, expected_blocks: int):
+        self.terms = _relevance_terms(f"{target} {focus or ''}")
+        self.remaining = max(0, budget_tokens)
+        self.budget = self.remaining
+        self.blocks_left = max(1, expected_blocks)
+        self.packed_shingles = []
+        self.stats = {'packed_tokens': 0, 'dropped_tokens': 0, 'packed': 0, 'duplicates': 0, 'over_budget': 0}
+
+    def _score(self, title: str, body: str) -> float:
+        if not self.terms:
+            return 0.0
+        return (2 * len(self.terms & _relevance_terms(title)) + len(self.terms & _relevance_terms(body))) / (3 * len(self.terms))
+
+    def pack(self, title: str, results: list) -> str:
+        share = self.remaining // self.blocks_left
+        self.blocks_left = max(1, self.blocks_left - 1)
+        header = f"\n\n{title}:"
+        used = count_tokens(header)
+        candidates = []
+        for position, result in enumerate(results):
+            result_title = strip_markup(result.get('title', 'Sem título'))
+            body = strip_markup(result.get('body', ''))
+            snippet = truncate_tokens(f"\n• {result_title}\n  {result.get('href', 'Sem link')}\n  {body}", PROMPT_SNIPPET_MAX_TOKENS)
+            candidates.append((-self._score(result_title, body), position, snippet, _shingles(f"{result_title} {body}")))
+        lines = []
+        # Na ordem de relevância; um trecho quase igual a outro já incluído (deste ou de blocos anteriores) é descartado
+        for _, _, snippet, shingles in sorted(candidates, key=lambda candidate: candidate[:2]):
+            tokens = count_tokens(snippet)
+            if any(len(shingles & other) / len(shingles | other) >= PROMPT_DUPLICATE_SIMILARITY
+                   for other in self.packed_shingles):
+                self.stats['duplicates'] += 1
+            elif used + tokens <= share:
+                lines.append(snippet)
+                used += tokens
+                self.packed_shingles.append(shingles)
+                self.stats['packed'] += 1
+                self.stats['packed_tokens'] += tokens
+            else:
+                self.stats['over_budget'] += 1
+                self.stats['dropped_tokens'] += tokens
+        if not lines:
+            return ""
+        self.remaining -= used
+        return header + "".join(lines)
+
+    def report(self) -> dict:
+        CONTEXT_PACK_TOKENS.labels('packed').inc(self.stats['packed_tokens'])
+        CONTEXT_PACK_TOKENS.labels('dropped').inc(self.stats['dropped_tokens'])
+        for result in ('packed', 'duplicates', 'over_budget'):
+            CONTEXT_PACK_SNIPPETS.labels(result).inc(self.stats[result])
+        return dict(self.stats, budget_tokens=self.budget)
+
+def pack_forensic_details(found: dict, max_tokens: int = PROMPT_FORENSIC_MAX_TOKENS) -> str:
+    # Indicadores extraídos, um tipo por linha, até o limite de tokens (os primeiros encontrados primeiro)
+    lines, used = [], 0
+    for key, values in found.items():
+        kept = []
+        for value in values:
+            cost = count_tokens(f"{value}, ")
+            if used + cost > max_tokens:
+                break
+            kept.append(value)
+            used += cost
+        if kept:
+            lines.append(f"{key}: {', '.join(kept)}")
+        if used >= max_tokens:
+            break
+    return "\n".join(lines)
+
+# ===== Investigação em Pipeline (buscas, extração forense e prefill sobrepostos) =====
+INVESTIGATION_SECTIONS = {
+    'web': ("Resultados de Sites", "Sites"),
+    'news': ("Notícias", "Notícias"),
+    'leaked': ("Dados Vazados", "Dados Vazados"),
+}
+INVESTIGATION_CLOSING = "\n\nElabore um relatório detalhado com ligações, riscos e informações relevantes."
+
+INVESTIGATION_STAGE_SECONDS = Histogram('investigation_stage_seconds', 'Tempo de cada etapa da investigação em pipeline',
+                                        ['stage'], buckets=(0.1, 0.5, 1, 2, 5, 10, 20, 40, 80))
+
+class ForensicAccumulator:
+    # Extração forense incremental: cada bloco de resultados é varrido assim que chega e os
+    # indicadores são acumulados na ordem em que aparecem (sem repetições)
+    def __init__(self):
+        self.found = {}
+
+    def add(self, text: str) -> int:
+        added = 0
+        for key, values in advanced_forensic_analysis(text).items():
+            bucket = self.found.setdefault(key, {})
+            for value in values:
+                if value not in bucket:
+                    bucket[value] = None
+                    added += 1
+        return added
+
+    def result(self) -> dict:
+        return {key: list(values) for key, values in self.found.items() if values}
+
+    def total(self) -> int:
+        return sum(len(values) for values in self.found.values())
+
+def run_investigation(target: str, sites_meta: int = 5, investigation_focus: str = "",
+                      search_news: bool = False, search_leaked_data: bool = False, custom_temperature: float = None,
+                      lang: str = "Português", fast_mode: bool = False, autocorrect: bool = True,
+                      aliases: list = None, priority: int = PRIORITY_INVESTIGATION):
+    # Gerador de eventos (tipo, dado): 'progress' (texto), 'token' (trecho do relatório) e 'links'
+    # (tabelas HTML). Com batching contínuo o job de inferência é aberto logo após a autocorreção
+    # com o prompt de sistema e o cabeçalho; cada fonte de busca que termina tem os resultados
+    # extraídos e enviados ao worker, que faz o prefill enquanto as fontes mais lentas ainda
+    # respondem. No modo sequencial o prompt é montado e enviado só quando as buscas terminam,
+    # para não prender um worker durante elas. A geração começa quando a última fonte termina
+    # (ou o prazo global vence).
+    started = time.monotonic()
+    corrected_target = cached_autocorrect(target, lang, priority) if autocorrect else target
+    INVESTIGATION_STAGE_SECONDS.labels('autocorrect').observe(time.monotonic() - started)
+    if corrected_target != target:
+        yield 'progress', f"✏️ Alvo corrigido para: {corrected_target}"
+
+    temp = custom_temperature if custom_temperature is not None else 0.7
+    max_tokens = 500 if fast_mode else 1000
+    logger.info(f"Utilizando temperatura {temp} na investigação e max_tokens={max_tokens}.")
+    header = f"Analise os dados obtidos sobre '{corrected_target}'"
+    if investigation_focus:
+        header += f", focando em '{investigation_focus}'"
+    head = system_prompt_prefix(INVESTIGATION_SYSTEM_PROMPT) + header + "\n"
+    messages = [{"role": "system", "content": INVESTIGATION_SYSTEM_PROMPT}]
+    job = None
+    if inference_scheduler.batched():
+        job = inference_scheduler.submit(messages, temp, max_tokens, stop=["</s>"], priority=priority,
+                                         prompt=head, open_prompt=True)
+    blocks = []  # Blocos de resultados quando o job só é criado depois das buscas
+    try:
+        search_types = ['web'] + (['news'] if search_news else []) + (['leaked'] if search_leaked_data else [])
+        queries = investigation_query_variants(corrected_target, investigation_focus, aliases)
+        yield 'progress', f"🔎 Buscando {len(queries)} variações da consulta em: {', '.join(search_types)}"
+        results = {search_type: [] for search_type in search_types}
+        seen = {search_type: set() for search_type in search_types}
+        outcomes = {search_type: [] for search_type in search_types}
+        forensic = ForensicAccumulator()
+        # Orçamento dos resultados: o contexto menos a resposta, as partes fixas do prompt e os indicadores
+        budget = (PROMPT_CONTEXT_TOKENS - max_tokens - count_tokens(head) - count_tokens(INVESTIGATION_CLOSING)
+                  - PROMPT_FORENSIC_MAX_TOKENS - PROMPT_SAFETY_TOKENS)
+        packer = ContextPacker(corrected_target, investigation_focus, budget, len(search_types))
+        search_started = time.monotonic()
+        for search_type, query, outcome, found in iter_searches(queries, search_types, sites_meta):
+            outcomes[search_type].append(outcome)
+            if outcome != 'ok':
+                reason = {'timeout': "excedeu o prazo", 'rate_limited': "não coube no limite de taxa"}.get(outcome, "falhou")
+                yield 'progress', f"⚠️ Busca {search_type} ({query}) {reason}; seguindo com resultados parciais"
+            else:
+                added = merge_search_results(results[search_type], seen[search_type], found)
+                yield 'progress', f"✅ Busca {search_type} ({query}) concluída: {len(found)} resultados, {len(added)} novos"
+                forensic.add("\n".join(f"{item.get('title', '')} {item.get('href', '')} {strip_markup(item.get('body', ''))}"
+                                       for item in added))
+            # Um bloco (e um cabeçalho) por tipo, enviado ao worker quando todas as variações do tipo terminam
+            if len(outcomes[search_type]) == len(queries):
+                block = packer.pack(INVESTIGATION_SECTIONS[search_type][0], results[search_type])
+                if block and job is not None:
+                    job.extend(block)
+                elif block:
+                    blocks.append(block)
+        INVESTIGATION_STAGE_SECONDS.labels('search').observe(time.monotonic() - search_started)
+
+        packed = packer.report()
+        logger.info(f"📦 Contexto da investigação: {packed}")
+        yield 'progress', (f"📦 Contexto: {packed['packed_tokens']} tokens de resultados ({packed['packed']} trechos); "
+                           f"descartados {packed['over_budget']} por orçamento ({packed['dropped_tokens']} tokens) "
+                           f"e {packed['duplicates']} repetidos")
+        tail = ""
+        missing_sources = [search_type for search_type, outcome in outcomes.items() if source_status(outcome) != 'ok']
+        if missing_sources:
+            tail += f"\n\nFontes sem resposta (resultados parciais): {', '.join(missing_sources)}"
+        forensic_details = pack_forensic_details(forensic.result())
+        if forensic_details:
+            tail += "\n\nAnálise Forense Extraída:\n" + forensic_details
+        yield 'progress', f"🧪 Extração forense concluída: {forensic.total()} indicadores"
+        if job is not None:
+            job.extend(tail + INVESTIGATION_CLOSING + " [/INST]", final=True)
+        else:
+            job = inference_scheduler.submit(messages, temp, max_tokens, stop=["</s>"], priority=priority,
+                                             prompt=head + "".join(blocks) + tail + INVESTIGATION_CLOSING + " [/INST]")
+
+        first_token = True
+        for token in job.iter_tokens():
+            if first_token:
+                first_token = False
+                INVESTIGATION_STAGE_SECONDS.labels('first_token').observe(time.monotonic() - started)
+                yield 'progress', "📝 Gerando relatório..."
+            yield 'token', token
+    finally:
+        # Cliente desconectado ou erro: libera o worker (inclusive um prompt ainda aberto)
+        if job is not None:
+            job.cancel()
+    INVESTIGATION_STAGE_SECONDS.labels('total').observe(time.monotonic() - started)
+    links = ""
+    for search_type in search_types:
+        if search_type == 'web' or results[search_type]:
+            links += format_search_results(results[search_type], INVESTIGATION_SECTIONS[search_type][1])[1]
+    yield 'links', links
+
+def collect_investigation(target: str, sites_meta: int = 5, investigation_focus: str = "",
+                          search_news: bool = False, search_leaked_data: bool = False, custom_temperature: float = None,
+                          lang: str = "Português", fast_mode: bool = False, autocorrect: bool = True,
+                          aliases: list = None, priority: int = PRIORITY_INVESTIGATION) -> tuple:
+    # (relatório, links) de run_investigation; falhas propagam como exceção
+    parts, links = [], ""
+    for kind, payload in run_investigation(target, sites_meta, investigation_focus, search_news, search_leaked_data,
+                                           custom_temperature, lang, fast_mode, autocorrect, aliases, priority):
+        if kind == 'token':
+            parts.append(payload)
+        elif kind == 'links':
+            links = payload
+        else:
+            logger.info(payload)
+    return "".join(parts), links
+
 def process_investigation(target: str, sites_meta: int = 5, investigation_focus: str = "",
                           search_news: bool = False, search_leaked_data: bool = False, custom_temperature: float = None,
-                          lang: str = "Português", fast_mode: bool = False) -> tuple:
+                          lang: str = "Português", fast_mode: bool = False, autocorrect: bool = True,
+                          aliases: list = None, priority: int = PRIORITY_INVESTIGATION) -> tuple:
     logger.info(f"🔍 Iniciando investigação para: {repr(target)}")
     if not target.strip():
         return "Erro: Por favor, insira um alvo para investigação.", ""
-    
-    corrected_target = autocorrect_text(target, lang)
-    
-    search_tasks = {}
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        search_tasks['web'] = executor.submit(perform_search, corrected_target, 'web', sites_meta)
-        if search_news:
-            search_tasks['news'] = executor.submit(perform_search, corrected_target, 'news', sites_meta)
-        if search_leaked_data:
-            search_tasks['leaked'] = executor.submit(perform_search, corrected_target, 'leaked', sites_meta)
-    
-    results_web = search_tasks['web'].result() if 'web' in search_tasks else []
-    results_news = search_tasks['news'].result() if 'news' in search_tasks else []
-    results_leaked = search_tasks['leaked'].result() if 'leaked' in search_tasks else []
-    
-    formatted_web, links_web, _ = format_search_results(results_web, "Sites")
-    formatted_news, links_news, _ = ( "", "", "" ) if not results_news else format_search_results(results_news, "Notícias")
-    formatted_leaked, links_leaked, _ = ( "", "", "" ) if not results_leaked else format_search_results(results_leaked, "Dados Vazados")
-    
-    combined_results_text = ""
-    if formatted_web:
-        combined_results_text += "<br><br>Resultados de Sites:<br>" + formatted_web
-    if formatted_news:
-        combined_results_text += "<br><br>Notícias:<br>" + formatted_news
-    if formatted_leaked:
-        combined_results_text += "<br><br>Dados Vazados:<br>" + formatted_leaked
-    
-    forensic_analysis = advanced_forensic_analysis(combined_results_text)
-    forensic_details = "<br>".join(f"{k}: {v}" for k, v in forensic_analysis.items() if v)
-    
-    investigation_prompt = f"Analise os dados obtidos sobre '{corrected_target}'"
-    if investigation_focus:
-        investigation_prompt += f", focando em '{investigation_focus}'"
-    investigation_prompt += "<br>" + combined_results_text
-    if forensic_details:
-        investigation_prompt += "<br><br>Análise Forense Extraída:<br>" + forensic_details
-    investigation_prompt += "<br><br>Elabore um relatório detalhado com ligações, riscos e informações relevantes."
-    
-    temp = custom_temperature if custom_temperature is not None else 0.7
-    max_tokens = 500 if fast_mode else 1000
-    logger.info(f"Utilizando temperatura {temp} na investigação e max_tokens={max_tokens}.")
-    
     try:
-        with model_lock:
-            investigation_response = model.create_chat_completion(
-                messages=[
-                    {"role": "system", "content": "Você é um perito policial e forense digital, experiente em métodos policiais de investigação. Utilize técnicas de análise de evidências, protocolos forenses e investigação digital para identificar padrões, rastrear conexões e coletar evidências relevantes. Seja minucioso, preciso e detalhado."},
-                    {"role": "user", "content": investigation_prompt}
-                ],
-                temperature=temp,
-                max_tokens=max_tokens,
-                stop=["</s>"]
-            )
-        report = investigation_response['choices'][0]['message']['content']
-        links_combined = links_web + (links_news if links_news else "") + (links_leaked if links_leaked else "")
-        return report, links_combined
+        return collect_investigation(target, sites_meta, investigation_focus, search_news, search_leaked_data,
+                                     custom_temperature, lang, fast_mode, autocorrect, aliases, priority)
+    except InferenceQueueFull:
+        raise
     except Exception as e:
         logger.error(f"❌ Erro na investigação: {e}")
         return f"Erro na investigação: {e}", ""
 
+def stream_investigation(target: str, sites_meta: int = 5, investigation_focus: str = "",
+                         search_news: bool = False, search_leaked_data: bool = False, custom_temperature: float = None,
+                         lang: str = "Português", fast_mode: bool = False, autocorrect: bool = True,
+                         aliases: list = None):
+    # Streaming HTTP: eventos de progresso em itálico, depois o relatório token a token e os links
+    logger.info(f"🔍 Iniciando investigação (streaming) para: {repr(target)}")
+    if not target.strip():
+        yield "Erro: Por favor, insira um alvo para investigação."
+        return
+    events = run_investigation(target, sites_meta, investigation_focus, search_news, search_leaked_data,
+                               custom_temperature, lang, fast_mode, autocorrect, aliases)
+    try:
+        for kind, payload in events:
+            if kind == 'progress':
+                yield f"<i>{payload}</i><br>"
+            elif kind == 'token':
+                yield payload
+            else:
+                yield "<br><br>Links encontrados:<br>" + payload
+    except Exception as e:
+        logger.error(f"❌ Erro na investigação (streaming): {e}")
+        yield f"Erro na investigação: {e}"
+    finally:
+        events.close()
+
 # ===== Função para Análise de E-mails =====
+EMAIL_DECODE_CHUNK_CHARS = 64 * 1024  # anexos são decodificados e resumidos em blocos desse tamanho
+EMAIL_BULK_MAX_MESSAGE_BYTES = 64 * 1024 * 1024  # mensagens maiores são relatadas como erro, sem carregar
+EMAIL_BULK_BATCH_MESSAGES = 64  # mensagens por tarefa enviada ao pool de processos
+EMAIL_BULK_BATCH_BYTES = 4 * 1024 * 1024
+EMAIL_BULK_INFLIGHT_PER_WORKER = 2  # tarefas em andamento por processo; limita a memória do streaming
+EMAIL_BULK_COPY_BYTES = 1024 * 1024
+EMAIL_BULK_FORMATS = ('mbox', 'zip', 'tar', 'eml')
+
+EMAIL_BULK_MESSAGES = Counter('email_bulk_messages_total', 'Mensagens processadas pela análise de e-mails em lote', ['result'])
+EMAIL_BULK_SECONDS = Histogram('email_bulk_seconds', 'Duração da análise de caixas de e-mail em lote',
+                               buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600))
+
+BASE64_NOISE_PATTERN = re.compile(r'[^A-Za-z0-9+/=]+')
+MBOXRD_FROM_PATTERN = re.compile(rb'^>+From ')
+
+def _iter_payload_bytes(part):
+    # Decodifica o payload em blocos, sem montar o anexo inteiro em memória; mesmas regras de
+    # get_payload(decode=True) para base64, quoted-printable e 7bit/8bit/binary
+    payload = part.get_payload(decode=False)
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+    if not isinstance(payload, str) or encoding not in ('base64', 'quoted-printable', '7bit', '8bit', 'binary', ''):
+        yield part.get_payload(decode=True) or b''
+        return
+    if encoding == 'base64':
+        carry = ''
+        for start in range(0, len(payload), EMAIL_DECODE_CHUNK_CHARS):
+            data = carry + BASE64_NOISE_PATTERN.sub('', payload[start:start + EMAIL_DECODE_CHUNK_CHARS])
+            usable = len(data) - len(data) % 4
+            carry = data[usable:]
+            if usable:
+                yield binascii.a2b_base64(data[:usable])
+        carry = carry.rstrip('=')
+        if len(carry) > 1:
+            # Base64 truncado: completa o padding, como o decodificador da biblioteca padrão; um
+            # único caractere que sobra não forma nenhum byte e é descartado
+            yield binascii.a2b_base64(carry + '=' * (-len(carry) % 4))
+        return
+    start = 0
+    while start < len(payload):
+        end = start + EMAIL_DECODE_CHUNK_CHARS
+        if encoding == 'quoted-printable' and end < len(payload):
+            # Corta no fim de uma linha para não separar um '=XX' ou uma quebra suave
+            newline = payload.rfind('\n', start, end)
+            end = newline + 1 if newline >= start else end
+        chunk = payload[start:end]
+        try:
+            data = chunk.encode('ascii', 'surrogateescape')
+        except UnicodeError:
+            data = chunk.encode('raw-unicode-escape')
+        yield binascii.a2b_qp(data) if encoding == 'quoted-printable' else data
+        start = end
+
+# ----- Repositório de anexos endereçado por conteúdo (diretório + índice SQLite) -----
+ATTACHMENT_STORE_DIR = os.environ.get("ATTACHMENT_STORE_DIR", os.path.join(CACHE_DIR, "attachments"))
+ATTACHMENT_SCAN_BYTES = 4 * 1024 * 1024  # tipo e indicadores vêm do início do anexo
+ATTACHMENT_MAX_INDICATORS = 50  # por tipo de indicador
+# Por padrão só hash, tipo e indicadores ficam no índice; guardar o conteúdo (amostras de malware
+# inclusive) é opcional e limitado por bytes em disco e idade
+ATTACHMENT_STORE_KEEP_CONTENT = os.environ.get("ATTACHMENT_STORE_KEEP_CONTENT", "false").lower() == "true"
+ATTACHMENT_STORE_MAX_BYTES = 2 * 1024 ** 3
+ATTACHMENT_STORE_MAX_AGE = 30 * 24 * 3600  # sem ser visto há mais tempo, o anexo sai do índice
+ATTACHMENT_STORE_PRUNE_EVERY = 100  # anexos novos entre limpezas
+ATTACHMENT_GENERIC_TYPES = ('application/octet-stream', 'text/plain')
+PRINTABLE_RUN_PATTERN = re.compile(rb'[\x20-\x7e]{6,}')
+
+# (deslocamento, assinatura, tipo) verificados no início do conteúdo decodificado
+ATTACHMENT_MAGIC_SIGNATURES = (
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'MZ', 'application/x-dosexec'),
+    (0, b'\x7fELF', 'application/x-executable'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),
+    (0, b'{\\rtf', 'application/rtf'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (0, b"7z\xbc\xaf'\x1c", 'application/x-7z-compressed'),
+    (257, b'ustar', 'application/x-tar'),
+    (0, b'#!', 'text/x-shellscript'),
+)
+# Tipos declarados compatíveis com cada tipo detectado (trechos do Content-Type)
+ATTACHMENT_TYPE_FAMILIES = {
+    'application/zip': ('zip', 'openxmlformats', 'opendocument', 'java-archive', 'epub'),
+    'application/x-ole-storage': ('msword', 'ms-excel', 'ms-powerpoint', 'vnd.ms-', 'ms-outlook'),
+    'application/x-dosexec': ('x-msdownload', 'x-msdos-program', 'x-dosexec', 'x-ms-installer'),
+    'image/jpeg': ('jpeg', 'jpg'),
+    'application/gzip': ('gzip', 'x-gzip', 'x-tar'),
+    'text/html': ('html',)
+}
+
+ATTACHMENT_STORE_LOOKUPS = Counter('attachment_store_lookups_total', 'Consultas ao repositório de anexos', ['result'])
+ATTACHMENT_STORE_BYTES_SAVED = Counter('attachment_store_bytes_saved_total',
+                                       'Bytes de anexos repetidos que não foram reprocessados')
+
+def detect_attachment_type(head: bytes) -> str:
+    for offset, signature, mime_type in ATTACHMENT_MAGIC_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return mime_type
+    start = head[:512].lstrip().lower()
+    if start.startswith((b'<!doctype html', b'<html')):
+        return 'text/html'
+    if b'\x00' not in head[:4096]:
+        try:
+            head[:4096].decode('utf-8')
+            return 'text/plain'
+        except UnicodeDecodeError as e:
+            # Um caractere multibyte cortado no fim da amostra ainda é texto
+            if e.start >= min(len(head), 4096) - 3:
+                return 'text/plain'
+    return 'application/octet-stream'
+
+def attachment_type_mismatch(declared: str, detected: str) -> bool:
+    # Conteúdo reconhecido que não corresponde ao Content-Type declarado (ex.: executável como PDF)
+    if detected in ATTACHMENT_GENERIC_TYPES or declared in ATTACHMENT_GENERIC_TYPES:
+        return False
+    tokens = ATTACHMENT_TYPE_FAMILIES.get(detected, (detected.split('/')[-1],))
+    return not any(token in declared for token in tokens)
+
+class AttachmentStore:
+    # Cada anexo é indexado uma vez pelo SHA-256 com tamanho, tipo detectado e indicadores; com
+    # keep_content o arquivo também é gravado em <dir>/ab/cd/<sha256>. Uma segunda tabela mapeia
+    # o hash do payload ainda codificado (base64/QP) para o SHA-256, de modo que um anexo repetido
+    # nem chega a ser decodificado. A limpeza remove do índice o que não é visto há max_age e
+    # apaga os arquivos mais antigos acima de max_bytes. Cada processo do pool abre a sua
+    # própria conexão; o WAL permite leituras e gravações concorrentes.
+    def __init__(self, directory: str, keep_content: bool = False, max_bytes: int = ATTACHMENT_STORE_MAX_BYTES,
+                 max_age: float = ATTACHMENT_STORE_MAX_AGE):
+        self.directory = directory
+        self.keep_content = keep_content
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"), timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS attachments (
+                    sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, detected_type TEXT NOT NULL, indicators TEXT NOT NULL,
+                    first_seen REAL NOT NULL, last_seen REAL NOT NULL, occurrences INTEGER NOT NULL DEFAULT 1,
+                    stored INTEGER NOT NULL DEFAULT 0)""")
+                conn.execute("CREATE INDEX IF NOT EXISTS attachments_last_seen ON attachments (last_seen)")
+                conn.execute("""CREATE TABLE IF NOT EXISTS attachment_encodings (
+                    encoded_digest TEXT PRIMARY KEY, sha256 TEXT NOT NULL)""")
+            self._conn = conn
+        return self._conn
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], sha256[2:4], sha256)
+
+    def _fetch(self, conn, sha256: str, touch: bool = True):
+        row = conn.execute("SELECT sha256, size, detected_type, indicators, stored FROM attachments WHERE sha256 = ?",
+                           (sha256,)).fetchone()
+        if row is None:
+            return None
+        if touch:
+            with conn:
+                conn.execute("UPDATE attachments SET last_seen = ?, occurrences = occurrences + 1 WHERE sha256 = ?",
+                             (time.time(), sha256))
+        return {'sha256': row[0], 'size': row[1], 'detected_type': row[2], 'indicators': json.loads(row[3]),
+                'stored': bool(row[4])}
+
+    def lookup(self, sha256: str, touch: bool = True):
+        with self._lock:
+            return self._fetch(self._connection(), sha256, touch)
+
+    def lookup_encoded(self, encoded_digest: str):
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT sha256 FROM attachment_encodings WHERE encoded_digest = ?",
+                               (encoded_digest,)).fetchone()
+            return self._fetch(conn, row[0]) if row else None
+
+    def ingest(self, chunks, encoded_digest: str = None) -> tuple:
+        # Calcula o hash em blocos (com keep_content, gravando num temporário ao mesmo tempo); se o
+        # SHA-256 já estiver no índice nada é gravado, senão tipo e indicadores são extraídos da
+        # amostra inicial e o arquivo vai para o caminho definitivo. Retorna (registro, resultado).
+        os.makedirs(self.directory, exist_ok=True)
+        digest, size, sample = hashlib.sha256(), 0, bytearray()
+        temporary = tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) if self.keep_content else None
+        try:
+            for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                if temporary is not None:
+                    temporary.write(chunk)
+                if len(sample) < ATTACHMENT_SCAN_BYTES:
+                    sample += chunk[:ATTACHMENT_SCAN_BYTES - len(sample)]
+        except BaseException:
+            if temporary is not None:
+                temporary.close()
+                os.remove(temporary.name)
+            raise
+        if temporary is not None:
+            temporary.close()
+        sha256 = digest.hexdigest()
+        record = self.lookup(sha256)
+        if record is not None:
+            if temporary is not None:
+                os.remove(temporary.name)
+            outcome = 'content_hit'
+        else:
+            sample = bytes(sample)
+            detected_type = detect_attachment_type(sample)
+            if not detected_type.startswith('text/'):
+                # Binário: só as sequências imprimíveis (como `strings`), para não casar ruído
+                sample = b"\n".join(PRINTABLE_RUN_PATTERN.findall(sample))
+            indicators = {kind: values[:ATTACHMENT_MAX_INDICATORS]
+                          for kind, values in FORENSIC_INDICATOR_SCANNER.scan(sample).items()}
+            record = {'sha256': sha256, 'size': size, 'detected_type': detected_type, 'indicators': indicators,
+                      'stored': temporary is not None}
+            if temporary is not None:
+                os.makedirs(os.path.dirname(self.path(sha256)), exist_ok=True)
+                os.replace(temporary.name, self.path(sha256))
+            now = time.time()
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute("INSERT OR IGNORE INTO attachments (sha256, size, detected_type, indicators, first_seen, "
+                                 "last_seen, stored) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (sha256, size, record['detected_type'], json.dumps(indicators, ensure_ascii=False),
+                                  now, now, int(record['stored'])))
+                self._writes += 1
+                if self._writes % ATTACHMENT_STORE_PRUNE_EVERY == 0:
+                    self._prune(conn, now)
+            outcome = 'miss'
+        if encoded_digest:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO attachment_encodings VALUES (?, ?)", (encoded_digest, sha256))
+        return record, outcome
+
+    def _remove_content(self, sha256: str) -> None:
+        try:
+            os.remove(self.path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def _prune(self, conn, now: float) -> None:
+        # Vencidos saem do índice (com o arquivo e os hashes codificados); acima de max_bytes,
+        # os arquivos menos vistos recentemente são apagados e o registro fica só com os metadados
+        expired = conn.execute("SELECT sha256, stored FROM attachments WHERE last_seen < ?",
+                               (now - self.max_age,)).fetchall()
+        evicted, stored_bytes = [], 0
+        for sha256, size in conn.execute("SELECT sha256, size FROM attachments WHERE stored = 1 AND last_seen >= ? "
+                                         "ORDER BY last_seen DESC", (now - self.max_age,)):
+            stored_bytes += size
+            if stored_bytes > self.max_bytes:
+                evicted.append(sha256)
+        with conn:
+            conn.executemany("DELETE FROM attachment_encodings WHERE sha256 = ?", [(row[0],) for row in expired])
+            conn.executemany("DELETE FROM attachments WHERE sha256 = ?", [(row[0],) for row in expired])
+            conn.executemany("UPDATE attachments SET stored = 0 WHERE sha256 = ?", [(sha256,) for sha256 in evicted])
+        for sha256 in [row[0] for row in expired if row[1]] + evicted:
+            self._remove_content(sha256)
+        if expired:
+            CACHE_EVICTIONS.labels('attachments', 'expired').inc(len(expired))
+        if evicted:
+            CACHE_EVICTIONS.labels('attachments', 'capacity').inc(len(evicted))
+
+    def prune(self) -> None:
+        with self._lock:
+            self._prune(self._connection(), time.time())
+
+attachment_store = AttachmentStore(ATTACHMENT_STORE_DIR, keep_content=ATTACHMENT_STORE_KEEP_CONTENT)
+
+def _encoded_payload_digest(part):
+    # Hash do payload como veio na mensagem (sem decodificar), junto com o Content-Transfer-Encoding
+    payload = part.get_payload(decode=False)
+    if not isinstance(payload, str):
+        return None
+    digest = hashlib.sha256(str(part.get('Content-Transfer-Encoding', '')).strip().lower().encode() + b'\x00')
+    for start in range(0, len(payload), EMAIL_DECODE_CHUNK_CHARS):
+        chunk = payload[start:start + EMAIL_DECODE_CHUNK_CHARS]
+        try:
+            digest.update(chunk.encode('ascii', 'surrogateescape'))
+        except UnicodeError:
+            digest.update(chunk.encode('raw-unicode-escape'))
+    return digest.hexdigest()
+
+def record_attachment_store_stats(attachments: list) -> tuple:
+    # Os contadores ficam no processo principal (o lote roda no pool); retorna (repetidos, bytes poupados)
+    hits = saved = 0
+    for attachment in attachments:
+        outcome = attachment.get('store')
+        if outcome is None:
+            continue
+        ATTACHMENT_STORE_LOOKUPS.labels(outcome).inc()
+        if outcome != 'miss':
+            hits += 1
+            saved += attachment['size']
+            ATTACHMENT_STORE_BYTES_SAVED.inc(attachment['size'])
+    return hits, saved
+
+def email_attachments(msg) -> list:
+    # Anexo já visto (mesmo payload codificado ou mesmo conteúdo) vem do índice do repositório;
+    # 'store' indica 'encoded_hit', 'content_hit' ou 'miss'
+    attachments = []
+    for part in msg.walk():
+        content_disposition = part.get("Content-Disposition", "")
+        if "attachment" in content_disposition:
+            content_type = part.get_content_type()
+            try:
+                encoded_digest = _encoded_payload_digest(part)
+                record = attachment_store.lookup_encoded(encoded_digest) if encoded_digest else None
+                outcome = 'encoded_hit'
+                if record is None:
+                    record, outcome = attachment_store.ingest(_iter_payload_bytes(part), encoded_digest)
+            except (OSError, sqlite3.Error) as e:
+                # Repositório indisponível: só tamanho e hash, calculados em blocos
+                logger.warning(f"Repositório de anexos indisponível: {e}")
+                digest, size = hashlib.sha256(), 0
+                for chunk in _iter_payload_bytes(part):
+                    digest.update(chunk)
+                    size += len(chunk)
+                record, outcome = {'sha256': digest.hexdigest(), 'size': size}, None
+            attachment = {
+                "filename": part.get_filename(),
+                "content_type": content_type,
+                "size": record['size'],
+                "sha256": record['sha256']
+            }
+            if outcome is not None:
+                attachment.update({
+                    "detected_type": record['detected_type'],
+                    "type_mismatch": attachment_type_mismatch(content_type, record['detected_type']),
+                    "indicators": record['indicators'],
+                    "store": outcome
+                })
+            attachments.append(attachment)
+    return attachments
+
 def analyze_email_forensics(raw_email: bytes) -> dict:
     result = {}
     try:
         msg = BytesParser(policy=policy.default).parsebytes(raw_email)
-        result['From'] = msg.get('From')
-        result['To'] = msg.get('To')
-        result['Subject'] = msg.get('Subject')
-        result['Date'] = msg.get('Date')
-        attachments = []
-        for part in msg.walk():
-            content_disposition = part.get("Content-Disposition", "")
-            if "attachment" in content_disposition:
-                attachments.append({
-                    "filename": part.get_filename(),
-                    "content_type": part.get_content_type(),
-                    "size": len(part.get_payload(decode=True))
-                })
-        result['Attachments'] = attachments
+        # Cabeçalhos como str: os objetos de cabeçalho da policy não atravessam o pool de processos
+        for header in ('From', 'To', 'Subject', 'Date'):
+            value = msg.get(header)
+            result[header] = str(value) if value is not None else None
+        result['Attachments'] = email_attachments(msg)
     except Exception as e:
         result['error'] = str(e)
     return result
@@ -1504,60 +4956,835 @@ def email_forensics():
     email_file = request.files['email_file']
     raw_email = email_file.read()
     analysis = analyze_email_forensics(raw_email)
+    record_attachment_store_stats(analysis.get('Attachments', []))
     return jsonify(analysis)
 
-# ===== Função para Análise de Comportamento de Usuário (UBA) =====
-def analyze_user_behavior(user_data: list) -> dict:
+@app.route('/email_forensics/attachments/<sha256>', methods=['GET'])
+def email_attachment_record(sha256):
+    record = attachment_store.lookup(sha256.lower(), touch=False) if re.fullmatch(r'[0-9a-fA-F]{64}', sha256) else None
+    if record is None:
+        return jsonify({'error': 'Anexo não encontrado'}), 404
+    return jsonify(record)
+
+# ----- Análise em lote de caixas de e-mail (mbox, maildir, zip) -----
+def iter_mbox_messages(fileobj, label: str = ""):
+    # Lê o mbox linha a linha e entrega uma mensagem por vez como (origem, bytes, erro); só a
+    # mensagem atual fica em memória. Linhas ">From " (mboxrd) perdem um '>'.
+    lines, size, start, offset, oversized = [], 0, 0, 0, False
+    previous_blank = True
+    for line in fileobj:
+        length = len(line)  # antes de remover o '>' do mboxrd, para a origem apontar o byte certo
+        if previous_blank and line.startswith(b'From '):
+            if lines or oversized:
+                yield _mbox_entry(label, start, lines, oversized)
+            lines, size, start, oversized = [], 0, offset, False
+        elif not oversized:
+            if MBOXRD_FROM_PATTERN.match(line):
+                line = line[1:]
+            lines.append(line)
+            size += len(line)
+            if size > EMAIL_BULK_MAX_MESSAGE_BYTES:
+                lines, oversized = [], True
+        previous_blank = line in (b'\n', b'\r\n')
+        offset += length
+    if lines or oversized:
+        yield _mbox_entry(label, start, lines, oversized)
+
+def _mbox_entry(label: str, start: int, lines: list, oversized: bool) -> tuple:
+    source = f"{label}@{start}" if label else f"@{start}"
+    if oversized:
+        return source, None, f"Mensagem maior que {EMAIL_BULK_MAX_MESSAGE_BYTES} bytes"
+    return source, b''.join(lines), None
+
+def _iter_archive_member(name: str, size: int, fileobj):
+    # Membro de zip/tar: um mbox (começa com "From ") é dividido; qualquer outro arquivo é
+    # uma mensagem (maildir: cur/ e new/, ou arquivos .eml)
+    if fileobj.peek(5)[:5] == b'From ':
+        yield from iter_mbox_messages(fileobj, name)
+    elif size > EMAIL_BULK_MAX_MESSAGE_BYTES:
+        yield name, None, f"Mensagem maior que {EMAIL_BULK_MAX_MESSAGE_BYTES} bytes"
+    else:
+        yield name, fileobj.read(), None
+
+def _is_maildir_tmp(name: str) -> bool:
+    # Mensagens em tmp/ ainda estão sendo entregues e não fazem parte da caixa
+    return 'tmp' in name.replace('\\', '/').split('/')[:-1]
+
+def iter_mailbox_messages(fileobj, fmt: str):
+    if fmt == 'zip':
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or _is_maildir_tmp(info.filename):
+                    continue
+                with archive.open(info) as member:
+                    yield from _iter_archive_member(info.filename, info.file_size, member)
+    elif fmt == 'tar':
+        # Modo de fluxo ('r|*'): os membros são lidos na ordem do arquivo, sem busca
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for info in archive:
+                if not info.isfile() or _is_maildir_tmp(info.name):
+                    continue
+                yield from _iter_archive_member(info.name, info.size, archive.extractfile(info))
+    elif fmt == 'mbox':
+        yield from iter_mbox_messages(fileobj)
+    else:
+        yield "", fileobj.read(EMAIL_BULK_MAX_MESSAGE_BYTES + 1), None
+
+def detect_mailbox_format(fileobj, filename: str = "") -> str:
+    head = fileobj.read(512)
+    fileobj.seek(0)
+    name = (filename or "").lower()
+    if head.startswith(b'PK\x03\x04') or name.endswith('.zip'):
+        return 'zip'
+    if head.startswith(b'\x1f\x8b') or head.startswith(b'BZh') or head[257:262] == b'ustar' or '.tar' in name:
+        return 'tar'
+    if head.startswith(b'From ') or name.endswith('.mbox'):
+        return 'mbox'
+    return 'eml'
+
+def analyze_email_batch(entries: list) -> list:
+    # Executado no pool de processos: (índice, origem, bytes, erro) -> resultado por mensagem
+    results = []
+    for index, source, raw, error in entries:
+        if error is None and len(raw) > EMAIL_BULK_MAX_MESSAGE_BYTES:
+            error = f"Mensagem maior que {EMAIL_BULK_MAX_MESSAGE_BYTES} bytes"
+        result = {'type': 'message', 'index': index, 'source': source, 'size': len(raw) if raw is not None else None}
+        result.update({'error': error} if error else analyze_email_forensics(raw))
+        results.append(result)
+    return results
+
+def stream_email_forensics(fileobj, fmt: str):
+    # As mensagens são agrupadas em tarefas para o pool de processos, com no máximo
+    # EMAIL_BULK_INFLIGHT_PER_WORKER tarefas por processo em andamento; os resultados saem em
+    # NDJSON na ordem da caixa, seguidos de uma linha de resumo.
+    started = time.perf_counter()
+    pool = get_analysis_pool()
+    max_inflight = EMAIL_BULK_INFLIGHT_PER_WORKER * ANALYSIS_PROCESS_WORKERS
+    pending = collections.deque()
+    summary = {'type': 'summary', 'format': fmt, 'messages': 0, 'errors': 0, 'attachments': 0, 'attachment_bytes': 0,
+               'attachments_deduplicated': 0, 'bytes_saved': 0}
+    batch, batch_bytes = [], 0
+
+    def drain(limit: int):
+        while len(pending) > limit:
+            for result in pending.popleft().result():
+                summary['messages'] += 1
+                if 'error' in result:
+                    summary['errors'] += 1
+                    EMAIL_BULK_MESSAGES.labels('error').inc()
+                else:
+                    EMAIL_BULK_MESSAGES.labels('ok').inc()
+                    summary['attachments'] += len(result['Attachments'])
+                    summary['attachment_bytes'] += sum(item['size'] for item in result['Attachments'])
+                    hits, saved = record_attachment_store_stats(result['Attachments'])
+                    summary['attachments_deduplicated'] += hits
+                    summary['bytes_saved'] += saved
+                yield json.dumps(result, ensure_ascii=False, default=str) + "\n"
+
+    try:
+        for index, (source, raw, error) in enumerate(iter_mailbox_messages(fileobj, fmt)):
+            batch.append((index, source, raw, error))
+            batch_bytes += len(raw) if raw is not None else 0
+            if len(batch) >= EMAIL_BULK_BATCH_MESSAGES or batch_bytes >= EMAIL_BULK_BATCH_BYTES:
+                pending.append(pool.submit(analyze_email_batch, batch))
+                batch, batch_bytes = [], 0
+                yield from drain(max_inflight - 1)
+        if batch:
+            pending.append(pool.submit(analyze_email_batch, batch))
+        yield from drain(0)
+    except Exception as e:
+        logger.error(f"❌ Erro na análise de e-mails em lote: {e}")
+        summary['error'] = str(e)
+    finally:
+        for future in pending:
+            future.cancel()
+        fileobj.close()
+    summary['elapsed'] = round(time.perf_counter() - started, 3)
+    EMAIL_BULK_SECONDS.observe(summary['elapsed'])
+    logger.info(f"📧 Análise em lote ({fmt}): {summary['messages']} mensagens, {summary['errors']} erros "
+                f"em {summary['elapsed']:.2f}s")
+    yield json.dumps(summary, ensure_ascii=False) + "\n"
+
+@app.route('/email_forensics/bulk', methods=['POST'])
+def email_forensics_bulk():
+    # Caixa inteira em 'mailbox_file' (multipart) ou no corpo bruto: mbox, zip/tar de maildir ou
+    # de arquivos .eml; o formato vem de ?format= ou é detectado pelo conteúdo
+    upload = request.files.get('mailbox_file') or request.files.get('email_file')
+    if upload is None and not _request_has_body():
+        return jsonify({'error': 'Arquivo de caixa de e-mail não fornecido'}), 400
+    # Formato explícito é validado antes de copiar o corpo
+    fmt = request.args.get('format')
+    if fmt and fmt not in EMAIL_BULK_FORMATS:
+        return jsonify({'error': f'Formato não suportado: {fmt}'}), 400
+    # O upload vai para um arquivo temporário próprio, não para a memória: o zip precisa de busca
+    # e os arquivos do multipart são fechados quando a view retorna, antes do streaming
+    fileobj = tempfile.TemporaryFile()
+    try:
+        shutil.copyfileobj(upload.stream if upload is not None else request.stream, fileobj, EMAIL_BULK_COPY_BYTES)
+        fileobj.seek(0)
+        fmt = fmt or detect_mailbox_format(fileobj, upload.filename if upload is not None else "")
+    except Exception:
+        fileobj.close()
+        raise
+    return streamed_text_response(stream_email_forensics(fileobj, fmt), mimetype='application/x-ndjson')
+
+# ===== Motor de UBA (colunar, modelos persistentes por tenant/entidade) =====
+UBA_MODEL_DIR = os.environ.get("UBA_MODEL_DIR", os.path.join(CACHE_DIR, "uba_models"))
+UBA_CONTAMINATION = 0.1
+UBA_N_ESTIMATORS = 100
+UBA_N_JOBS = -1  # árvores treinadas e avaliadas em todos os núcleos
+UBA_RANDOM_STATE = 42
+UBA_RESERVOIR_SIZE = 50000  # amostra uniforme dos registros vistos, usada no retreino
+UBA_RETRAIN_INTERVAL = 3600  # idade mínima do modelo antes de um retreino
+UBA_RETRAIN_MIN_RECORDS = 10000  # registros novos desde o último treino antes de um retreino
+UBA_STREAM_CHUNK_ROWS = 50000  # linhas por bloco no modo streaming; sem modelo, o primeiro bloco treina
+UBA_STREAM_COPY_BYTES = 1024 * 1024
+UBA_STREAM_FORMATS = {'application/x-ndjson': 'ndjson', 'application/jsonl': 'ndjson', 'application/json-seq': 'ndjson',
+                      'text/csv': 'csv'}
+
+UBA_RECORDS = Counter('uba_records_total', 'Registros processados pelo motor de UBA', ['operation'])
+UBA_SECONDS = Histogram('uba_operation_seconds', 'Duração das operações do motor de UBA', ['operation'],
+                        buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+UBA_RETRAINS = Counter('uba_retrains_total', 'Retreinos periódicos dos modelos de UBA', ['result'])
+
+def uba_column(values) -> np.ndarray:
+    # Numérico vira float64 (None -> NaN); o resto vira texto e é tratado como categoria
+    array = np.asarray(values)
+    if array.dtype.kind in 'biuf':
+        return array.astype(np.float64)
+    if array.dtype.kind == 'O':
+        try:
+            return np.asarray(values, dtype=np.float64)
+        except (TypeError, ValueError):
+            pass
+    if array.dtype.kind == 'U':
+        # Texto numérico (CSV, JSON com números entre aspas); vazio vira NaN
+        try:
+            return np.where(array == '', 'nan', array).astype(np.float64)
+        except ValueError:
+            pass
+    return array.astype(str)
+
+def uba_columns(payload) -> tuple:
+    # Aceita a lista de registros original, {"records": [...]} ou o formato colunar
+    # {"columns": {"campo": [valores]}}, que vai direto para os arrays sem passar por dicts.
+    # Retorna (colunas, número de linhas).
+    if isinstance(payload, dict) and 'columns' in payload:
+        raw = payload['columns']
+    else:
+        records = payload.get('records') if isinstance(payload, dict) else payload
+        if not records:
+            return {}, 0
+        raw = {key: [record.get(key) for record in records] for key in records[0]}
+    columns = {name: uba_column(values) for name, values in raw.items()}
+    lengths = {len(column) for column in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError("As colunas têm tamanhos diferentes")
+    return columns, lengths.pop() if lengths else 0
+
+def _uba_model_filename(tenant: str, entity: str) -> str:
+    return re.sub(r'[^\w.-]', '_', f"{tenant}__{entity}") + ".joblib"
+
+def _uba_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def uba_numeric(column: np.ndarray) -> np.ndarray:
+    # Coluna como float64 para um campo numérico do modelo; um valor que não é número vira NaN
+    # (tratado como ausente) sem descartar o resto da coluna
+    if column.dtype.kind == 'f':
+        return column
+    try:
+        return column.astype(np.float64)
+    except (TypeError, ValueError):
+        return np.fromiter((_uba_float(value) for value in column), dtype=np.float64, count=len(column))
+
+class UBAModel:
+    # IsolationForest sobre colunas numéricas (NaN -> mediana do treino) e categóricas
+    # (codificadas pela frequência da categoria no treino; categoria nunca vista = 0, o que a
+    # torna rara). Mantém um reservatório dos registros pontuados para o retreino periódico.
+    def __init__(self, tenant: str, entity: str):
+        self.tenant = tenant
+        self.entity = entity
+        self.numeric = []
+        self.categorical = []
+        self.medians = {}
+        self.frequencies = {}
+        self.forest = None
+        self.trained_at = None
+        self.trained_rows = 0
+        self.reservoir = {}
+        self.reservoir_rows = 0
+        self.seen = 0
+        self.since_fit = 0
+        self._rng = np.random.default_rng(UBA_RANDOM_STATE)
+        self._lock = threading.Lock()
+
+    @property
+    def features(self) -> list:
+        return self.numeric + self.categorical
+
+    def fit(self, columns: dict, n: int) -> 'UBAModel':
+        self.numeric = [name for name, column in columns.items() if column.dtype.kind == 'f']
+        self.categorical = [name for name, column in columns.items() if column.dtype.kind != 'f']
+        if not self.features:
+            raise ValueError("Nenhum campo para treinar o modelo")
+        for name in self.numeric:
+            median = np.nanmedian(columns[name]) if not np.isnan(columns[name]).all() else 0.0
+            self.medians[name] = float(median)
+        for name in self.categorical:
+            categories, counts = np.unique(columns[name].astype(str), return_counts=True)
+            self.frequencies[name] = (categories, counts / n)
+        X = self.encode(columns, n)
+        self.forest = lazy_import('sklearn.ensemble').IsolationForest(
+            n_estimators=UBA_N_ESTIMATORS, contamination=UBA_CONTAMINATION, random_state=UBA_RANDOM_STATE,
+            n_jobs=UBA_N_JOBS).fit(X)
+        self.trained_at = time.time()
+        self.trained_rows = n
+        self.since_fit = 0
+        return self
+
+    def encode(self, columns: dict, n: int) -> np.ndarray:
+        # Matriz float32 (o tipo usado internamente pelas árvores), preenchida coluna a coluna
+        X = np.empty((n, len(self.features)), dtype=np.float32)
+        for j, name in enumerate(self.numeric):
+            column = columns.get(name)
+            if column is None:
+                X[:, j] = self.medians[name]
+                continue
+            column = uba_numeric(column)
+            X[:, j] = np.where(np.isnan(column), self.medians[name], column)
+        for j, name in enumerate(self.categorical, len(self.numeric)):
+            column = columns.get(name)
+            categories, frequencies = self.frequencies[name]
+            if column is None or not len(categories):
+                X[:, j] = 0.0
+                continue
+            column = column.astype(str)
+            positions = np.minimum(np.searchsorted(categories, column), len(categories) - 1)
+            X[:, j] = np.where(categories[positions] == column, frequencies[positions], 0.0)
+        return X
+
+    def score(self, columns: dict, n: int) -> tuple:
+        # decision_function < 0 é exatamente o critério de predict(); evita avaliar as árvores duas vezes
+        scores = self.forest.decision_function(self.encode(columns, n))
+        return scores, scores < 0
+
+    def observe(self, columns: dict, n: int) -> None:
+        # Amostragem de reservatório (Algoritmo R) vetorizada: cada registro visto tem a mesma
+        # chance de estar na amostra usada pelo retreino
+        with self._lock:
+            columns = {name: uba_numeric(column) if name in self.numeric else column
+                       for name, column in columns.items() if name in self.features}
+            if not self.reservoir:
+                self.reservoir = {name: np.empty(UBA_RESERVOIR_SIZE, dtype=np.float64 if name in self.numeric else object)
+                                  for name in self.features}
+            fill = min(n, UBA_RESERVOIR_SIZE - self.reservoir_rows)
+            if fill > 0:
+                for name, column in self.reservoir.items():
+                    source = columns.get(name)
+                    column[self.reservoir_rows:self.reservoir_rows + fill] = (
+                        source[:fill] if source is not None else (np.nan if name in self.numeric else ''))
+                self.reservoir_rows += fill
+            positions = self.seen + np.arange(fill, n)
+            accepted = np.nonzero(self._rng.random(n - fill) * (positions + 1) < UBA_RESERVOIR_SIZE)[0] + fill
+            if len(accepted):
+                slots = self._rng.integers(0, UBA_RESERVOIR_SIZE, len(accepted))
+                for name, column in self.reservoir.items():
+                    source = columns.get(name)
+                    column[slots] = source[accepted] if source is not None else (np.nan if name in self.numeric else '')
+            self.seen += n
+            self.since_fit += n
+
+    def reservoir_columns(self) -> tuple:
+        with self._lock:
+            return ({name: column[:self.reservoir_rows].copy() for name, column in self.reservoir.items()},
+                    self.reservoir_rows)
+
+    def needs_retrain(self) -> bool:
+        return (self.since_fit >= UBA_RETRAIN_MIN_RECORDS and self.reservoir_rows
+                and time.time() - self.trained_at >= UBA_RETRAIN_INTERVAL)
+
+    def summary(self) -> dict:
+        return {
+            'tenant': self.tenant,
+            'entity': self.entity,
+            'features': {'numeric': self.numeric, 'categorical': self.categorical},
+            'trained_at': self.trained_at,
+            'trained_rows': self.trained_rows,
+            'records_since_training': self.since_fit
+        }
+
+    def to_state(self) -> dict:
+        with self._lock:
+            state = {key: value for key, value in self.__dict__.items() if key not in ('_lock', '_rng')}
+            state['reservoir'] = {name: column[:self.reservoir_rows].copy() for name, column in self.reservoir.items()}
+        return state
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'UBAModel':
+        model = cls(state['tenant'], state['entity'])
+        model.__dict__.update(state)
+        model.reservoir = {}
+        reservoir_rows, model.reservoir_rows = model.reservoir_rows, 0
+        if reservoir_rows:
+            seen, since_fit = model.seen, model.since_fit
+            model.seen = 0
+            model.observe(state['reservoir'], reservoir_rows)
+            model.seen, model.since_fit = seen, since_fit
+        return model
+
+class UBAModelStore:
+    # Modelos em memória e em disco (joblib), um por tenant/entidade. Requisições só pontuam;
+    # o treino acontece na primeira carga (ou quando pedido) e o retreino roda em segundo plano.
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._models = {}
+        self._retraining = set()
+        self._lock = threading.Lock()
+
+    def _path(self, tenant: str, entity: str) -> str:
+        return os.path.join(self.directory, _uba_model_filename(tenant, entity))
+
+    def get(self, tenant: str, entity: str):
+        key = (tenant, entity)
+        with self._lock:
+            model = self._models.get(key)
+        if model is None and os.path.exists(self._path(tenant, entity)):
+            model = UBAModel.from_state(lazy_import('joblib').load(self._path(tenant, entity)))
+            with self._lock:
+                model = self._models.setdefault(key, model)
+        return model
+
+    def fit(self, tenant: str, entity: str, columns: dict, n: int) -> UBAModel:
+        started = time.perf_counter()
+        model = UBAModel(tenant, entity).fit(columns, n)
+        model.observe(columns, n)
+        model.since_fit = 0
+        UBA_SECONDS.labels('fit').observe(time.perf_counter() - started)
+        UBA_RECORDS.labels('fit').inc(n)
+        self.save(model)
+        return model
+
+    def save(self, model: UBAModel) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(model.tenant, model.entity)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        lazy_import('joblib').dump(model.to_state(), temporary)
+        os.replace(temporary, path)
+        with self._lock:
+            self._models[(model.tenant, model.entity)] = model
+
+    def maybe_retrain(self, model: UBAModel) -> bool:
+        key = (model.tenant, model.entity)
+        with self._lock:
+            if key in self._retraining or not model.needs_retrain():
+                return False
+            self._retraining.add(key)
+        threading.Thread(target=self._retrain, args=(model,), name=f"uba-retrain-{model.entity}", daemon=True).start()
+        return True
+
+    def _retrain(self, model: UBAModel) -> None:
+        # Novo modelo treinado no reservatório (histórico + registros recentes), com o mesmo
+        # esquema; substitui o atual só quando estiver pronto
+        started = time.perf_counter()
+        try:
+            retrained = UBAModel.from_state(model.to_state())
+            columns, n = retrained.reservoir_columns()
+            retrained.fit(columns, n)
+            self.save(retrained)
+            UBA_RETRAINS.labels('ok').inc()
+            logger.info(f"🔁 Modelo de UBA {model.tenant}/{model.entity} retreinado com {n} registros "
+                        f"em {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            UBA_RETRAINS.labels('error').inc()
+            logger.error(f"❌ Erro ao retreinar o modelo de UBA {model.tenant}/{model.entity}: {e}")
+        finally:
+            UBA_SECONDS.labels('retrain').observe(time.perf_counter() - started)
+            with self._lock:
+                self._retraining.discard((model.tenant, model.entity))
+
+uba_models = UBAModelStore(UBA_MODEL_DIR)
+
+def analyze_user_behavior(user_data, tenant: str = "default", entity: str = "default", train: str = "auto") -> dict:
+    # train: 'auto' treina só se ainda não houver modelo, 'true' treina de novo com estes dados e
+    # 'false' apenas pontua
     result = {}
     try:
-        if not user_data:
+        columns, n = uba_columns(user_data)
+        if not n:
             return {"error": "Nenhum dado de usuário fornecido"}
-        keys = list(user_data[0].keys())
-        X = np.array([[record[k] for k in keys] for record in user_data])
-        model_uba = IsolationForest(contamination=0.1, random_state=42)
-        model_uba.fit(X)
-        scores = model_uba.decision_function(X)
-        anomalies = model_uba.predict(X)
-        analysis = []
-        for i, record in enumerate(user_data):
-            record_analysis = record.copy()
-            record_analysis['anomaly_score'] = scores[i]
-            record_analysis['is_anomaly'] = anomalies[i] == -1
-            analysis.append(record_analysis)
-        result['analysis'] = analysis
+        model = uba_models.get(tenant, entity)
+        trained = train == 'true' or (model is None and train == 'auto')
+        if trained:
+            model = uba_models.fit(tenant, entity, columns, n)
+        elif model is None:
+            return {"error": f"Nenhum modelo treinado para {tenant}/{entity}"}
+        started = time.perf_counter()
+        scores, anomalies = model.score(columns, n)
+        UBA_SECONDS.labels('score').observe(time.perf_counter() - started)
+        UBA_RECORDS.labels('score').inc(n)
+        if not trained:
+            model.observe(columns, n)
+        retrain_scheduled = uba_models.maybe_retrain(model)
+        if isinstance(user_data, dict) and 'columns' in user_data:
+            result['analysis'] = {'anomaly_score': scores.tolist(), 'is_anomaly': anomalies.tolist()}
+        else:
+            records = user_data.get('records') if isinstance(user_data, dict) else user_data
+            result['analysis'] = [dict(record, anomaly_score=score, is_anomaly=anomaly)
+                                  for record, score, anomaly in zip(records, scores.tolist(), anomalies.tolist())]
+        result['anomalies'] = int(anomalies.sum())
+        result['model'] = dict(model.summary(), trained_now=trained, retrain_scheduled=retrain_scheduled)
     except Exception as e:
         result['error'] = str(e)
     return result
 
+def iter_ndjson_chunks(text):
+    # Blocos (linhas, colunas, tamanho, inválidas) com até UBA_STREAM_CHUNK_ROWS registros
+    rows, invalid = [], 0
+    for line in text:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            invalid += 1
+            continue
+        if not isinstance(record, dict):
+            invalid += 1
+            continue
+        rows.append(record)
+        if len(rows) >= UBA_STREAM_CHUNK_ROWS:
+            yield (rows, *uba_columns(rows), invalid)
+            rows, invalid = [], 0
+    if rows or invalid:
+        yield (rows, *uba_columns(rows), invalid)
+
+def _csv_chunk(header: list, rows: list, invalid: int) -> tuple:
+    columns = {name: uba_column(values) for name, values in zip(header, zip(*rows))} if rows else {}
+    return rows, columns, len(rows), invalid
+
+def _csv_line(values: list) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+def iter_csv_chunks(reader, header: list):
+    # Como iter_ndjson_chunks, para linhas CSV (linhas com número de campos diferente do cabeçalho são inválidas)
+    rows, invalid = [], 0
+    for row in reader:
+        if len(row) != len(header):
+            if any(row):
+                invalid += 1
+            continue
+        rows.append(row)
+        if len(rows) >= UBA_STREAM_CHUNK_ROWS:
+            yield _csv_chunk(header, rows, invalid)
+            rows, invalid = [], 0
+    if rows or invalid:
+        yield _csv_chunk(header, rows, invalid)
+
+class UBAStreamRejected(Exception):
+    # Pedido de streaming recusado antes de a resposta começar (vira 4xx na rota)
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+def open_user_behavior_stream(spool, fmt: str, tenant: str, entity: str, train: str) -> tuple:
+    # Validações que precisam acontecer antes do status 200: cabeçalho CSV e existência do modelo.
+    # Devolve (texto, leitor CSV, cabeçalho, modelo salvo ou None).
+    text = io.TextIOWrapper(spool, encoding='utf-8', errors='replace', newline='')
+    reader = header = None
+    if fmt == 'csv':
+        reader = csv.reader(text)
+        header = next(reader, None)
+        if not header or not any(name.strip() for name in header):
+            raise UBAStreamRejected("CSV sem cabeçalho")
+        if len(set(header)) != len(header):
+            raise UBAStreamRejected("Cabeçalho CSV com colunas repetidas")
+    model = uba_models.get(tenant, entity) if train != 'true' else None
+    if model is None and train == 'false':
+        raise UBAStreamRejected(f"Nenhum modelo treinado para {tenant}/{entity}", 409)
+    if model is not None and header is not None and not set(model.features) & set(header):
+        raise UBAStreamRejected(f"Cabeçalho CSV sem nenhum campo do modelo ({', '.join(model.features)})")
+    return text, reader, header, model
+
+def stream_user_behavior(spool, fmt: str, tenant: str = "default", entity: str = "default", train: str = "auto",
+                         only_anomalies: bool = False, opened: tuple = None):
+    # O corpo já está em disco: cada bloco vira colunas, é pontuado e enviado antes de o próximo
+    # ser lido, então a memória não cresce com a entrada. Sem modelo salvo (ou com train=true)
+    # o primeiro bloco treina o modelo, e o reservatório continua recebendo o restante.
+    # opened é o resultado de open_user_behavior_stream, já validado pela rota. Um erro depois
+    # do início termina a saída com uma linha de erro (NDJSON) ou a linha '#error' (CSV).
+    total = anomalies_total = invalid_total = 0
+    model = None
+    trained = False
+    started = time.perf_counter()
+    try:
+        text, reader, header, saved_model = opened or open_user_behavior_stream(spool, fmt, tenant, entity, train)
+        chunks = iter_ndjson_chunks(text) if reader is None else iter_csv_chunks(reader, header)
+        for rows, columns, n, invalid in chunks:
+            invalid_total += invalid
+            if not n:
+                continue
+            fitted = False
+            if model is None:
+                model = saved_model
+                trained = fitted = train == 'true' or (model is None and train == 'auto')
+                if trained:
+                    model = uba_models.fit(tenant, entity, columns, n)
+                elif model is None:
+                    raise ValueError(f"Nenhum modelo treinado para {tenant}/{entity}")
+                if reader is not None:
+                    yield _csv_line(header + ['anomaly_score', 'is_anomaly'])
+            if not fitted:
+                model.observe(columns, n)
+            chunk_started = time.perf_counter()
+            scores, anomalies = model.score(columns, n)
+            UBA_SECONDS.labels('score').observe(time.perf_counter() - chunk_started)
+            UBA_RECORDS.labels('score').inc(n)
+            total += n
+            anomalies_total += int(anomalies.sum())
+            selected = np.nonzero(anomalies)[0] if only_anomalies else range(n)
+            scores, anomalies = scores.tolist(), anomalies.tolist()
+            if reader is None:
+                yield "".join(json.dumps(dict(rows[i], anomaly_score=scores[i], is_anomaly=anomalies[i]),
+                                         ensure_ascii=False) + "\n" for i in selected)
+            else:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(rows[i] + [scores[i], anomalies[i]] for i in selected)
+                yield buffer.getvalue()
+        retrain_scheduled = uba_models.maybe_retrain(model) if model is not None else False
+        logger.info(f"📊 UBA em streaming: {total} registros, {anomalies_total} anomalias, {invalid_total} linhas "
+                    f"inválidas em {time.perf_counter() - started:.2f}s")
+        if reader is None:
+            summary = {'type': 'summary', 'records': total, 'anomalies': anomalies_total, 'invalid_rows': invalid_total}
+            if model is not None:
+                summary['model'] = dict(model.summary(), trained_now=trained, retrain_scheduled=retrain_scheduled)
+            yield json.dumps(summary, ensure_ascii=False) + "\n"
+    except Exception as e:
+        logger.error(f"❌ Erro na análise de UBA em streaming: {e}")
+        if fmt != 'csv':
+            yield json.dumps({'type': 'error', 'error': str(e), 'records': total}, ensure_ascii=False) + "\n"
+        else:
+            # Marca o fim incompleto: a saída não termina em silêncio no meio dos dados
+            yield _csv_line(['#error', f"{e} (após {total} registros)"])
+    finally:
+        spool.close()
+
 @app.route('/user_behavior', methods=['POST'])
 def user_behavior():
+    tenant = request.args.get('tenant', 'default')
+    entity = request.args.get('entity', 'default')
+    train = request.args.get('train', 'auto').lower()
+    fmt = request.args.get('format') or UBA_STREAM_FORMATS.get(request.mimetype)
     try:
+        if fmt in ('ndjson', 'csv'):
+            # Streaming: o corpo vai para um arquivo temporário (não para a memória) e as linhas
+            # pontuadas voltam em blocos; only_anomalies=true devolve só as anomalias
+            spool = tempfile.TemporaryFile()
+            shutil.copyfileobj(request.stream, spool, UBA_STREAM_COPY_BYTES)
+            spool.seek(0)
+            only_anomalies = request.args.get('only_anomalies', 'false').lower() == 'true'
+            try:
+                opened = open_user_behavior_stream(spool, fmt, tenant, entity, train)
+            except UBAStreamRejected as e:
+                spool.close()
+                return jsonify({'error': str(e)}), e.status
+            return streamed_text_response(
+                stream_user_behavior(spool, fmt, tenant, entity, train, only_anomalies, opened),
+                mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson')
         user_data = request.get_json()
         if not user_data:
             return jsonify({'error': 'Nenhum dado de usuário fornecido'}), 400
-        analysis = analyze_user_behavior(user_data)
+        analysis = analyze_user_behavior(user_data, tenant, entity, train)
         return jsonify(analysis)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ===== Pool de Processos para Análises Pesadas =====
+ANALYSIS_PROCESS_WORKERS = max(1, psutil.cpu_count(logical=True) or 1)
+_analysis_pool = None
+_analysis_pool_lock = threading.Lock()
+
+def get_analysis_pool() -> concurrent.futures.ProcessPoolExecutor:
+    # Pool de longa duração, criado no primeiro uso e compartilhado entre as requisições
+    global _analysis_pool
+    with _analysis_pool_lock:
+        if _analysis_pool is None:
+            _analysis_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=ANALYSIS_PROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _analysis_pool
+
 # ===== Função para Análise de Logs e Integração com SIEM =====
+SIEM_PARALLEL_MIN_BYTES = 32 * 1024 * 1024  # Abaixo disso o arquivo é lido num único processo
+SIEM_SAMPLE_LINES = 5
+SIEM_TOP_TEMPLATES = 10
+SIEM_TEMPLATE_CAPACITY = 2000  # Templates distintos mantidos; acima disso as contagens são aproximadas
+SIEM_TEMPLATE_MAX_CHARS = 200
+SIEM_MAX_TIME_BUCKETS = 10000  # Buckets de hora mantidos; o excedente é contado à parte
+
+# Aplicado à linha em maiúsculas (mais rápido que re.IGNORECASE); o primeiro nível encontrado vale
+SIEM_LEVEL_PATTERN = re.compile(r'\b(TRACE|DEBUG|INFO|NOTICE|WARN(?:ING)?|ERR(?:OR)?|CRIT(?:ICAL)?|FATAL|ALERT|EMERG(?:ENCY)?)\b')
+SIEM_LEVEL_ALIASES = {'WARN': 'WARNING', 'ERR': 'ERROR', 'CRIT': 'CRITICAL', 'EMERGENCY': 'EMERG'}
+# ISO 8601 (2024-05-01T12:34) ou syslog (May  1 12:34:56), procurado só no início da linha
+SIEM_TIMESTAMP_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})[T ](\d{2}):\d{2}(?::\d{2}(?:[.,]\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?'
+                                    r'|\b([A-Z][a-z]{2}) +(\d{1,2}) (\d{2}):\d{2}:\d{2}')
+SIEM_TIMESTAMP_WINDOW = 64
+# Palavras com dígitos (IPs, ids, hexadecimais, números) viram <*> para agrupar mensagens em templates
+SIEM_VARIABLE_PATTERN = re.compile(r'(?<!\S)\S*\d\S*')
+
+class LogAggregates:
+    # Agregados de memória limitada; instâncias de partes diferentes do arquivo são combinadas com merge()
+    def __init__(self):
+        self.total_lines = 0
+        self.error_count = 0
+        self.warning_count = 0
+        self.sample_lines = []
+        self.levels = collections.Counter()
+        self.templates = collections.Counter()
+        self.time_buckets = collections.Counter()
+        self.time_buckets_overflow = 0
+
+    def add_line(self, line: str) -> None:
+        self.total_lines += 1
+        if len(self.sample_lines) < SIEM_SAMPLE_LINES:
+            self.sample_lines.append(line)
+        # Mesma contagem dos campos legados (ocorrências de ERROR|error e WARNING|warning)
+        self.error_count += line.count('ERROR') + line.count('error')
+        self.warning_count += line.count('WARNING') + line.count('warning')
+        level = SIEM_LEVEL_PATTERN.search(line.upper())
+        if level:
+            level = level.group(1)
+            self.levels[SIEM_LEVEL_ALIASES.get(level, level)] += 1
+        else:
+            self.levels['UNKNOWN'] += 1
+        timestamp = SIEM_TIMESTAMP_PATTERN.search(line, 0, SIEM_TIMESTAMP_WINDOW)
+        message = line
+        if timestamp:
+            if timestamp.group(1):
+                bucket = f"{timestamp.group(1)} {timestamp.group(2)}:00"
+            else:
+                bucket = f"{timestamp.group(3)} {int(timestamp.group(4)):02d} {timestamp.group(5)}:00"
+            self._count_bucket(bucket, 1)
+            message = line[timestamp.end():]
+        template = SIEM_VARIABLE_PATTERN.sub('<*>', message.strip()[:SIEM_TEMPLATE_MAX_CHARS])
+        self.templates[template] += 1
+        if len(self.templates) > 2 * SIEM_TEMPLATE_CAPACITY:
+            self._prune_templates()
+
+    def _count_bucket(self, bucket: str, count: int) -> None:
+        if bucket in self.time_buckets or len(self.time_buckets) < SIEM_MAX_TIME_BUCKETS:
+            self.time_buckets[bucket] += count
+        else:
+            self.time_buckets_overflow += count
+
+    def _prune_templates(self) -> None:
+        self.templates = collections.Counter(dict(self.templates.most_common(SIEM_TEMPLATE_CAPACITY)))
+
+    def merge(self, other: 'LogAggregates') -> None:
+        # other deve cobrir a parte seguinte do arquivo (mantém as primeiras linhas como amostra)
+        self.total_lines += other.total_lines
+        self.error_count += other.error_count
+        self.warning_count += other.warning_count
+        self.sample_lines.extend(other.sample_lines[:SIEM_SAMPLE_LINES - len(self.sample_lines)])
+        self.levels.update(other.levels)
+        self.templates.update(other.templates)
+        if len(self.templates) > 2 * SIEM_TEMPLATE_CAPACITY:
+            self._prune_templates()
+        for bucket, count in other.time_buckets.items():
+            self._count_bucket(bucket, count)
+        self.time_buckets_overflow += other.time_buckets_overflow
+
+    def to_dict(self) -> dict:
+        return {
+            'error_count': self.error_count,
+            'warning_count': self.warning_count,
+            'total_lines': self.total_lines,
+            'sample_lines': self.sample_lines,
+            'level_counts': dict(self.levels.most_common()),
+            'top_templates': [{'template': template, 'count': count}
+                              for template, count in self.templates.most_common(SIEM_TOP_TEMPLATES)],
+            'time_buckets': dict(sorted(self.time_buckets.items())),
+            'time_buckets_overflow': self.time_buckets_overflow
+        }
+
+def _aggregate_lines(lines) -> LogAggregates:
+    aggregates = LogAggregates()
+    for raw in lines:
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8', errors='replace')
+        aggregates.add_line(raw.rstrip('\r\n'))
+    return aggregates
+
+def _analyze_log_range(path: str, start: int, end: int) -> LogAggregates:
+    # Processa as linhas que começam em [start, end); a linha que atravessa o início
+    # pertence ao trecho anterior, que lê até o fim dela.
+    aggregates = LogAggregates()
+    with open(path, 'rb') as f:
+        position = start
+        if start:
+            f.seek(start - 1)
+            position = start - 1 + len(f.readline())
+        while position < end:
+            raw = f.readline()
+            if not raw:
+                break
+            position += len(raw)
+            aggregates.add_line(raw.decode('utf-8', errors='replace').rstrip('\r\n'))
+    return aggregates
+
+def analyze_log_file(path: str) -> dict:
+    start_time = time.time()
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    chunks = 1
+    if compressed:
+        # gzip não permite acesso aleatório: descompacta em streaming num único processo
+        with gzip.open(path, 'rb') as f:
+            aggregates = _aggregate_lines(f)
+    elif size < SIEM_PARALLEL_MIN_BYTES or ANALYSIS_PROCESS_WORKERS == 1:
+        aggregates = _analyze_log_range(path, 0, size)
+    else:
+        chunks = ANALYSIS_PROCESS_WORKERS
+        bounds = [size * i // chunks for i in range(chunks + 1)]
+        pool = get_analysis_pool()
+        futures = [pool.submit(_analyze_log_range, path, bounds[i], bounds[i + 1]) for i in range(chunks)]
+        aggregates = LogAggregates()
+        for future in futures:
+            aggregates.merge(future.result())
+    result = aggregates.to_dict()
+    result['bytes'] = size
+    result['compressed'] = compressed
+    result['chunks'] = chunks
+    result['elapsed'] = round(time.time() - start_time, 3)
+    return result
+
 def analyze_logs_for_siem(logs: str) -> dict:
-    result = {}
     try:
-        error_pattern = re.compile(r'ERROR|error')
-        warning_pattern = re.compile(r'WARNING|warning')
-        errors = error_pattern.findall(logs)
-        warnings = warning_pattern.findall(logs)
-        result['error_count'] = len(errors)
-        result['warning_count'] = len(warnings)
-        result['total_lines'] = len(logs.splitlines())
-        result['sample_lines'] = logs.splitlines()[:5]
+        return _aggregate_lines(io.StringIO(logs)).to_dict()
     except Exception as e:
-        result['error'] = str(e)
-    return result
+        return {'error': str(e)}
 
 @app.route('/log_analysis', methods=['POST'])
 def log_analysis():
+    # Aceita o texto no campo 'logs' ou um arquivo (texto ou .gz) no campo 'log_file'
+    upload = request.files.get('log_file')
+    if upload:
+        fd, path = tempfile.mkstemp(prefix='siem_', suffix='.log')
+        os.close(fd)
+        try:
+            upload.save(path)
+            analysis = analyze_log_file(path)
+        except Exception as e:
+            logger.error(f"Erro na análise de logs: {e}")
+            analysis = {'error': str(e)}
+        finally:
+            os.remove(path)
+        return jsonify(analysis)
     logs = request.form.get('logs', '')
     if not logs:
         return jsonify({'error': 'Nenhum log fornecido'}), 400
@@ -1571,9 +5798,15 @@ NETWORK_REGEX_PATTERNS = {
     "DOMINIO_SUSPEITO": re.compile(r"\b[a-z0-9.-]+\.(ru|cn|tk|xyz|info)\b"),
     "USER_AGENT_SUSPEITO": re.compile(r"curl|python-requests|wget", re.IGNORECASE)
 }
+# User-Agents suspeitos não têm caractere obrigatório, então este scanner dispensa o pré-filtro
+NETWORK_INDICATOR_SCANNER = IndicatorScanner(NETWORK_REGEX_PATTERNS)
 
-def process_pcap(pcap_path):
+def process_pcap_pyshark(pcap_path):
+    # Implementação original via tshark, mantida para comparação (?engine=pyshark e benchmarks)
     try:
+        pyshark = lazy_import('pyshark', optional=True)
+        if pyshark is None:
+            return {"error": "pyshark não está instalado. A funcionalidade de análise de rede não está disponível."}
         cap = pyshark.FileCapture(pcap_path, only_summaries=True)
         protocol_count = {}
         ip_count = {}
@@ -1588,7 +5821,7 @@ def process_pcap(pcap_path):
             if hasattr(packet, 'source'):
                 ip = packet.source
                 ip_count[ip] = ip_count.get(ip, 0) + 1
-                if NETWORK_REGEX_PATTERNS["IP_SUSPEITO"].search(ip):
+                if "IP_SUSPEITO" in NETWORK_INDICATOR_SCANNER.kinds(ip):
                     alerts.append(f"⚠️ IP suspeito detectado: {ip}")
             if hasattr(packet, 'destination'):
                 ip = packet.destination
@@ -1598,7 +5831,7 @@ def process_pcap(pcap_path):
                 for port in ports:
                     port_count[port] = port_count.get(port, 0) + 1
             if hasattr(packet, 'info') and packet.info:
-                if NETWORK_REGEX_PATTERNS["USER_AGENT_SUSPEITO"].search(packet.info):
+                if "USER_AGENT_SUSPEITO" in NETWORK_INDICATOR_SCANNER.kinds(packet.info):
                     alerts.append(f"⚠️ User-Agent suspeito detectado: {packet.info}")
         cap.close()
         result = {
@@ -1612,19 +5845,617 @@ def process_pcap(pcap_path):
     except Exception as e:
         return {"error": str(e)}
 
+# ----- Motor nativo de PCAP (mmap + NumPy) -----
+PCAP_BLOCK_PACKETS = 262144  # Pacotes indexados e vetorizados por bloco
+PCAP_MAX_CAPLEN = 262144  # Acima disso o registro é considerado corrompido
+PCAP_COUNTER_CAPACITY = 50000  # Endereços/consultas distintos mantidos (contagem aproximada acima disso)
+PCAP_MAX_ALERTS = 100
+PCAP_TOP_N = 5
+
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6), b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9), b'\xa1\xb2\x3c\x4d': ('>', 1e-9)
+}
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAP_RAW_LINKTYPES = (12, 14, 101, 228, 229)
+PCAP_NULL_LINKTYPES = (0, 108)
+PCAP_IP_PROTOCOLS = {1: 'ICMP', 2: 'IGMP', 6: 'TCP', 17: 'UDP', 47: 'GRE', 50: 'ESP', 58: 'ICMPv6', 132: 'SCTP'}
+PCAP_TCP_PORTS = {20: 'FTP', 21: 'FTP', 22: 'SSH', 23: 'TELNET', 25: 'SMTP', 53: 'DNS', 80: 'HTTP', 110: 'POP', 143: 'IMAP',
+                  443: 'TLS', 445: 'SMB', 993: 'TLS', 995: 'TLS', 3306: 'MySQL', 3389: 'RDP', 5432: 'PGSQL', 8080: 'HTTP'}
+PCAP_UDP_PORTS = {53: 'DNS', 67: 'DHCP', 68: 'DHCP', 123: 'NTP', 137: 'NBNS', 161: 'SNMP', 443: 'QUIC', 514: 'Syslog',
+                  1900: 'SSDP', 5353: 'MDNS'}
+PCAP_PROTOCOL_NAMES = ['Outros', 'ARP', 'IPv4', 'IPv6'] + sorted(
+    set(PCAP_IP_PROTOCOLS.values()) | set(PCAP_TCP_PORTS.values()) | set(PCAP_UDP_PORTS.values()))
+_PCAP_CODES = {name: code for code, name in enumerate(PCAP_PROTOCOL_NAMES)}
+_pcap_ip_lookup = np.zeros(256, dtype=np.int64)
+for _number, _name in PCAP_IP_PROTOCOLS.items():
+    _pcap_ip_lookup[_number] = _PCAP_CODES[_name]
+_pcap_tcp_lookup = np.zeros(65536, dtype=np.int64)
+for _port, _name in PCAP_TCP_PORTS.items():
+    _pcap_tcp_lookup[_port] = _PCAP_CODES[_name]
+_pcap_udp_lookup = np.zeros(65536, dtype=np.int64)
+for _port, _name in PCAP_UDP_PORTS.items():
+    _pcap_udp_lookup[_port] = _PCAP_CODES[_name]
+# Primeiros 4 bytes de uma requisição HTTP, usados para pré-filtrar os pacotes com User-Agent
+PCAP_HTTP_PREFIXES = np.array([int.from_bytes(m, 'big') for m in
+                               (b'GET ', b'POST', b'HEAD', b'PUT ', b'DELE', b'OPTI', b'PATC', b'CONN')], dtype=np.int64)
+PCAP_USER_AGENT_HEADER = re.compile(rb'\r\nUser-Agent:[ \t]*([^\r\n]*)', re.IGNORECASE)
+
+PcapBlock = collections.namedtuple('PcapBlock', 'offsets caplens origlens linktypes')
+
+class PcapIndexer:
+    # Localiza os registros de pacotes de um pcap/pcapng. Guarda apenas o estado do formato
+    # (endianness, interfaces), então pode ser chamado repetidamente sobre um buffer que cresce.
+    def __init__(self):
+        self.format = None
+        self.endian = '<'
+        self.ts_scale = 1e-6
+        self.linktype = 1
+        self.interfaces = []
+        self.first_ts = None
+        self.last_ts = None
+
+    def index(self, buf, position: int, end: int, max_packets: int = PCAP_BLOCK_PACKETS) -> tuple:
+        # Retorna (PcapBlock, nova posição); para antes do primeiro registro incompleto
+        if self.format is None:
+            if end - position < 24:
+                return self._block([], [], [], []), position
+            magic = bytes(buf[position:position + 4])
+            if magic in PCAP_MAGIC:
+                self.format = 'pcap'
+                self.endian, self.ts_scale = PCAP_MAGIC[magic]
+                self.linktype = struct.unpack_from(self.endian + 'I', buf, position + 20)[0] & 0xFFFF
+                position += 24
+            elif magic == b'\x0a\x0d\x0d\x0a':
+                self.format = 'pcapng'
+            else:
+                raise ValueError("Formato de captura não reconhecido (esperado pcap ou pcapng)")
+        if self.format == 'pcap':
+            return self._index_pcap(buf, position, end, max_packets)
+        return self._index_pcapng(buf, position, end, max_packets)
+
+    def _block(self, offsets, caplens, origlens, linktypes) -> PcapBlock:
+        return PcapBlock(np.array(offsets, dtype=np.int64), np.array(caplens, dtype=np.int64),
+                         np.array(origlens, dtype=np.int64), np.array(linktypes, dtype=np.int64))
+
+    def _timestamp(self, ts: float) -> None:
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts
+
+    def _index_pcap(self, buf, position, end, max_packets):
+        header = struct.Struct(self.endian + 'IIII')
+        offsets, caplens, origlens = [], [], []
+        ts_sec = ts_frac = None
+        while len(offsets) < max_packets and position + 16 <= end:
+            ts_sec, ts_frac, caplen, origlen = header.unpack_from(buf, position)
+            if caplen > PCAP_MAX_CAPLEN:
+                raise ValueError(f"Registro PCAP corrompido no byte {position}")
+            if position + 16 + caplen > end:
+                break
+            if self.first_ts is None:
+                self._timestamp(ts_sec + ts_frac * self.ts_scale)
+            offsets.append(position + 16)
+            caplens.append(caplen)
+            origlens.append(origlen)
+            position += 16 + caplen
+        if offsets:
+            self._timestamp(ts_sec + ts_frac * self.ts_scale)
+        return self._block(offsets, caplens, origlens, [self.linktype] * len(offsets)), position
+
+    def _index_pcapng(self, buf, position, end, max_packets):
+        offsets, caplens, origlens, linktypes = [], [], [], []
+        while len(offsets) < max_packets and position + 12 <= end:
+            block_type = struct.unpack_from(self.endian + 'I', buf, position)[0]
+            if block_type == PCAPNG_SECTION_HEADER:
+                self.endian = '<' if bytes(buf[position + 8:position + 12]) == b'\x4d\x3c\x2b\x1a' else '>'
+                self.interfaces = []
+            block_len = struct.unpack_from(self.endian + 'I', buf, position + 4)[0]
+            if block_len < 12 or block_len % 4 or block_len > PCAP_MAX_CAPLEN + 64 * 1024:
+                raise ValueError(f"Bloco pcapng corrompido no byte {position}")
+            if position + block_len > end:
+                break
+            if block_type == 1:  # Interface Description Block
+                self.interfaces.append((struct.unpack_from(self.endian + 'H', buf, position + 8)[0],
+                                        self._ts_resolution(buf, position + 16, position + block_len - 4)))
+            elif block_type == 6:  # Enhanced Packet Block
+                interface, ts_high, ts_low, caplen, origlen = struct.unpack_from(self.endian + 'IIIII', buf, position + 8)
+                linktype, scale = self.interfaces[interface] if interface < len(self.interfaces) else (1, 1e-6)
+                offsets.append(position + 28)
+                caplens.append(min(caplen, block_len - 32))
+                origlens.append(origlen)
+                linktypes.append(linktype)
+                self._timestamp(((ts_high << 32) | ts_low) * scale)
+            elif block_type == 3:  # Simple Packet Block
+                origlen = struct.unpack_from(self.endian + 'I', buf, position + 8)[0]
+                offsets.append(position + 12)
+                caplens.append(min(origlen, block_len - 16))
+                origlens.append(origlen)
+                linktypes.append(self.interfaces[0][0] if self.interfaces else 1)
+            elif block_type == 2:  # Packet Block (obsoleto)
+                interface, _, ts_high, ts_low, caplen, origlen = struct.unpack_from(self.endian + 'HHIIII', buf, position + 8)
+                linktype, scale = self.interfaces[interface] if interface < len(self.interfaces) else (1, 1e-6)
+                offsets.append(position + 28)
+                caplens.append(min(caplen, block_len - 32))
+                origlens.append(origlen)
+                linktypes.append(linktype)
+                self._timestamp(((ts_high << 32) | ts_low) * scale)
+            position += block_len
+        return self._block(offsets, caplens, origlens, linktypes), position
+
+    def _ts_resolution(self, buf, position: int, end: int) -> float:
+        # Opção if_tsresol (código 9) do Interface Description Block; padrão em microssegundos
+        while position + 4 <= end:
+            code, length = struct.unpack_from(self.endian + 'HH', buf, position)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                value = buf[position + 4]
+                return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+            position += 4 + (length + 3) // 4 * 4
+        return 1e-6
+
+def _dns_query_name(payload: bytes):
+    # Nome da primeira pergunta de uma mensagem DNS (sem ponteiros de compressão)
+    labels = []
+    position = 12
+    while position < len(payload) and len(labels) < 128:
+        length = payload[position]
+        if length == 0:
+            return '.'.join(labels).lower() if labels else None
+        if length & 0xC0:
+            return None
+        labels.append(payload[position + 1:position + 1 + length].decode('ascii', errors='replace'))
+        position += 1 + length
+    return None
+
+def _prune_counter(counter: collections.Counter, capacity: int) -> collections.Counter:
+    if len(counter) > 2 * capacity:
+        return collections.Counter(dict(counter.most_common(capacity)))
+    return counter
+
+class PcapAggregates:
+    # Agregados de memória limitada calculados bloco a bloco com operações vetorizadas
+    def __init__(self):
+        self.total_packets = 0
+        self.total_bytes = 0
+        self.protocols = np.zeros(len(PCAP_PROTOCOL_NAMES), dtype=np.int64)
+        self.ports = np.zeros(65536, dtype=np.int64)
+        self.ipv4 = collections.Counter()
+        self.ipv6 = collections.Counter()
+        self.suspicious_sources = collections.Counter()
+        self.user_agents = collections.Counter()
+        self.dns_queries = collections.Counter()
+
+    def add_block(self, data: np.ndarray, block: PcapBlock) -> None:
+        offsets, caplens = block.offsets, block.caplens
+        n = len(offsets)
+        if n == 0:
+            return
+        self.total_packets += n
+        self.total_bytes += int(block.origlens.sum())
+        end = offsets + caplens
+
+        def field(rel, width, mask):
+            # Lê um campo big-endian de `width` bytes em offsets + rel onde mask e o tamanho capturado permitem
+            position = offsets + rel
+            valid = mask & (rel >= 0) & (position + width <= end)
+            position = np.where(valid, position, 0)
+            value = np.zeros(n, dtype=np.int64)
+            for i in range(width):
+                value = (value << 8) | data[position + i]
+            return np.where(valid, value, 0), valid
+
+        everything = np.ones(n, dtype=bool)
+        linktypes = block.linktypes
+        # Camada de enlace: Ethernet (com até duas tags VLAN), Linux SLL/SLL2, IP bruto e loopback
+        l3 = np.full(n, -1, dtype=np.int64)
+        ethertype = np.zeros(n, dtype=np.int64)
+        for linktype, type_offset, header_len in ((1, 12, 14), (113, 14, 16), (276, 0, 20)):
+            value, ok = field(type_offset, 2, linktypes == linktype)
+            ethertype = np.where(ok, value, ethertype)
+            l3 = np.where(ok, header_len, l3)
+        for _ in range(2):
+            value, ok = field(l3 + 2, 2, (ethertype == 0x8100) | (ethertype == 0x88A8) | (ethertype == 0x9100))
+            ethertype = np.where(ok, value, ethertype)
+            l3 = np.where(ok, l3 + 4, l3)
+        guess = np.isin(linktypes, PCAP_RAW_LINKTYPES) | np.isin(linktypes, PCAP_NULL_LINKTYPES)
+        l3 = np.where(np.isin(linktypes, PCAP_NULL_LINKTYPES), 4, np.where(guess, 0, l3))
+        first_byte, _ = field(l3, 1, l3 >= 0)
+        version = first_byte >> 4
+        ethertype = np.where(guess & (version == 4), 0x0800, np.where(guess & (version == 6), 0x86DD, ethertype))
+
+        # Camada de rede
+        v4 = (ethertype == 0x0800) & (version == 4)
+        ihl = (first_byte & 0x0F) * 4
+        v4 &= ihl >= 20
+        src4, ok = field(l3 + 12, 4, v4)
+        dst4, ok_dst = field(l3 + 16, 4, v4)
+        v4 &= ok & ok_dst
+        proto4, _ = field(l3 + 9, 1, v4)
+        fragment, _ = field(l3 + 6, 2, v4)
+        v6 = (ethertype == 0x86DD) & (version == 6)
+        next_header, ok = field(l3 + 6, 1, v6)
+        v6 &= ok & (l3 + 40 <= caplens)
+        proto = np.where(v4, proto4, np.where(v6, next_header, -1))
+        l4 = np.where(v4 & ((fragment & 0x1FFF) == 0), l3 + ihl, np.where(v6, l3 + 40, -1))
+
+        # Camada de transporte
+        tcp = (proto == 6) & (l4 >= 0)
+        udp = (proto == 17) & (l4 >= 0)
+        sport, ok = field(l4, 2, tcp | udp)
+        dport, ok_dport = field(l4 + 2, 2, tcp | udp)
+        tcp &= ok & ok_dport
+        udp &= ok & ok_dport
+        data_offset, _ = field(l4 + 12, 1, tcp)
+        payload = np.where(tcp, l4 + (data_offset >> 4) * 4, np.where(udp, l4 + 8, caplens))
+        payload_len = caplens - payload
+
+        # Protocolo mais específico identificado para cada pacote
+        code = np.where(ethertype == 0x0806, _PCAP_CODES['ARP'], 0)
+        code = np.where(v4, _PCAP_CODES['IPv4'], np.where(v6, _PCAP_CODES['IPv6'], code))
+        ip_code = _pcap_ip_lookup[np.where(proto >= 0, proto, 0) & 0xFF]
+        code = np.where((v4 | v6) & (ip_code > 0), ip_code, code)
+        app_code = np.where(_pcap_tcp_lookup[dport] > 0, _pcap_tcp_lookup[dport], _pcap_tcp_lookup[sport])
+        code = np.where(tcp & (app_code > 0), app_code, code)
+        app_code = np.where(_pcap_udp_lookup[dport] > 0, _pcap_udp_lookup[dport], _pcap_udp_lookup[sport])
+        code = np.where(udp & (app_code > 0), app_code, code)
+        self.protocols += np.bincount(code, minlength=len(PCAP_PROTOCOL_NAMES))
+
+        # Endereços e portas
+        addresses, counts = np.unique(np.concatenate([src4[v4], dst4[v4]]), return_counts=True)
+        self.ipv4.update(dict(zip(addresses.tolist(), counts.tolist())))
+        if v6.any():
+            base = (offsets + l3)[v6][:, None] + np.arange(16)
+            pairs = np.concatenate([data[base + 8], data[base + 24]])
+            addresses, counts = np.unique(np.ascontiguousarray(pairs).view('V16').ravel(), return_counts=True)
+            self.ipv6.update({address.tobytes(): count for address, count in zip(addresses, counts.tolist())})
+        transport = tcp | udp
+        self.ports += np.bincount(np.concatenate([sport[transport], dport[transport]]), minlength=65536)
+        addresses, counts = np.unique(src4[v4], return_counts=True)
+        for address, count in zip(addresses.tolist(), counts.tolist()):
+            text = str(ipaddress.IPv4Address(address))
+            if "IP_SUSPEITO" in NETWORK_INDICATOR_SCANNER.kinds(text):
+                self.suspicious_sources[text] += count
+
+        # Conteúdo de aplicação só para os candidatos: requisições HTTP e consultas DNS
+        prefix, _ = field(payload, 4, tcp & (payload_len >= 16))
+        for i in np.flatnonzero(np.isin(prefix, PCAP_HTTP_PREFIXES)).tolist():
+            match = PCAP_USER_AGENT_HEADER.search(bytes(data[offsets[i] + payload[i]:end[i]]))
+            if match:
+                self.user_agents[match.group(1).decode('latin-1').strip()] += 1
+        for i in np.flatnonzero(udp & (dport == 53) & (payload_len > 12)).tolist():
+            name = _dns_query_name(bytes(data[offsets[i] + payload[i]:end[i]]))
+            if name:
+                self.dns_queries[name] += 1
+        self.ipv4 = _prune_counter(self.ipv4, PCAP_COUNTER_CAPACITY)
+        self.ipv6 = _prune_counter(self.ipv6, PCAP_COUNTER_CAPACITY)
+        self.dns_queries = _prune_counter(self.dns_queries, PCAP_COUNTER_CAPACITY)
+        self.user_agents = _prune_counter(self.user_agents, PCAP_COUNTER_CAPACITY)
+
+    def alerts(self) -> list:
+        alerts = [f"⚠️ IP suspeito detectado: {ip} ({count} pacotes)"
+                  for ip, count in self.suspicious_sources.most_common()]
+        alerts += [f"⚠️ User-Agent suspeito detectado: {agent} ({count} requisições)"
+                   for agent, count in self.user_agents.most_common()
+                   if "USER_AGENT_SUSPEITO" in NETWORK_INDICATOR_SCANNER.kinds(agent)]
+        alerts += [f"⚠️ Domínio suspeito consultado: {name} ({count} consultas)"
+                   for name, count in self.dns_queries.most_common()
+                   if "DOMINIO_SUSPEITO" in NETWORK_INDICATOR_SCANNER.kinds(name)]
+        return alerts
+
+    def to_dict(self, indexer: PcapIndexer = None) -> dict:
+        # O top geral está contido na união dos tops de IPv4 e IPv6; só esses são formatados
+        addresses = collections.Counter({str(ipaddress.IPv4Address(a)): c for a, c in self.ipv4.most_common(PCAP_TOP_N)})
+        addresses.update({str(ipaddress.IPv6Address(a)): c for a, c in self.ipv6.most_common(PCAP_TOP_N)})
+        top_ports = np.argsort(self.ports)[::-1][:PCAP_TOP_N]
+        alerts = self.alerts()
+        result = {
+            "total_packets": self.total_packets,
+            "total_bytes": self.total_bytes,
+            "protocol_count": {PCAP_PROTOCOL_NAMES[code]: int(self.protocols[code])
+                               for code in np.argsort(self.protocols)[::-1] if self.protocols[code]},
+            "top_ip_addresses": dict(addresses.most_common(PCAP_TOP_N)),
+            "top_ports": {str(port): int(self.ports[port]) for port in top_ports if self.ports[port]},
+            "top_dns_queries": dict(self.dns_queries.most_common(PCAP_TOP_N)),
+            "alerts": alerts[:PCAP_MAX_ALERTS],
+            "alerts_total": len(alerts)
+        }
+        if indexer is not None and indexer.first_ts is not None:
+            result["capture_start"] = indexer.first_ts
+            result["capture_duration"] = round(indexer.last_ts - indexer.first_ts, 6)
+        return result
+
+def analyze_pcap_file(pcap_path: str) -> dict:
+    # Lê o arquivo via mmap em blocos de PCAP_BLOCK_PACKETS pacotes
+    start_time = time.time()
+    try:
+        indexer = PcapIndexer()
+        aggregates = PcapAggregates()
+        with open(pcap_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return {"error": "Arquivo PCAP vazio"}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = np.frombuffer(mm, dtype=np.uint8)
+                position = 0
+                try:
+                    while True:
+                        block, position = indexer.index(mm, position, size)
+                        if not len(block.offsets):
+                            break
+                        aggregates.add_block(data, block)
+                finally:
+                    del data  # Libera o buffer exportado antes de fechar o mmap
+        result = aggregates.to_dict(indexer)
+        result["format"] = indexer.format
+        result["truncated_bytes"] = size - position
+        result["elapsed"] = round(time.time() - start_time, 3)
+        return result
+    except Exception as e:
+        return {"error": str(e)}
+
+PCAP_ENGINES = {'native': analyze_pcap_file, 'pyshark': process_pcap_pyshark}
+
+def process_pcap(pcap_path, engine: str = 'native'):
+    return PCAP_ENGINES[engine](pcap_path)
+
 @app.route('/network_analysis', methods=['POST'])
 def network_analysis():
     if 'pcap_file' not in request.files:
         return jsonify({"error": "Arquivo PCAP não fornecido"}), 400
-    file = request.files['pcap_file']
-    pcap_path = os.path.join(PCAP_UPLOAD_FOLDER, file.filename)
-    file.save(pcap_path)
-    with multiprocessing.Pool(processes=1) as pool:
-        result = pool.apply(process_pcap, (pcap_path,))
+    engine = request.args.get('engine', 'native')
+    if engine not in PCAP_ENGINES:
+        return jsonify({"error": f"Motor de análise desconhecido: {engine}"}), 400
+    # Nome de arquivo temporário único (o nome enviado pelo cliente não é usado no caminho)
+    fd, pcap_path = tempfile.mkstemp(prefix='pcap_', suffix='.pcap', dir=PCAP_UPLOAD_FOLDER)
+    os.close(fd)
+    try:
+        request.files['pcap_file'].save(pcap_path)
+        # A análise roda no pool de processos compartilhado, sem criar um Pool por requisição
+        result = get_analysis_pool().submit(process_pcap, pcap_path, engine).result()
+    finally:
+        os.remove(pcap_path)
     return jsonify(result)
 
+# ----- Jobs assíncronos de PCAP (upload em streaming + análise concorrente) -----
+PCAP_UPLOAD_CHUNK = 1024 * 1024
+PCAP_STREAM_READ_BYTES = 8 * 1024 * 1024
+PCAP_STREAM_BLOCK_PACKETS = 65536  # Blocos menores no modo job para parciais mais frequentes
+PCAP_MAX_UPLOAD_BYTES = 20 * 1024 ** 3
+PCAP_MAX_ACTIVE_JOBS = 4
+PCAP_UPLOAD_IDLE_TIMEOUT = 300  # Segundos sem dados antes de abandonar um upload
+PCAP_JOB_TTL = 3600  # Segundos que um job concluído fica disponível para consulta
+PCAP_PROGRESS_INTERVAL = 1.0  # Intervalo entre linhas do stream NDJSON
+
+PCAP_JOBS_ACTIVE = Gauge('pcap_jobs_active', 'Jobs de análise de PCAP em andamento')
+
+class PcapJobLimitReached(Exception):
+    pass
+
+class PcapJob:
+    # Upload gravado num arquivo temporário único enquanto uma thread acompanha o arquivo,
+    # indexa os registros já completos e atualiza os agregados parciais.
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        fd, self.path = tempfile.mkstemp(prefix='pcap_job_', suffix='.pcap', dir=PCAP_UPLOAD_FOLDER)
+        os.close(fd)
+        self.status = 'waiting_upload'
+        self.error = None
+        self.result = None
+        self.bytes_received = 0
+        self.bytes_analyzed = 0
+        self.created_at = time.time()
+        self.finished_at = None
+        self.upload_started = threading.Event()
+        self.upload_done = threading.Event()
+        self.data_available = threading.Event()
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.indexer = PcapIndexer()
+        self.aggregates = PcapAggregates()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'error', 'cancelled')
+
+    def receive(self, stream) -> None:
+        # Copia o corpo da requisição em blocos; a análise acompanha o arquivo em paralelo
+        if self.upload_started.is_set():
+            raise ValueError("Este job já recebeu um upload")
+        self.upload_started.set()
+        self.status = 'receiving'
+        try:
+            with open(self.path, 'ab') as f:
+                while not self.finished:
+                    chunk = stream.read(PCAP_UPLOAD_CHUNK)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    f.flush()
+                    self.bytes_received += len(chunk)
+                    self.data_available.set()
+                    if self.bytes_received > PCAP_MAX_UPLOAD_BYTES:
+                        raise ValueError("Upload excede o limite de tamanho")
+        except Exception as e:
+            self._fail(f"Falha no upload: {e}")
+        finally:
+            self.upload_done.set()
+            self.data_available.set()
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        self.upload_done.set()
+        self.data_available.set()
+
+    def _fail(self, message: str) -> None:
+        if not self.finished:
+            self.error = message
+            self.status = 'error'
+
+    def run(self) -> None:
+        PCAP_JOBS_ACTIVE.inc()
+        buffer = bytearray()
+        base = 0  # Posição no arquivo do primeiro byte de buffer
+        last_data = time.time()
+        try:
+            with open(self.path, 'rb') as f:
+                while not self.finished:
+                    if self.cancelled:
+                        self.status = 'cancelled'
+                        break
+                    chunk = f.read(PCAP_STREAM_READ_BYTES)
+                    if not chunk:
+                        if self.upload_done.is_set() and base + len(buffer) >= self.bytes_received:
+                            break
+                        if time.time() - last_data > PCAP_UPLOAD_IDLE_TIMEOUT:
+                            raise ValueError("Upload abandonado (sem dados recebidos)")
+                        self.data_available.clear()
+                        self.data_available.wait(timeout=1.0)
+                        continue
+                    last_data = time.time()
+                    if self.status == 'receiving' or self.status == 'waiting_upload':
+                        self.status = 'analyzing'
+                    buffer += chunk
+                    data_bytes = bytes(buffer)
+                    data = np.frombuffer(data_bytes, dtype=np.uint8)
+                    position = 0
+                    while True:
+                        block, position = self.indexer.index(data_bytes, position, len(data_bytes),
+                                                             PCAP_STREAM_BLOCK_PACKETS)
+                        if not len(block.offsets):
+                            break
+                        with self.lock:
+                            self.aggregates.add_block(data, block)
+                            self.bytes_analyzed = base + position
+                    del buffer[:position]
+                    base += position
+            if not self.finished:
+                with self.lock:
+                    self.result = self.aggregates.to_dict(self.indexer)
+                self.result['format'] = self.indexer.format
+                self.result['truncated_bytes'] = self.bytes_received - base
+                self.status = 'done'
+        except Exception as e:
+            logger.error(f"❌ Erro no job de PCAP {self.id}: {e}")
+            self._fail(str(e))
+        finally:
+            self.finished_at = time.time()
+            PCAP_JOBS_ACTIVE.dec()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            partial = self.result or self.aggregates.to_dict(self.indexer)
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'upload_complete': self.upload_done.is_set(),
+            'bytes_received': self.bytes_received,
+            'bytes_analyzed': self.bytes_analyzed,
+            'elapsed': round((self.finished_at or time.time()) - self.created_at, 3),
+            'error': self.error,
+            'packets': partial['total_packets'],
+            'top_talkers': partial['top_ip_addresses'],
+            'result' if self.status == 'done' else 'partial': partial
+        }
+
+pcap_jobs = {}
+_pcap_jobs_lock = threading.Lock()
+
+def _expire_pcap_jobs() -> None:
+    now = time.time()
+    with _pcap_jobs_lock:
+        for job_id, job in list(pcap_jobs.items()):
+            if job.finished and now - job.finished_at > PCAP_JOB_TTL:
+                del pcap_jobs[job_id]
+
+def create_pcap_job() -> PcapJob:
+    _expire_pcap_jobs()
+    with _pcap_jobs_lock:
+        if sum(1 for job in pcap_jobs.values() if not job.finished) >= PCAP_MAX_ACTIVE_JOBS:
+            raise PcapJobLimitReached("Limite de jobs de PCAP simultâneos atingido")
+        job = PcapJob()
+        pcap_jobs[job.id] = job
+    threading.Thread(target=job.run, name=f"pcap-job-{job.id[:8]}", daemon=True).start()
+    return job
+
+def _pcap_job_links(job: PcapJob) -> dict:
+    return {
+        'job_id': job.id,
+        'status_url': f"/network_analysis/jobs/{job.id}",
+        'stream_url': f"/network_analysis/jobs/{job.id}/stream",
+        'upload_url': f"/network_analysis/jobs/{job.id}/data"
+    }
+
+def _request_has_body() -> bool:
+    return bool(request.content_length) or request.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+
+@app.route('/network_analysis/jobs', methods=['POST'])
+def create_network_analysis_job():
+    # Sem corpo: cria o job e devolve a URL para enviar a captura via PUT (id imediato).
+    # Com corpo bruto (ou multipart em 'pcap_file'): recebe em streaming e já analisa.
+    try:
+        job = create_pcap_job()
+    except PcapJobLimitReached as e:
+        response = jsonify({'error': str(e)})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(INFERENCE_RETRY_AFTER)
+        return response
+    if 'pcap_file' in request.files:
+        job.receive(request.files['pcap_file'].stream)
+    elif _request_has_body():
+        job.receive(request.stream)
+    return jsonify(dict(_pcap_job_links(job), **job.snapshot())), 202
+
+@app.route('/network_analysis/jobs/<job_id>/data', methods=['PUT'])
+def upload_network_analysis_job(job_id):
+    job = pcap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    if job.upload_started.is_set() or job.finished:
+        return jsonify({'error': 'Este job já recebeu um upload'}), 409
+    job.receive(request.stream)
+    return jsonify(job.snapshot()), 202
+
+@app.route('/network_analysis/jobs/<job_id>', methods=['GET'])
+def network_analysis_job_status(job_id):
+    job = pcap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/network_analysis/jobs/<job_id>', methods=['DELETE'])
+def cancel_network_analysis_job(job_id):
+    job = pcap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    job.cancel()
+    return jsonify(job.snapshot())
+
+@app.route('/network_analysis/jobs/<job_id>/stream', methods=['GET'])
+def stream_network_analysis_job(job_id):
+    # NDJSON: uma linha com os agregados parciais a cada PCAP_PROGRESS_INTERVAL até o fim do job
+    job = pcap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+
+    def generate():
+        while True:
+            finished = job.finished
+            yield json.dumps(job.snapshot(), ensure_ascii=False) + "\n"
+            if finished:
+                break
+            time.sleep(PCAP_PROGRESS_INTERVAL)
+
+    return streamed_text_response(generate(), mimetype='application/x-ndjson')
+
+
 # ===== Integração com Gradio.live (Interface Aprimorada e Reativa) =====
-def gradio_interface(query, mode, language, style, investigation_focus, num_sites, search_news, search_leaked_data, temperature, velocidade, gpu_layers, n_batch):
+def gradio_interface(query, mode, language, style, investigation_focus, num_sites, search_news, search_leaked_data, temperature, velocidade, gpu_layers, n_batch, autocorrect=True, aliases=""):
     # Atualiza configurações de GPU/CPU se fornecidas
     if gpu_layers != "" and n_batch != "":
         try:
@@ -1638,11 +6469,32 @@ def gradio_interface(query, mode, language, style, investigation_focus, num_site
     # Se o modo for "Investigação", retornamos feedback em tempo real via generator
     if mode == "Investigação":
         yield "⏳ Iniciando investigação...", ""
+        if not query.strip():
+            yield "Erro: Por favor, insira um alvo para investigação.", ""
+            return
         sites_meta = int(num_sites)
-        report, links_table = process_investigation(query, sites_meta, investigation_focus, search_news, search_leaked_data, custom_temperature, language, fast_mode)
-        yield report, links_table
+        alias_list = [alias.strip() for alias in (aliases or "").split(',') if alias.strip()]
+        # Progresso das etapas e relatório parcial a cada evento do pipeline
+        progress, parts, links_table = [], [], ""
+        try:
+            for kind, payload in run_investigation(query, sites_meta, investigation_focus, search_news, search_leaked_data, custom_temperature, language, fast_mode, autocorrect, alias_list):
+                if kind == 'progress':
+                    progress.append(f"<i>{payload}</i>")
+                elif kind == 'token':
+                    parts.append(payload)
+                else:
+                    links_table = payload
+                yield "<br>".join(progress) + "<br><br>" + "".join(parts), links_table
+        except InferenceQueueFull:
+            yield f"⏳ {INFERENCE_BUSY_MESSAGE}", ""
+        except Exception as e:
+            logger.error(f"❌ Erro na investigação: {e}")
+            yield f"Erro na investigação: {e}", ""
     elif mode == "Chat":
-        result = generate_response(query, language, style, custom_temperature, fast_mode)
+        try:
+            result = generate_response(query, language, style, custom_temperature, fast_mode, autocorrect)
+        except InferenceQueueFull:
+            result = f"⏳ {INFERENCE_BUSY_MESSAGE}"
         yield result, ""
     elif mode == "Metadados":
         meta = analyze_image_metadata(query)
@@ -1652,6 +6504,7 @@ def gradio_interface(query, mode, language, style, investigation_focus, num_site
         yield "Modo não suportado.", ""
 
 def build_gradio_interface():
+    gr = lazy_import('gradio')
     with gr.Blocks(title="Interface de IA - Chat & Investigação") as demo:
         gr.Markdown("# Interface de IA - Chat & Investigação")
         gr.Markdown("### Insira os parâmetros para interagir com o sistema")
@@ -1662,11 +6515,13 @@ def build_gradio_interface():
                 language_input = gr.Radio(["Português", "English", "Español", "Français", "Deutsch"], label="Idioma", value="Português", interactive=True)
                 style_input = gr.Radio(["Técnico", "Livre"], label="Estilo", value="Técnico", interactive=True)
                 investigation_focus = gr.Textbox(label="Foco da Investigação (opcional)", placeholder="Ex: vulnerabilidades, evidências, etc.", lines=1)
+                aliases_input = gr.Textbox(label="Apelidos do Alvo (opcional)", placeholder="Separados por vírgula", lines=1)
                 num_sites = gr.Number(label="Número de Sites", value=5, precision=0)
                 search_news = gr.Checkbox(label="Pesquisar Notícias", value=False)
                 search_leaked_data = gr.Checkbox(label="Pesquisar Dados Vazados", value=False)
                 temperature_input = gr.Slider(label="Temperatura da IA", minimum=0.0, maximum=1.0, step=0.1, value=0.7)
                 velocidade_input = gr.Radio(["Rápida", "Detalhada"], label="Velocidade (menos detalhes / mais detalhes)", value="Detalhada", interactive=True)
+                autocorrect_input = gr.Checkbox(label="Autocorreção da consulta", value=True)
                 # Novos parâmetros para configuração de GPU/CPU
                 gpu_layers_input = gr.Textbox(label="Camadas GPU (n_gpu_layers)", placeholder="Deixe em branco para detecção automática")
                 n_batch_input = gr.Textbox(label="Tamanho do Lote (n_batch)", placeholder="Deixe em branco para detecção automática")
@@ -1677,18 +6532,70 @@ def build_gradio_interface():
         # Define a interface como geradora para feedback em tempo real
         submit_btn.click(fn=gradio_interface, 
                  inputs=[query_input, mode_input, language_input, style_input,
-                         investigation_focus, num_sites, search_news, search_leaked_data, temperature_input, velocidade_input, gpu_layers_input, n_batch_input],
+                         investigation_focus, num_sites, search_news, search_leaked_data, temperature_input, velocidade_input, gpu_layers_input, n_batch_input, autocorrect_input, aliases_input],
                  outputs=[report_output, links_output])
     return demo
 
-demo = build_gradio_interface()
-
 def launch_gradio():
     logger.info("Iniciando Gradio (o sistema escolherá uma porta livre).")
+    started = time.perf_counter()
+    demo = build_gradio_interface()
+    record_startup_phase('gradio', started)
     demo.launch(share=True)
 
+# ===== Aquecimento em Segundo Plano e Prontidão =====
+WARMUP_MODULES = ('duckduckgo_search', 'sklearn.ensemble', 'pyshark')
+warmup_done = threading.Event()
+
+def warm_up() -> None:
+    # Roda depois do boot: importa as dependências pesadas e carrega o modelo nos workers,
+    # enquanto as rotas que não usam o modelo já atendem normalmente.
+    started = time.perf_counter()
+    for module_name in WARMUP_MODULES:
+        try:
+            lazy_import(module_name, optional=True)
+        except Exception as e:
+            logger.warning(f"Falha ao pré-carregar {module_name}: {e}")
+    try:
+        # Carrega os perfis do langdetect agora, e não na primeira resposta validada
+        detect_langs("aquecimento do detector de idioma")
+    except Exception as e:
+        logger.warning(f"Falha ao pré-carregar os perfis de idioma: {e}")
+    model_started = time.perf_counter()
+    inference_scheduler.start()
+    inference_scheduler.wait_ready()
+    record_startup_phase('model', model_started)
+    try:
+        # Retoma lotes que ficaram na fila durável antes do reinício
+        if batch_store.pending():
+            batch_runner.start()
+    except Exception as e:
+        logger.warning(f"Falha ao retomar a fila de lotes: {e}")
+    record_startup_phase('warmup', started)
+    warmup_done.set()
+    logger.info(f"✅ Aquecimento concluído em {startup_phases['warmup']:.2f}s")
+
+@app.route('/ready')
+def ready():
+    # Prontidão: 200 quando o aquecimento terminou e há ao menos um worker com o modelo carregado
+    workers_ready = sum(1 for worker in inference_scheduler.workers
+                        if worker.ready.is_set() and worker.failed is None)
+    is_ready = warmup_done.is_set() and workers_ready > 0
+    return jsonify({
+        'ready': is_ready,
+        'warmup_done': warmup_done.is_set(),
+        'inference_workers_ready': workers_ready,
+        'uptime': round(time.perf_counter() - _BOOT_STARTED, 3),
+        'startup_phases': dict(startup_phases)
+    }), 200 if is_ready else 503
+
+record_startup_phase('module', _BOOT_STARTED)
+
 # ===== Execução da Aplicação =====
 if __name__ == '__main__':
+    # Com o reloader do modo debug, apenas o processo que atende as requisições faz o aquecimento
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
     gradio_thread = threading.Thread(target=launch_gradio, daemon=True)
     gradio_thread.start()
     logger.info("Executando a aplicação Flask na porta 5000...")
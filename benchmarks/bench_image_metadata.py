@@ -0,0 +1,136 @@
+"""Benchmark da extração de metadados de imagens: download completo contra busca por Range.
+
+Sobe um servidor HTTP local (stub com suporte a Range e um modo que ignora Range), serve
+uma foto JPEG grande gerada com Pillow contendo EXIF, GPS e XMP, e compara o caminho
+antigo (requests.get + Image.open no arquivo inteiro) com fetch_image_head: bytes
+transferidos, requisições, tempo e se os metadados EXIF extraídos são os mesmos.
+
+Uso:
+    python benchmarks/bench_image_metadata.py --megapixels 24 --repeat 5
+"""
+import argparse
+import io
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+XMP_PACKET = (b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+              b'<rdf:Description xmlns:xmp="http://ns.adobe.com/xap/1.0/" xmp:CreatorTool="bench"/></rdf:RDF></x:xmpmeta>')
+
+
+def synthetic_photo(megapixels: float) -> bytes:
+    import numpy as np
+    from PIL import Image
+    side = int((megapixels * 1e6) ** 0.5)
+    rng = np.random.default_rng(42)
+    image = Image.fromarray(rng.integers(0, 256, (side, side, 3), dtype=np.uint8))
+    exif = Image.Exif()
+    exif[0x010F] = 'BenchCam'
+    exif[0x0110] = 'Model X'
+    exif[0x0132] = '2024:01:01 12:00:00'
+    exif.get_ifd(0x8769)[0x9003] = '2024:01:01 12:00:00'
+    gps = exif.get_ifd(0x8825)
+    gps[1], gps[2] = 'S', (23.0, 33.0, 1.5)
+    gps[3], gps[4] = 'W', (46.0, 38.0, 2.25)
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=95, exif=exif, xmp=XMP_PACKET)
+    return out.getvalue()
+
+
+def stub_handler(payload: bytes, honor_range: bool):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def handle(self):
+            # o cliente fecha a conexão assim que tem os bytes de que precisa
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def do_GET(self):
+            header = self.headers.get('Range', '')
+            start, end = 0, len(payload) - 1
+            if honor_range and header.startswith('bytes='):
+                first, _, last = header[6:].partition('-')
+                start = int(first)
+                end = min(int(last) if last else end, end)
+                if start >= len(payload):
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(payload)}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{len(payload)}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            try:
+                self.wfile.write(payload[start:end + 1])
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return Handler
+
+
+def start_stub(payload: bytes, honor_range: bool) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), stub_handler(payload, honor_range))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, default=24, help='tamanho da foto sintética')
+    parser.add_argument('--repeat', type=int, default=5, help='repetições de cada caminho')
+    args = parser.parse_args()
+
+    import requests
+    from PIL import Image
+
+    import app
+
+    payload = synthetic_photo(args.megapixels)
+    print(f"Foto sintética: {args.megapixels:g} MP, {len(payload) / 1e6:.1f} MB")
+
+    def legacy(url):
+        content = requests.get(url, timeout=10).content
+        exif = Image.open(io.BytesIO(content)).getexif()
+        return app.exif_to_metadata(exif), len(content), 1
+
+    def ranged(url):
+        fetched = app.fetch_image_head(url)
+        return app.parse_image_metadata(fetched['data']), fetched['bytes_transferred'], fetched['requests']
+
+    for honor_range in (True, False):
+        server = start_stub(payload, honor_range)
+        url = f"http://127.0.0.1:{server.server_address[1]}/photo.jpg"
+        print(f"\nServidor {'com' if honor_range else 'sem'} suporte a Range")
+        results = {}
+        for name, fn in (('download', legacy), ('range', ranged)):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                meta, transferred, requests_made = fn(url)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            results[name] = meta
+            print(f"{name:>9}: {transferred / 1024:,.0f} KB em {requests_made} requisição(ões), {elapsed * 1000:.1f} ms por imagem")
+        expected = {key: str(value) for key, value in results['download'].items()}
+        found = {key: str(value) for key, value in results['range'].items() if key in expected}
+        print(f"{'':>9}  EXIF {'idêntico' if expected == found else 'diferente'}; "
+              f"GPS: {results['range'].get('GPS Coordinates')}; XMP: {'sim' if 'XMP' in results['range'] else 'não'}")
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
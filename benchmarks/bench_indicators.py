@@ -0,0 +1,91 @@
+"""Benchmark da extração de indicadores: scanner unificado contra o laço por padrão.
+
+Gera um texto sintético de vários MB (palavras comuns com IPs, e-mails, URLs, telefones,
+MACs e domínios misturados), mede o laço antigo (um findall por padrão em
+COMPILED_REGEX_PATTERNS) e o IndicatorScanner sobre str e bytes, e confere que os
+indicadores encontrados são os mesmos.
+
+Uso:
+    python benchmarks/bench_indicators.py --megabytes 8
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def synthetic_text(megabytes: float, seed: int = 42) -> str:
+    rng = random.Random(seed)
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(5000)]
+    parts = []
+    size = 0
+    i = 0
+    while size < megabytes * 1e6:
+        r = rng.random()
+        if r < 0.01:
+            part = '.'.join(str(rng.randint(0, 255)) for _ in range(4))
+        elif r < 0.02:
+            part = f"user{i}@mail{i % 50}.example.com"
+        elif r < 0.03:
+            part = f"https://site{i % 300}.example.org/path?id={i}"
+        elif r < 0.035:
+            part = f"+55 11 9{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}"
+        elif r < 0.04:
+            part = "aa:bb:cc:%02x:ee:ff" % (i % 256)
+        elif r < 0.045:
+            part = ':'.join('%x' % rng.randint(0, 0xffff) for _ in range(8))
+        elif r < 0.055:
+            part = f"host{i % 700}.corp.net"
+        else:
+            part = rng.choice(words) + ('.' if rng.random() < 0.05 else '')
+        parts.append(part)
+        size += len(part) + 1
+        i += 1
+    return ' '.join(parts)
+
+
+def timed(name: str, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>14}: {elapsed:.3f}s")
+    return result, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megabytes', type=float, default=8, help='tamanho do texto sintético')
+    args = parser.parse_args()
+
+    import app
+
+    text = synthetic_text(args.megabytes)
+    data = text.encode('utf-8')
+    print(f"Texto sintético: {len(data) / 1e6:.1f} MB")
+    patterns = app.COMPILED_REGEX_PATTERNS
+
+    def legacy(text):
+        found = {}
+        for key, pattern in patterns.items():
+            matches = pattern.findall(text)
+            if matches:
+                found[key] = list(set(matches))
+        return found
+
+    expected, base = timed('por padrão', legacy, text)
+    scanner = app.FORENSIC_INDICATOR_SCANNER
+    for name, payload in (('scanner (str)', text), ('scanner (bytes)', data)):
+        result, elapsed = timed(name, scanner.scan, payload)
+        diff = {key: len(set(expected.get(key, ())) ^ set(result.get(key, ())))
+                for key in set(expected) | set(result)}
+        status = 'idênticos' if not any(diff.values()) else f'diferenças {diff}'
+        print(f"{'':>14}  {base / elapsed:.1f}x mais rápido, indicadores {status}")
+    print('Indicadores por tipo:', {key: len(values) for key, values in expected.items()})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Benchmark do motor de PCAP: parser nativo (mmap + NumPy) contra o caminho pyshark/tshark.
+
+Gera uma captura sintética (Ethernet/IPv4/IPv6, TCP, UDP, DNS, HTTP, ICMP e ARP) e mede
+pacotes por segundo de cada motor.
+
+Uso:
+    python benchmarks/bench_pcap.py --packets 500000
+    python benchmarks/bench_pcap.py --packets 200000 --pcapng --pyshark-packets 20000
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def _checksum_free_ipv4(src: bytes, dst: bytes, proto: int, payload: bytes) -> bytes:
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, 0, 64, proto, 0, src, dst) + payload
+
+
+def _ethernet(ethertype: int, payload: bytes) -> bytes:
+    return b'\x00\x11\x22\x33\x44\x55' + b'\x66\x77\x88\x99\xaa\xbb' + struct.pack('!H', ethertype) + payload
+
+
+def _tcp(sport: int, dport: int, payload: bytes = b'') -> bytes:
+    return struct.pack('!HHIIBBHHH', sport, dport, 1, 0, 5 << 4, 0x18, 65535, 0, 0) + payload
+
+
+def _udp(sport: int, dport: int, payload: bytes) -> bytes:
+    return struct.pack('!HHHH', sport, dport, 8 + len(payload), 0) + payload
+
+
+def _dns_query(name: str) -> bytes:
+    labels = b''.join(bytes([len(part)]) + part.encode() for part in name.split('.')) + b'\x00'
+    return struct.pack('!HHHHHH', 0x1234, 0x0100, 1, 0, 0, 0) + labels + struct.pack('!HH', 1, 1)
+
+
+def synthetic_packets(count: int, seed: int = 42):
+    rng = random.Random(seed)
+    hosts = [bytes([192, 168, 0, i]) for i in range(1, 50)] + [bytes([8, 8, rng.randrange(256), i]) for i in range(50)]
+    agents = [b'curl/8.4.0', b'Mozilla/5.0', b'python-requests/2.31', b'Wget/1.21']
+    domains = ['example.com', 'malware.ru', 'cdn.example.org', 'tracker.xyz', 'api.github.com']
+    for _ in range(count):
+        src, dst = rng.choice(hosts), rng.choice(hosts)
+        kind = rng.random()
+        if kind < 0.45:
+            frame = _ethernet(0x0800, _checksum_free_ipv4(src, dst, 6, _tcp(rng.randrange(1024, 65535), 443, b'\x17' * rng.randrange(0, 600))))
+        elif kind < 0.6:
+            request = b'GET /index.html HTTP/1.1\r\nHost: example.com\r\nUser-Agent: ' + rng.choice(agents) + b'\r\n\r\n'
+            frame = _ethernet(0x0800, _checksum_free_ipv4(src, dst, 6, _tcp(rng.randrange(1024, 65535), 80, request)))
+        elif kind < 0.8:
+            frame = _ethernet(0x0800, _checksum_free_ipv4(src, dst, 17, _udp(rng.randrange(1024, 65535), 53, _dns_query(rng.choice(domains)))))
+        elif kind < 0.9:
+            header = struct.pack('!IHBB', 6 << 28, 20 + 8, 17, 64)
+            frame = _ethernet(0x86DD, header + b'\xfe\x80' + b'\x00' * 13 + bytes([rng.randrange(1, 20)])
+                              + b'\xfe\x80' + b'\x00' * 13 + b'\x01' + _udp(5353, 5353, b'\x00' * 20))
+        elif kind < 0.97:
+            frame = _ethernet(0x0800, _checksum_free_ipv4(src, dst, 1, b'\x08\x00' + b'\x00' * 62))
+        else:
+            frame = _ethernet(0x0806, b'\x00\x01\x08\x00\x06\x04\x00\x01' + b'\x00' * 20)
+        yield frame
+
+
+def write_pcap(path: str, count: int) -> None:
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+        for i, frame in enumerate(synthetic_packets(count)):
+            f.write(struct.pack('<IIII', 1700000000 + i // 1000, (i % 1000) * 1000, len(frame), len(frame)))
+            f.write(frame)
+
+
+def write_pcapng(path: str, count: int) -> None:
+    def block(block_type: int, body: bytes) -> bytes:
+        body += b'\x00' * (-len(body) % 4)
+        return struct.pack('<II', block_type, len(body) + 12) + body + struct.pack('<I', len(body) + 12)
+
+    with open(path, 'wb') as f:
+        f.write(block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1)))
+        f.write(block(1, struct.pack('<HHI', 1, 0, 65535)))
+        for i, frame in enumerate(synthetic_packets(count)):
+            ts = (1700000000 + i // 1000) * 1000000 + (i % 1000) * 1000
+            f.write(block(6, struct.pack('<IIIII', 0, ts >> 32, ts & 0xFFFFFFFF, len(frame), len(frame)) + frame))
+
+
+def run(name: str, fn, path: str) -> dict:
+    start = time.perf_counter()
+    result = fn(path)
+    elapsed = time.perf_counter() - start
+    packets = result.get('total_packets', 0)
+    print(f"{name:>8}: {packets} pacotes em {elapsed:.2f}s -> {packets / elapsed:,.0f} pacotes/s")
+    if 'error' in result:
+        print(f"          erro: {result['error']}")
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--packets', type=int, default=200000, help='pacotes na captura sintética')
+    parser.add_argument('--pyshark-packets', type=int, default=20000,
+                        help='pacotes na captura usada pelo pyshark (mais lento); 0 desativa')
+    parser.add_argument('--pcapng', action='store_true', help='gera pcapng em vez de pcap clássico')
+    args = parser.parse_args()
+
+    import app
+
+    writer = write_pcapng if args.pcapng else write_pcap
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.pcapng' if args.pcapng else 'bench.pcap')
+        start = time.perf_counter()
+        writer(path, args.packets)
+        print(f"Captura sintética: {args.packets} pacotes, {os.path.getsize(path) / 1e6:.1f} MB "
+              f"({time.perf_counter() - start:.1f}s para gerar)")
+        result = run('nativo', app.analyze_pcap_file, path)
+        print(f"          protocolos: {result.get('protocol_count')}")
+        print(f"          alertas: {result.get('alerts_total')}")
+        if args.pyshark_packets:
+            if app.lazy_import('pyshark', optional=True) is None:
+                print(" pyshark: não instalado, comparação ignorada")
+                return
+            small = os.path.join(tmp, 'bench_small.pcap')
+            write_pcap(small, args.pyshark_packets)
+            run('nativo', app.analyze_pcap_file, small)
+            run('pyshark', app.process_pcap_pyshark, small)
+
+
+if __name__ == '__main__':
+    main()
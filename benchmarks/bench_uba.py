@@ -0,0 +1,107 @@
+"""Benchmark do motor de UBA: caminho antigo (matriz por laço + fit a cada requisição) contra o colunar.
+
+Gera registros sintéticos de login (hora, bytes, falhas, duração, país e dispositivo), mede o
+caminho antigo só com os campos numéricos (ele não aceita texto) e o motor novo com todos os
+campos: primeiro treino, pontuação com o modelo persistido (registros e formato colunar) e
+recarga do modelo do disco.
+
+Uso:
+    python benchmarks/bench_uba.py --records 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+NUMERIC_FIELDS = ('login_hour', 'bytes_sent', 'failed_logins', 'session_minutes')
+
+
+def synthetic_columns(count: int, seed: int = 42) -> dict:
+    rng = np.random.default_rng(seed)
+    countries = np.array(['BR', 'US', 'PT', 'DE', 'FR', 'AR', 'RU', 'KP'])
+    devices = np.array(['laptop', 'desktop', 'mobile', 'tablet', 'server'])
+    columns = {
+        'login_hour': rng.normal(13, 3, count).clip(0, 23).round(),
+        'bytes_sent': rng.lognormal(10, 1, count).round(),
+        'failed_logins': rng.poisson(0.2, count).astype(np.float64),
+        'session_minutes': rng.gamma(2, 20, count).round(1),
+        'country': countries[rng.choice(len(countries), count, p=[.5, .2, .15, .06, .05, .03, .007, .003])],
+        'device': devices[rng.choice(len(devices), count, p=[.4, .3, .25, .04, .01])]
+    }
+    # 1% de sessões atípicas: madrugada, muito tráfego e várias falhas
+    outliers = rng.choice(count, count // 100, replace=False)
+    columns['login_hour'][outliers] = rng.integers(0, 5, len(outliers))
+    columns['bytes_sent'][outliers] *= 50
+    columns['failed_logins'][outliers] += rng.integers(3, 10, len(outliers))
+    return columns
+
+
+def to_records(columns: dict, fields) -> list:
+    values = [columns[field].tolist() for field in fields]
+    return [dict(zip(fields, row)) for row in zip(*values)]
+
+
+def legacy(user_data: list, IsolationForest) -> dict:
+    keys = list(user_data[0].keys())
+    X = np.array([[record[k] for k in keys] for record in user_data])
+    model = IsolationForest(contamination=0.1, random_state=42)
+    model.fit(X)
+    scores = model.decision_function(X)
+    anomalies = model.predict(X)
+    analysis = []
+    for i, record in enumerate(user_data):
+        record_analysis = record.copy()
+        record_analysis['anomaly_score'] = scores[i]
+        record_analysis['is_anomaly'] = anomalies[i] == -1
+        analysis.append(record_analysis)
+    return {'analysis': analysis}
+
+
+def timed(name: str, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>34}: {elapsed:.2f}s")
+    if isinstance(result, dict) and 'error' in result:
+        print(f"{'':>34}  erro: {result['error']}")
+    return result, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=1000000, help='registros sintéticos')
+    parser.add_argument('--skip-legacy', action='store_true', help='não mede o caminho antigo')
+    args = parser.parse_args()
+
+    import app
+
+    columns = synthetic_columns(args.records)
+    fields = list(columns)
+    print(f"Registros sintéticos: {args.records}, campos: {', '.join(fields)}")
+    with tempfile.TemporaryDirectory() as tmp:
+        app.uba_models = app.UBAModelStore(tmp)
+        if not args.skip_legacy:
+            numeric_records = to_records(columns, NUMERIC_FIELDS)
+            _, base = timed('antigo (numérico, fit por requisição)', legacy, numeric_records,
+                            app.lazy_import('sklearn.ensemble').IsolationForest)
+            del numeric_records
+        records = to_records(columns, fields)
+        timed('novo: primeiro treino + pontuação', app.analyze_user_behavior, records, 'bench', 'logins')
+        result, elapsed = timed('novo: pontuação (registros)', app.analyze_user_behavior, records, 'bench', 'logins')
+        if not args.skip_legacy:
+            print(f"{'':>34}  {base / elapsed:.1f}x mais rápido que o antigo")
+        del records
+        payload = {'columns': {name: column.tolist() for name, column in columns.items()}}
+        result, elapsed = timed('novo: pontuação (colunar)', app.analyze_user_behavior, payload, 'bench', 'logins')
+        app.uba_models = app.UBAModelStore(tmp)
+        timed('novo: recarga do disco + pontuação', app.analyze_user_behavior, payload, 'bench', 'logins', 'false')
+        print(f"Anomalias: {result.get('anomalies')} de {args.records}; modelo: {result.get('model', {}).get('features')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Dados persistentes do app (SQLite, índices) num diretório temporário, nunca no repositório
+_cache_dir = tempfile.mkdtemp(prefix='cyber-tests-')
+os.environ['CYBER_CACHE_DIR'] = _cache_dir
+atexit.register(shutil.rmtree, _cache_dir, True)
+
+import pytest  # noqa: E402
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def search_env(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'search_cache', app.SearchResultCache(
+        str(tmp_path / 'search.sqlite3'), app.SEARCH_CACHE_TTL, app.SEARCH_CACHE_NEGATIVE_TTL,
+        app.SEARCH_CACHE_STALE_TTL, app.SEARCH_CACHE_MAX_ENTRIES))
+
+    def use(backend):
+        previous = app.set_search_backend(backend)
+        request_cleanup.append(previous)
+        return backend
+
+    request_cleanup = []
+    yield use
+    for previous in request_cleanup:
+        app.set_search_backend(previous)
+
+
+class StubImageServer:
+    # Servidor HTTP local para os testes de metadados: Range opcional, ETag com 304 e
+    # registro das requisições e do pico de conexões simultâneas
+    def __init__(self, files: dict, honor_range: bool = True, etag: bool = True, delay: float = 0.0):
+        self.files = files
+        self.honor_range = honor_range
+        self.etag = etag
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}{path}"
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def handle(self):
+                # o cliente fecha a conexão assim que tem os bytes de que precisa
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                    stub.requests.append({'path': self.path, 'range': self.headers.get('Range'),
+                                          'if_none_match': self.headers.get('If-None-Match')})
+                try:
+                    if stub.delay:
+                        time.sleep(stub.delay)
+                    self._respond()
+                finally:
+                    with stub.lock:
+                        stub.active -= 1
+
+            def _respond(self):
+                payload = stub.files.get(self.path)
+                if payload is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                etag = f'"{len(payload)}-{hash(payload) & 0xFFFFFFFF:x}"'
+                if stub.etag and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                header = self.headers.get('Range', '')
+                start, end = 0, len(payload) - 1
+                if stub.honor_range and header.startswith('bytes='):
+                    first, _, last = header[6:].partition('-')
+                    start = int(first)
+                    end = min(int(last) if last else end, end)
+                    if start >= len(payload):
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{len(payload)}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{len(payload)}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg' if payload[:2] == b'\xff\xd8' else 'image/png')
+                self.send_header('Content-Length', str(end - start + 1))
+                if stub.etag:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                try:
+                    self.wfile.write(payload[start:end + 1])
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
+
+
+@pytest.fixture
+def image_server(monkeypatch):
+    # Fábrica de servidores stub; o cache de metadados é isolado por teste
+    monkeypatch.setattr(app, 'image_metadata_cache', app.BoundedTTLCache(
+        'image_metadata_test', app.METADATA_CACHE_MAX_ENTRIES, app.METADATA_CACHE_MAX_BYTES, app.METADATA_CACHE_TTL))
+    servers = []
+
+    def start(files: dict, **options) -> StubImageServer:
+        server = StubImageServer(files, **options)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,36 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def full_queue(monkeypatch):
+    def reject():
+        raise app.InferenceQueueFull("Fila de inferência cheia")
+    monkeypatch.setattr(app.inference_scheduler, 'ensure_capacity', reject)
+    return app.app.test_client()
+
+
+def test_cached_chat_stream_is_served_with_a_full_queue(full_queue):
+    app.set_cached_response(app.normalize_query('Pergunta em cache'), 'Português', 'Técnico', 'resposta salva')
+    response = full_queue.post('/ask?stream=true', data={'user_input': 'Pergunta em cache', 'mode': 'Chat',
+                                                          'autocorrect': 'false'})
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'resposta salva'
+
+
+def test_uncached_chat_stream_is_rejected_with_a_full_queue(full_queue):
+    response = full_queue.post('/ask?stream=true', data={'user_input': 'Pergunta nova sem cache', 'mode': 'Chat',
+                                                          'autocorrect': 'false'})
+    assert response.status_code == 429
+    assert 'Retry-After' in response.headers
+
+
+def test_gradio_chat_shows_retry_message_when_queue_is_full(monkeypatch):
+    def full(*args, **kwargs):
+        raise app.InferenceQueueFull("Fila de inferência cheia")
+    monkeypatch.setattr(app, 'generate_response', full)
+    [(report, links)] = list(app.gradio_interface('pergunta', 'Chat', 'Português', 'Técnico', '', 5, False, False,
+                                                  0.7, 'Rápida', '', ''))
+    assert app.INFERENCE_BUSY_MESSAGE in report
+    assert links == ""
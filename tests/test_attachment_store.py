@@ -0,0 +1,56 @@
+import os
+import time
+
+import app
+
+PDF = b'%PDF-1.4\nvisit http://evil.example.com/payload now\n' + b'x' * 1000
+EXE = b'MZ' + b'\x00' * 100 + b'connect 10.0.0.5 please' + b'\x00' * 100
+
+
+def test_repeated_content_is_a_hit(tmp_path):
+    store = app.AttachmentStore(str(tmp_path))
+    record, outcome = store.ingest(iter([PDF[:10], PDF[10:]]), 'enc-1')
+    assert outcome == 'miss'
+    assert record['detected_type'] == 'application/pdf'
+    assert record['size'] == len(PDF)
+    again, outcome = store.ingest(iter([PDF]), 'enc-2')
+    assert outcome == 'content_hit'
+    assert again['sha256'] == record['sha256']
+    assert store.lookup_encoded('enc-2')['sha256'] == record['sha256']
+    assert store.lookup_encoded('unknown') is None
+
+
+def test_binary_indicators_come_from_printable_runs(tmp_path):
+    record, _ = app.AttachmentStore(str(tmp_path)).ingest(iter([EXE]))
+    assert record['detected_type'] == 'application/x-dosexec'
+    assert any('10.0.0.5' in values for values in record['indicators'].values())
+
+
+def test_content_is_not_kept_by_default(tmp_path):
+    store = app.AttachmentStore(str(tmp_path))
+    record, _ = store.ingest(iter([PDF]))
+    assert record['stored'] is False
+    assert not os.path.exists(store.path(record['sha256']))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_kept_content_is_evicted_over_the_byte_limit(tmp_path):
+    store = app.AttachmentStore(str(tmp_path), keep_content=True, max_bytes=len(PDF) + len(EXE) - 1)
+    old, _ = store.ingest(iter([EXE]))
+    new, _ = store.ingest(iter([PDF]))
+    assert os.path.exists(store.path(old['sha256']))
+    store.prune()
+    assert not os.path.exists(store.path(old['sha256']))
+    assert os.path.exists(store.path(new['sha256']))
+    assert store.lookup(old['sha256'], touch=False)['stored'] is False
+
+
+def test_old_records_expire(tmp_path):
+    store = app.AttachmentStore(str(tmp_path), keep_content=True, max_age=60)
+    record, _ = store.ingest(iter([PDF]), 'enc-1')
+    with store._connection() as conn:
+        conn.execute("UPDATE attachments SET last_seen = ?", (time.time() - 120,))
+    store.prune()
+    assert store.lookup(record['sha256']) is None
+    assert store.lookup_encoded('enc-1') is None
+    assert not os.path.exists(store.path(record['sha256']))
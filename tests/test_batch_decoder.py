@@ -0,0 +1,160 @@
+import ctypes
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import app
+
+VOCAB = ['<eos>', 'Resposta', ' final\nUs', 'er: oi', 'a\nU', 'nidade', ' ok']
+EOS = 0
+
+
+class FakeLlama:
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list:
+        return [1] + [100 + (byte % 50) for byte in text]
+
+    def detokenize(self, tokens: list) -> bytes:
+        return "".join(VOCAB[token] for token in tokens).encode('utf-8')
+
+
+class FakeBatch:
+    def __init__(self, size: int):
+        self.batch = SimpleNamespace(token=[0] * size, pos=[0] * size, seq_id=[[0] for _ in range(size)],
+                                     n_seq_id=[0] * size, logits=[False] * size, n_tokens=0)
+
+    def reset(self) -> None:
+        self.batch.n_tokens = 0
+
+
+class ScriptedContext:
+    # Cada seq_id devolve, em ordem, logits com o máximo no próximo token do seu roteiro
+    def __init__(self, batch: FakeBatch, scripts: dict):
+        self.batch = batch
+        self.scripts = scripts
+        self.decodes = 0
+        self._buffers = []
+
+    def decode(self, batch) -> None:
+        self.decodes += 1
+
+    def get_logits_ith(self, index: int):
+        token = self.scripts[self.batch.batch.seq_id[index][0]].pop(0)
+        logits = (ctypes.c_float * 200)()
+        logits[token] = 10.0
+        self._buffers.append(logits)
+        return ctypes.cast(logits, ctypes.POINTER(ctypes.c_float))
+
+    def kv_cache_seq_rm(self, seq_id, start, end) -> None:
+        pass
+
+
+def make_decoder(scripts: dict, max_sequences: int = 2) -> app.BatchDecoder:
+    decoder = object.__new__(app.BatchDecoder)
+    decoder.llm = FakeLlama()
+    decoder.max_sequences = max_sequences
+    decoder.n_ctx_per_sequence = 512
+    decoder.n_batch = 64
+    decoder.prefix_tokens = []
+    decoder.batch = FakeBatch(64)
+    decoder.ctx = ScriptedContext(decoder.batch, scripts)
+    decoder.n_vocab = 200
+    decoder.eos = EOS
+    decoder.free_seq_ids = list(range(max_sequences))
+    decoder.sequences = {}
+    decoder.rng = np.random.default_rng(0)
+    decoder.seconds_per_token = 0.0
+    return decoder
+
+
+def sequence(stop: list) -> app._BatchSequence:
+    return app._BatchSequence(1, 0, [1, 2, 3], {'prompt': 'p', 'stop': stop})
+
+
+def feed(seq: app._BatchSequence, pieces: list, final_last: bool = False) -> tuple:
+    emitted, stopped = [], False
+    for i, piece in enumerate(pieces):
+        seq.text += piece
+        text, stopped = app.BatchDecoder._emit(None, seq, final_last and i == len(pieces) - 1)
+        emitted.append(text)
+        if stopped:
+            break
+    return emitted, stopped
+
+
+def test_stop_string_spanning_two_tokens_is_never_emitted():
+    seq = sequence(["\nUser:"])
+    emitted, stopped = feed(seq, ["Resposta", " final\nUs", "er: oi"])
+    assert stopped
+    assert emitted == ["Resposta", " final", ""]
+
+
+def test_held_text_is_released_when_the_stop_does_not_complete():
+    seq = sequence(["\nUser:"])
+    emitted, stopped = feed(seq, ["a\nU", "nidade"])
+    assert not stopped
+    assert emitted == ["a", "\nUnidade"]
+
+
+def test_final_emit_flushes_a_partial_stop():
+    seq = sequence(["\nUser:"])
+    emitted, stopped = feed(seq, ["fim\nUs"], final_last=True)
+    assert emitted == ["fim\nUs"] and not stopped
+
+
+def test_without_stop_strings_nothing_is_held():
+    seq = sequence([])
+    assert feed(seq, ["a\nU", "b"]) == (["a\nU", "b"], False)
+
+
+def test_greedy_sampling_at_temperature_zero():
+    logits = np.array([0.1, 3.0, -2.0, 2.9], dtype=np.float32)
+    assert app._sample_token(logits, 0.0, None) == 1
+    assert app._sample_token(logits, -1.0, None) == 1
+
+
+def test_sampling_stays_within_top_k_and_top_p(monkeypatch):
+    monkeypatch.setattr(app, 'SAMPLING_TOP_K', 2)
+    logits = np.array([5.0, 4.9, 4.8, -1.0], dtype=np.float32)
+    rng = np.random.default_rng(0)
+    assert {app._sample_token(logits, 1.0, rng) for _ in range(200)} == {0, 1}
+    monkeypatch.setattr(app, 'SAMPLING_TOP_P', 0.5)
+    assert {app._sample_token(logits, 1.0, rng) for _ in range(50)} == {0}
+
+
+def test_step_decodes_sequences_independently():
+    # seq 1: a stop string atravessa dois tokens; seq 0: termina por max_tokens
+    decoder = make_decoder({1: [1, 2, 3, 6], 0: [6, 6, 6]})
+    decoder.admit(10, {'prompt': 'pergunta um', 'temperature': 0, 'stop': ["\nUser:"]})
+    decoder.admit(20, {'prompt': 'pergunta dois', 'temperature': 0, 'max_tokens': 2})
+    events = []
+    for _ in range(10):
+        events += decoder.step()
+        if not decoder.sequences:
+            break
+    text = {job: "".join(payload for kind, j, payload in events if kind == 'token' and j == job) for job in (10, 20)}
+    assert text == {10: "Resposta final", 20: " ok ok"}
+    done = {job: payload for kind, job, payload in events if kind == 'done'}
+    assert done[10]['completion_tokens'] == 3 and done[20]['completion_tokens'] == 2
+    assert done[10]['prefix_hit'] is False
+    assert sorted(decoder.free_seq_ids) == [0, 1]
+
+
+def test_eos_finishes_without_emitting_it():
+    decoder = make_decoder({1: [6, EOS]})
+    decoder.admit(10, {'prompt': 'oi', 'temperature': 0})
+    events = decoder.step() + decoder.step()
+    assert [event[:2] for event in events] == [('token', 10), ('done', 10)]
+    assert events[0][2] == " ok"
+    assert events[1][2]['completion_tokens'] == 1
+
+
+@pytest.mark.parametrize('prompt_length', [3, 150])
+def test_long_prompts_are_prefilled_in_chunks(prompt_length):
+    decoder = make_decoder({1: [EOS]})
+    decoder.admit(10, {'prompt': 'x' * prompt_length, 'temperature': 0})
+    steps = 0
+    while decoder.sequences:
+        decoder.step()
+        steps += 1
+    assert steps == -(-(prompt_length + 1) // decoder.n_batch)
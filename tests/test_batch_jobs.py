@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = app.BatchJobStore(str(tmp_path / 'jobs.sqlite3'))
+    monkeypatch.setattr(app, 'batch_store', store)
+    monkeypatch.setattr(app, 'get_cached_response', lambda *key: None)
+    monkeypatch.setattr(app, 'set_cached_response', lambda *args, **kwargs: None)
+    return store
+
+
+def items(*queries):
+    return [app.normalize_batch_item(query, {}) for query in queries]
+
+
+def run_all(store):
+    runner = app.BatchJobRunner(store, 1)
+    while (claimed := store.claim()) is not None:
+        runner._process(*claimed)
+
+
+def test_failures_come_from_exceptions_not_from_the_text(store, monkeypatch):
+    def complete(query, *args, **kwargs):
+        if query == 'quebra':
+            raise RuntimeError('modelo caiu')
+        return 'Erro ao gerar resposta: isto é só o texto pedido'
+    monkeypatch.setattr(app, 'complete_response', complete)
+    batch_id = store.create(items('texto', 'quebra'))
+    run_all(store)
+    ok, broken = store.snapshot(batch_id)['items']
+    assert ok['status'] == 'done'
+    assert ok['result'].startswith('Erro ao gerar resposta:')
+    assert broken['status'] == 'error'
+    assert broken['error'] == 'modelo caiu'
+
+
+def test_select_returns_only_chosen_items_with_full_counts(store, monkeypatch):
+    monkeypatch.setattr(app, 'complete_response', lambda query, *args, **kwargs: f'resposta {query}')
+    batch_id = store.create(items('a', 'b', 'a'))
+    store.finish(*store.claim()[:2], 'done', 'resposta a')
+    snapshot = store.snapshot(batch_id, select=lambda idx, status: idx == 2)
+    assert snapshot['counts'] == {'done': 2, 'queued': 1}
+    assert snapshot['total'] == 3
+    [duplicate] = snapshot['items']
+    assert duplicate['index'] == 2
+    assert duplicate['status'] == 'done'
+    assert duplicate['result'] == 'resposta a'
+
+
+def test_progress_stream_sends_each_item_once(store, monkeypatch):
+    monkeypatch.setattr(app, 'complete_response', lambda query, *args, **kwargs: f'resposta {query}')
+    monkeypatch.setattr(app, 'BATCH_PROGRESS_INTERVAL', 0)
+    batch_id = store.create(items('a', 'b', 'a'))
+    run_all(store)
+    response = app.app.test_client().get(f'/jobs/{batch_id}/stream')
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [line['index'] for line in lines[:-1]] == [0, 1, 2]
+    assert lines[-1]['type'] == 'batch'
+    assert lines[-1]['counts'] == {'done': 3}
@@ -0,0 +1,38 @@
+import app
+
+
+def test_least_recently_used_entry_is_evicted_by_count():
+    cache = app.BoundedTTLCache('test-count', 2, 1024, 3600)
+    cache.set('a', 'x')
+    cache.set('b', 'y')
+    assert cache.get('a') == 'x'
+    cache.set('c', 'z')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'x'
+    assert cache.get('c') == 'z'
+
+
+def test_total_bytes_are_bounded():
+    cache = app.BoundedTTLCache('test-bytes', 100, 50, 3600)
+    cache.set('a', 'x' * 20)
+    cache.set('b', 'y' * 20)
+    cache.set('c', 'z' * 20)
+    assert cache.get('a') is None
+    assert cache.get('b') == 'y' * 20
+    assert cache._store.currsize <= 50
+
+
+def test_entry_larger_than_the_limit_is_not_stored():
+    cache = app.BoundedTTLCache('test-oversized', 100, 50, 3600)
+    cache.set('small', 'ok')
+    cache.set('big', 'x' * 100)
+    assert cache.get('big') is None
+    assert cache.get('small') == 'ok'
+
+
+def test_each_entry_expires_with_its_own_ttl():
+    cache = app.BoundedTTLCache('test-ttl', 100, 1024, 3600)
+    cache.set('expired', 'x', ttl=-1)
+    cache.set('fresh', 'y')
+    assert cache.get('expired') is None
+    assert cache.get('fresh') == 'y'
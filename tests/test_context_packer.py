@@ -0,0 +1,58 @@
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def char_estimate(monkeypatch):
+    # Estimativa por caracteres: o resultado não depende do tokenizador do modelo
+    monkeypatch.setattr(app, 'get_prompt_tokenizer', lambda: None)
+
+
+def result(title, body, href='https://example.com'):
+    return {'title': title, 'body': body, 'href': href}
+
+
+def test_blocks_stay_within_the_budget():
+    packer = app.ContextPacker('alvo', '', 300, 2)
+    results = [result(f'Título {i} alvo', f'Texto único número {i} ' * 10) for i in range(20)]
+    first = packer.pack('Sites', results)
+    second = packer.pack('Notícias', [result(f'Outro {i}', f'Notícia diferente {i} ' * 10) for i in range(20)])
+    assert app.count_tokens(first) <= 150
+    assert app.count_tokens(first) + app.count_tokens(second) <= 300
+    report = packer.report()
+    assert report['packed_tokens'] <= 300
+    assert report['over_budget'] > 0
+    assert report['budget_tokens'] == 300
+
+
+def test_unused_share_passes_to_the_next_block():
+    packer = app.ContextPacker('alvo', '', 400, 2)
+    assert packer.pack('Sites', []) == ""
+    block = packer.pack('Notícias', [result(f'Notícia {i}', f'Conteúdo diferente {i} ' * 10) for i in range(20)])
+    assert app.count_tokens(block) > 200
+
+
+def test_near_duplicates_are_dropped_across_blocks():
+    packer = app.ContextPacker('alvo', '', 2000, 2)
+    body = 'o alvo foi visto em um fórum vendendo credenciais de acesso a sistemas internos'
+    first = packer.pack('Sites', [result('Alvo no fórum', body)])
+    second = packer.pack('Notícias', [result('Alvo no fórum', body + '!'), result('Outra coisa', 'sem relação alguma')])
+    assert 'fórum' in first
+    assert 'fórum' not in second
+    assert 'Outra coisa' in second
+    assert packer.report()['duplicates'] == 1
+
+
+def test_most_relevant_results_come_first():
+    packer = app.ContextPacker('acme corp', 'vazamento', 2000, 1)
+    block = packer.pack('Sites', [result('Receita de bolo', 'farinha e ovos'),
+                                  result('Acme Corp vazamento', 'dados da acme corp expostos em vazamento')])
+    assert block.index('Acme Corp vazamento') < block.index('Receita de bolo')
+
+
+def test_markup_is_removed_from_snippets():
+    packer = app.ContextPacker('alvo', '', 2000, 1)
+    block = packer.pack('Sites', [result('<b>Alvo</b>', '<p>texto &amp; mais</p>')])
+    assert '<b>' not in block and '<p>' not in block
+    assert 'Alvo' in block
@@ -0,0 +1,79 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import app
+
+BASE = 0x0123456789ABCDEF
+
+
+def flip(value, bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+@pytest.fixture
+def index(tmp_path):
+    return app.ImageHashIndex(str(tmp_path))
+
+
+def test_matches_are_ordered_by_distance_within_the_limit(index):
+    index.add('https://a/near', 'caso', 'sha-near', flip(BASE, [1, 2]), BASE)
+    index.add('https://a/same', 'caso', 'sha-same', BASE, BASE)
+    index.add('https://a/far', 'caso', 'sha-far', flip(BASE, range(20)), BASE)
+    result = index.search(BASE, BASE, max_distance=10)
+    assert result['searched'] == 3
+    assert [(m['url'], m['phash_distance']) for m in result['matches']] == [('https://a/same', 0), ('https://a/near', 2)]
+    assert result['matches'][0]['case'] == 'caso'
+    assert [m['url'] for m in index.search(BASE, max_distance=10, limit=1)['matches']] == ['https://a/same']
+
+
+def test_dhash_breaks_ties(index):
+    index.add('https://a/1', 'caso', 'sha-1', BASE, flip(BASE, range(5)))
+    index.add('https://a/2', 'caso', 'sha-2', BASE, flip(BASE, [0]))
+    matches = index.search(BASE, BASE)['matches']
+    assert [(m['url'], m['dhash_distance']) for m in matches] == [('https://a/2', 1), ('https://a/1', 5)]
+
+
+def test_repeated_image_in_the_same_case_is_ignored(index):
+    assert index.add('https://a/1', 'caso', 'sha', BASE, BASE)
+    assert not index.add('https://a/1', 'caso', 'sha', BASE, BASE)
+    assert index.add('https://a/1', 'outro', 'sha', BASE, BASE)
+    assert len(index) == 2
+
+
+def test_index_is_reloaded_from_disk(tmp_path, index):
+    index.add_many([(f'https://a/{i}', 'caso', f'sha-{i}', flip(BASE, [i]), BASE, None) for i in range(40)])
+    reopened = app.ImageHashIndex(str(tmp_path))
+    assert len(reopened) == 40
+    assert {m['url'] for m in reopened.search(flip(BASE, [3]), max_distance=0)['matches']} == {'https://a/3'}
+
+
+def test_partial_record_and_missing_rows_are_repaired_on_load(tmp_path, index):
+    index.add('https://a/1', 'caso', 'sha-1', BASE, BASE)
+    index.add('https://a/2', 'caso', 'sha-2', flip(BASE, [0]), BASE)
+    # Queda no meio da escrita do segundo registro no arquivo binário
+    with open(index.array_path, 'r+b') as f:
+        f.truncate(24 + 10)
+    reopened = app.ImageHashIndex(str(tmp_path))
+    assert len(reopened) == 2
+    assert [m['url'] for m in reopened.search(flip(BASE, [0]), max_distance=0)['matches']] == ['https://a/2']
+
+
+def test_similar_images_have_close_hashes():
+    blocks = np.random.default_rng(0).integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    image = Image.fromarray(blocks).resize((128, 128), Image.Resampling.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=60)
+    recompressed = Image.open(io.BytesIO(buffer.getvalue()))
+    resized = image.resize((96, 96))
+    phash, dhash = app.image_hashes(image)
+    for other in (recompressed, resized):
+        other_phash, other_dhash = app.image_hashes(other)
+        assert bin(phash ^ other_phash).count('1') <= app.PHASH_DEFAULT_DISTANCE
+        assert bin(dhash ^ other_dhash).count('1') <= app.PHASH_DEFAULT_DISTANCE
+    mirrored_phash, _ = app.image_hashes(image.transpose(Image.Transpose.FLIP_LEFT_RIGHT))
+    assert bin(phash ^ mirrored_phash).count('1') > app.PHASH_DEFAULT_DISTANCE
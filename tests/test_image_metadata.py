@@ -0,0 +1,126 @@
+import io
+
+import numpy as np
+import pytest
+import requests
+from PIL import Image
+
+import app
+
+XMP_PACKET = (b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+              b'<rdf:Description xmlns:xmp="http://ns.adobe.com/xap/1.0/" xmp:CreatorTool="teste"/></rdf:RDF></x:xmpmeta>')
+
+
+def photo_exif() -> Image.Exif:
+    exif = Image.Exif()
+    exif[0x010F] = 'TestCam'
+    exif[0x0110] = 'Model X'
+    exif[0x0132] = '2024:01:01 12:00:00'
+    exif.get_ifd(0x8769)[0x9003] = '2024:01:01 12:00:00'
+    gps = exif.get_ifd(0x8825)
+    gps[1], gps[2] = 'S', (23.0, 33.0, 1.5)
+    gps[3], gps[4] = 'W', (46.0, 38.0, 2.25)
+    return exif
+
+
+def noise(side: int) -> Image.Image:
+    return Image.fromarray(np.random.default_rng(7).integers(0, 256, (side, side, 3), dtype=np.uint8))
+
+
+def jpeg_photo(side: int = 800) -> bytes:
+    out = io.BytesIO()
+    noise(side).save(out, 'JPEG', quality=95, exif=photo_exif(), xmp=XMP_PACKET)
+    return out.getvalue()
+
+
+def png_photo(side: int = 400) -> bytes:
+    out = io.BytesIO()
+    noise(side).save(out, 'PNG', exif=photo_exif())
+    return out.getvalue()
+
+
+def with_leading_segments(jpeg: bytes, count: int, size: int = 60000) -> bytes:
+    # Segmentos APP2 de preenchimento logo após o SOI empurram o EXIF para depois da primeira faixa
+    padding = b''.join(b'\xff\xe2' + (size + 2).to_bytes(2, 'big') + bytes(size) for _ in range(count))
+    return jpeg[:2] + padding + jpeg[2:]
+
+
+def legacy_metadata(url: str) -> dict:
+    # Caminho antigo: download completo e Image.open sobre o arquivo inteiro
+    image = Image.open(io.BytesIO(requests.get(url, timeout=10).content))
+    meta = app.exif_to_metadata(image.getexif())
+    meta["Dimensions"] = f"{image.size[0]}x{image.size[1]}"
+    return meta
+
+
+def test_range_server_reads_only_the_header(image_server):
+    payload = jpeg_photo()
+    assert len(payload) > 4 * app.METADATA_INITIAL_BYTES
+    server = image_server({'/photo.jpg': payload})
+    fetched = app.fetch_image_head(server.url('/photo.jpg'))
+    assert fetched['ranged'] and fetched['complete']
+    assert fetched['requests'] == 1
+    assert fetched['bytes_transferred'] == app.METADATA_INITIAL_BYTES
+    assert fetched['total_size'] == len(payload)
+    assert server.requests[0]['range'] == f"bytes=0-{app.METADATA_INITIAL_BYTES - 1}"
+    assert app.parse_image_metadata(fetched['data'])['Make'] == 'TestCam'
+
+
+def test_server_ignoring_range_stops_at_max_bytes(image_server):
+    # Formato desconhecido: o buffer dobra até o limite e a leitura do corpo para ali
+    payload = bytes(np.random.default_rng(1).integers(0, 256, 2 * 1024 * 1024, dtype=np.uint8))
+    server = image_server({'/blob': payload}, honor_range=False)
+    max_bytes = 256 * 1024
+    fetched = app.fetch_image_head(server.url('/blob'), max_bytes=max_bytes)
+    assert not fetched['ranged']
+    assert fetched['requests'] == 1
+    assert fetched['bytes_transferred'] == max_bytes
+    assert fetched['total_size'] == len(payload)
+    assert not fetched['complete']
+
+
+def test_server_ignoring_range_streams_only_the_header(image_server):
+    payload = jpeg_photo()
+    server = image_server({'/photo.jpg': payload}, honor_range=False)
+    fetched = app.fetch_image_head(server.url('/photo.jpg'))
+    assert not fetched['ranged'] and fetched['complete']
+    assert fetched['bytes_transferred'] < len(payload)
+    assert app.parse_image_metadata(fetched['data']) == app.parse_image_metadata(payload)
+
+
+def test_exif_after_the_first_range_triggers_a_second_read(image_server):
+    payload = with_leading_segments(jpeg_photo(), 2)
+    assert payload.index(b'Exif\x00\x00') > app.METADATA_INITIAL_BYTES
+    server = image_server({'/photo.jpg': payload})
+    fetched = app.fetch_image_head(server.url('/photo.jpg'))
+    assert fetched['requests'] == 2
+    assert fetched['complete']
+    assert fetched['bytes_transferred'] < len(payload)
+    assert server.requests[1]['range'].startswith(f"bytes={app.METADATA_INITIAL_BYTES}-")
+    assert app.parse_image_metadata(fetched['data'])['Model'] == 'Model X'
+
+
+def test_conditional_request_reuses_cached_metadata_on_304(image_server):
+    server = image_server({'/photo.jpg': jpeg_photo()})
+    url = server.url('/photo.jpg')
+    first = app.analyze_image_metadata(url)
+    assert 'Cache' not in first
+    second = app.analyze_image_metadata(url)
+    assert second["Cache"] == "revalidado (304)"
+    assert second["Bytes transferidos"] == 0
+    assert server.requests[1]['if_none_match'] is not None
+    transfer = ("Cache", "Bytes transferidos", "Requisições HTTP", "Tamanho do arquivo")
+    assert {k: v for k, v in second.items() if k not in transfer} == {k: v for k, v in first.items() if k not in transfer}
+
+
+@pytest.mark.parametrize('payload', [jpeg_photo(), with_leading_segments(jpeg_photo(), 2), png_photo()],
+                         ids=['jpeg', 'jpeg-exif-late', 'png'])
+def test_ranged_metadata_matches_the_full_download(image_server, payload):
+    server = image_server({'/image': payload})
+    url = server.url('/image')
+    fetched = app.fetch_image_head(url)
+    meta = app.parse_image_metadata(fetched['data'])
+    meta.pop("XMP", None)
+    assert meta == legacy_metadata(url)
+    assert meta["GPSInfo"]["GPSLatitudeRef"] == 'S'
+    assert fetched['bytes_transferred'] < len(payload)
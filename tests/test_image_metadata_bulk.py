@@ -0,0 +1,108 @@
+import concurrent.futures
+import io
+import json
+import threading
+import time
+
+import pytest
+import requests
+from PIL import Image
+
+import app
+
+
+def small_jpeg(seed: int) -> bytes:
+    exif = Image.Exif()
+    exif[0x010F] = f'Cam {seed}'
+    out = io.BytesIO()
+    Image.new('RGB', (64, 48), (seed % 256, 0, 0)).save(out, 'JPEG', exif=exif)
+    return out.getvalue()
+
+
+def records(lines) -> tuple:
+    parsed = [json.loads(line) for line in lines]
+    assert parsed[-1]['type'] == 'summary'
+    return parsed[:-1], parsed[-1]
+
+
+@pytest.fixture
+def thread_parse_pool(monkeypatch):
+    # Parsing em threads do próprio processo, para que os wrappers de contagem valham lá também
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+    monkeypatch.setattr(app, 'get_analysis_pool', lambda: pool)
+    yield pool
+    pool.shutdown(wait=True)
+
+
+def test_connections_per_host_stay_within_the_pool_size(image_server, thread_parse_pool, monkeypatch):
+    # Sessão sem pool_block: o limite por host precisa vir do despacho, não do adaptador
+    session = requests.Session()
+    monkeypatch.setattr(app, 'get_metadata_session', lambda: session)
+    servers = [image_server({f'/{i}.jpg': small_jpeg(i) for i in range(12)}, delay=0.1) for _ in range(2)]
+    urls = [server.url(f'/{i}.jpg') for server in servers for i in range(12)]
+    items, summary = records(app.stream_image_metadata(urls))
+    assert summary['ok'] == len(urls)
+    for server in servers:
+        assert len(server.requests) == 12
+        assert 1 < server.max_active <= app.METADATA_POOL_MAXSIZE
+
+
+def test_images_in_flight_stay_within_the_bound(image_server, thread_parse_pool, monkeypatch):
+    bound = 3
+    monkeypatch.setattr(app, 'METADATA_BULK_INFLIGHT', bound)
+    lock = threading.Lock()
+    state = {'inflight': 0, 'peak': 0}
+    fetch, parse = app.fetch_image_for_metadata, app.image_metadata_from_bytes
+
+    def counting_fetch(*args, **kwargs):
+        with lock:
+            state['inflight'] += 1
+            state['peak'] = max(state['peak'], state['inflight'])
+        return fetch(*args, **kwargs)
+
+    def counting_parse(*args, **kwargs):
+        time.sleep(0.05)
+        try:
+            return parse(*args, **kwargs)
+        finally:
+            with lock:
+                state['inflight'] -= 1
+
+    monkeypatch.setattr(app, 'fetch_image_for_metadata', counting_fetch)
+    monkeypatch.setattr(app, 'image_metadata_from_bytes', counting_parse)
+    # Quatro hosts com 4 conexões cada permitiriam 16 downloads; o limite em memória é 3
+    servers = [image_server({f'/{i}.jpg': small_jpeg(i) for i in range(5)}, delay=0.05) for _ in range(4)]
+    urls = [server.url(f'/{i}.jpg') for server in servers for i in range(5)]
+    items, summary = records(app.stream_image_metadata(urls))
+    assert summary['ok'] == len(urls)
+    assert state['inflight'] == 0
+    assert 1 < state['peak'] <= bound
+
+
+def test_second_run_is_served_from_the_etag_cache(image_server, thread_parse_pool):
+    server = image_server({'/a.jpg': small_jpeg(1), '/b.jpg': small_jpeg(2)})
+    urls = [server.url('/a.jpg'), server.url('/b.jpg')]
+    first, summary = records(app.stream_image_metadata(urls))
+    assert summary['cache_hits'] == 0 and {item['cache'] for item in first} == {'miss'}
+    second, summary = records(app.stream_image_metadata(urls))
+    assert summary['cache_hits'] == 2 and {item['cache'] for item in second} == {'hit'}
+    assert all(request['if_none_match'] for request in server.requests[2:])
+    assert {item['index']: item['metadata'] for item in second} == {item['index']: item['metadata'] for item in first}
+    assert all(item['bytes_transferred'] == 0 for item in second)
+
+
+def test_bulk_route_reports_every_index_exactly_once(image_server):
+    server = image_server({f'/{i}.jpg': small_jpeg(i) for i in range(6)})
+    urls = [server.url(f'/{i}.jpg') for i in range(6)]
+    urls[2] = 'ftp://example.com/x.jpg'
+    urls[4] = server.url('/missing.jpg')
+    response = app.app.test_client().post('/image_metadata/bulk', json={'urls': urls})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    items, summary = records(response.get_data(as_text=True).splitlines())
+    assert sorted(item['index'] for item in items) == list(range(len(urls)))
+    assert all(item['url'] == urls[item['index']] for item in items)
+    assert {item['index'] for item in items if 'error' in item} == {2, 4}
+    assert summary['ok'] == 4 and summary['errors'] == 2
+    ok = {item['index']: item for item in items if 'error' not in item}
+    assert ok[0]['metadata']['Make'] == 'Cam 0'
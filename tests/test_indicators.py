@@ -0,0 +1,42 @@
+import random
+
+import app
+
+
+def legacy_scan(text):
+    # Laço anterior: um findall por padrão no texto inteiro
+    found = {}
+    for key, pattern in app.COMPILED_REGEX_PATTERNS.items():
+        matches = pattern.findall(text)
+        if matches:
+            found[key] = set(matches)
+    return found
+
+
+def scanned(data):
+    return {key: set(values) for key, values in app.FORENSIC_INDICATOR_SCANNER.scan(data).items()}
+
+
+def test_overlapping_kinds_are_not_truncated():
+    text = 'see https://user+tag@mail.com now'
+    result = scanned(text)
+    assert result == legacy_scan(text)
+    assert result['email'] == {'user+tag@mail.com'}
+
+
+def test_order_of_first_appearance():
+    result = app.FORENSIC_INDICATOR_SCANNER.scan('10.0.0.2 x 10.0.0.1 y 10.0.0.2')
+    assert result['ip'] == ['10.0.0.2', '10.0.0.1']
+
+
+def test_matches_per_pattern_loop_on_random_text():
+    pieces = ['see', 'https://user+tag@mail.com', 'now', '1.2.3.4', 'a.b.c', '+55 11 91234-5678', 'aa:bb:cc:dd:ee:ff',
+              'x@y.io', '(11) 2345-6789', 'foo-bar.example.org', 'http://1.2.3.4:80/a', '\n', '\t', '-', '.', '@', '::',
+              'fe80:0:0:0:0:0:0:1', 'mail.com.', 'x', '100-200-300-400', 'a_b@c.de']
+    separators = [' ', '', '  ', '\n', ',']
+    rng = random.Random(1)
+    for _ in range(3000):
+        text = ''.join(rng.choice(pieces) + rng.choice(separators) for _ in range(rng.randint(1, 12)))
+        expected = legacy_scan(text)
+        assert scanned(text) == expected, text
+        assert scanned(text.encode()) == expected, text
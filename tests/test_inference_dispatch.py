@@ -0,0 +1,61 @@
+import threading
+
+import app
+
+
+class FakeProcess:
+    def is_alive(self):
+        return True
+
+
+class FakeScheduler:
+    def __init__(self, worker, job):
+        self.worker = worker
+        self.jobs = [job]
+
+    def next_job(self, timeout):
+        if self.jobs:
+            return self.jobs.pop()
+        self.worker.stopping = True
+        return None
+
+    def requeue(self, job):
+        raise AssertionError("job não deveria voltar para a fila")
+
+
+class CancellingGauge:
+    # INFERENCE_INFLIGHT.inc() roda entre a retirada da fila e o envio: cancela o job nesse intervalo
+    def __init__(self, job):
+        self.job = job
+        self.value = 0
+
+    def inc(self):
+        self.value += 1
+        self.job.cancel()
+
+    def dec(self):
+        self.value -= 1
+
+
+def test_job_cancelled_after_dequeue_is_not_sent(monkeypatch):
+    job = app.InferenceJob({'messages': []}, app.PRIORITY_CHAT)
+    worker = app.InferenceWorker(None, 0, {})
+    worker.scheduler = FakeScheduler(worker, job)
+    worker.process = FakeProcess()
+    worker.slots = threading.BoundedSemaphore(1)
+    worker.ready.set()
+    sent = []
+    worker.send = sent.append
+    gauge = CancellingGauge(job)
+    monkeypatch.setattr(app, 'INFERENCE_INFLIGHT', gauge)
+    loop = threading.Thread(target=worker._dispatch_loop, daemon=True)
+    loop.start()
+    loop.join(timeout=5)
+    worker.stopping = True
+    assert not loop.is_alive(), "a vaga do job cancelado não foi devolvida"
+    assert not [msg for msg in sent if msg[0] == 'run']
+    assert job.cancelled and job.done
+    assert worker.jobs == {}
+    assert gauge.value == 0
+    # A vaga foi devolvida
+    assert worker.slots.acquire(blocking=False)
@@ -0,0 +1,63 @@
+import pytest
+
+import app
+
+
+class FakeJob:
+    def __init__(self, params):
+        self.params = params
+        self.extended = []
+        self.cancelled = False
+
+    def extend(self, text, final=False):
+        self.extended.append(text)
+
+    def iter_tokens(self):
+        yield 'relatório'
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeScheduler:
+    def __init__(self, batched):
+        self._batched = batched
+        self.jobs = []
+
+    def batched(self):
+        return self._batched
+
+    def submit(self, messages, temperature, max_tokens, stop=None, priority=app.PRIORITY_CHAT, prompt=None,
+               open_prompt=False):
+        self.jobs.append(FakeJob({'prompt': prompt, 'open': open_prompt}))
+        return self.jobs[-1]
+
+
+def run(monkeypatch, batched):
+    scheduler = FakeScheduler(batched)
+    monkeypatch.setattr(app, 'inference_scheduler', scheduler)
+    submitted_before_search = []
+
+    def searches(*args, **kwargs):
+        submitted_before_search.append(len(scheduler.jobs))
+        yield from original(*args, **kwargs)
+    original = app.iter_searches
+    monkeypatch.setattr(app, 'iter_searches', searches)
+    events = list(app.run_investigation('alvo', 3, autocorrect=False, search_news=True))
+    assert ('token', 'relatório') in events
+    assert len(scheduler.jobs) == 1
+    return scheduler.jobs[0], submitted_before_search[0]
+
+
+@pytest.mark.parametrize('batched', [True, False])
+def test_prompt_is_opened_early_only_when_batched(search_env, monkeypatch, batched):
+    search_env(app.StaticSearchBackend())
+    job, submitted_before_search = run(monkeypatch, batched)
+    assert submitted_before_search == int(batched)
+    assert job.params['open'] is batched
+    prompt = job.params['prompt'] + "".join(job.extended)
+    assert prompt.startswith(app.system_prompt_prefix(app.INVESTIGATION_SYSTEM_PROMPT))
+    assert prompt.endswith(app.INVESTIGATION_CLOSING + " [/INST]")
+    assert prompt.count(app.INVESTIGATION_SECTIONS['web'][0]) == 1
+    assert prompt.count(app.INVESTIGATION_SECTIONS['news'][0]) == 1
+    assert job.cancelled
@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+PT = app.LANGUAGE_MAP['Português']
+ENGLISH_TEXT = ("The attacker used a phishing campaign to steal credentials and then moved laterally "
+                "across the network before exfiltrating the database.")
+
+
+@pytest.fixture
+def language_env(monkeypatch):
+    monkeypatch.setattr(app, 'language_cache', app.BoundedTTLCache('language_test', 100, 1 << 20, 60))
+    monkeypatch.setattr(app, 'translation_cache', app.BoundedTTLCache('translation_test', 100, 1 << 20, 60))
+    calls = {'detect': 0, 'model': 0}
+
+    def detect(result):
+        def fake_detect_langs(sample):
+            calls['detect'] += 1
+            return [SimpleNamespace(lang=lang, prob=prob) for lang, prob in result]
+        monkeypatch.setattr(app, 'detect_langs', fake_detect_langs)
+
+    def fake_completion(messages, **kwargs):
+        calls['model'] += 1
+        return "O atacante usou uma campanha de phishing."
+
+    monkeypatch.setattr(app, 'run_chat_completion', fake_completion)
+    return SimpleNamespace(detect=detect, calls=calls)
+
+
+def test_low_confidence_detection_keeps_the_text(language_env):
+    language_env.detect([('en', 0.6), ('pt', 0.4)])
+    assert app.validate_language(ENGLISH_TEXT, PT) == ENGLISH_TEXT
+    assert language_env.calls == {'detect': 1, 'model': 0}
+
+
+def test_matching_language_skips_the_model(language_env):
+    language_env.detect([('pt', 0.99)])
+    assert app.validate_language(ENGLISH_TEXT, PT) == ENGLISH_TEXT
+    assert language_env.calls['model'] == 0
+
+
+def test_short_samples_are_not_detected(language_env):
+    language_env.detect([('en', 0.99)])
+    assert app.validate_language("ok https://example.com/very/long/url 12345", PT).startswith("ok")
+    assert language_env.calls == {'detect': 0, 'model': 0}
+
+
+def test_repeated_correction_hits_the_translation_cache(language_env):
+    language_env.detect([('en', 0.99)])
+    first = app.validate_language(ENGLISH_TEXT, PT)
+    assert first == "[Traduzido]\nO atacante usou uma campanha de phishing."
+    second = app.validate_language(ENGLISH_TEXT, PT)
+    assert second == first
+    # A detecção também vem do cache por conteúdo; o modelo roda uma única vez
+    assert language_env.calls == {'detect': 1, 'model': 1}
+
+
+def test_translation_cache_is_per_target_language(language_env):
+    language_env.detect([('en', 0.99)])
+    app.correct_language(ENGLISH_TEXT, PT)
+    app.correct_language(ENGLISH_TEXT, app.LANGUAGE_MAP['Español'])
+    app.correct_language(ENGLISH_TEXT, PT)
+    assert language_env.calls['model'] == 2
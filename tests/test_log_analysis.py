@@ -0,0 +1,85 @@
+import gzip
+import io
+import re
+
+import pytest
+
+import app
+
+LINES = [
+    "2024-05-01T12:00:01Z INFO user 1001 logged in from 10.0.0.5",
+    "2024-05-01T12:00:02Z ERROR disk /dev/sda1 at 97% capacity",
+    "May  1 12:01:03 host sshd[412]: WARNING failed password for root from 203.0.113.9",
+    "2024-05-01T13:10:00Z warning retry 3 of 5 — conexão recusada",
+    "sem timestamp nem nível, só texto com acentuação: ação, coração",
+    "2024-05-01 13:59:59 CRIT kernel panic error error",
+    "",
+    "2024-05-01T14:00:00+03:00 DEBUG cache miss key=abc123",
+]
+
+
+def legacy_siem(logs: str) -> dict:
+    # Campos da resposta original de /log_analysis
+    return {
+        'error_count': len(re.findall(r'ERROR|error', logs)),
+        'warning_count': len(re.findall(r'WARNING|warning', logs)),
+        'total_lines': len(logs.splitlines()),
+        'sample_lines': logs.splitlines()[:5],
+    }
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    # Linhas de tamanhos variados, CRLF e caracteres multibyte para cortar em qualquer posição
+    body = "".join(f"{line}\r\n" if i % 3 == 0 else f"{line}\n" for i, line in enumerate(LINES * 7))
+    path = tmp_path / 'app.log'
+    path.write_bytes(body.encode('utf-8'))
+    return path
+
+
+def test_any_split_merges_to_the_single_range_result(log_file):
+    size = log_file.stat().st_size
+    whole = app._analyze_log_range(str(log_file), 0, size).to_dict()
+    assert whole['total_lines'] == len(LINES) * 7
+    for first in range(1, size, 7):
+        second = min(size, first + 97)
+        merged = app.LogAggregates()
+        for start, end in ((0, first), (first, second), (second, size)):
+            merged.merge(app._analyze_log_range(str(log_file), start, end))
+        assert merged.to_dict() == whole, f"cortes em {first} e {second}"
+
+
+def test_parallel_file_analysis_matches_the_text_path(log_file, monkeypatch):
+    monkeypatch.setattr(app, 'SIEM_PARALLEL_MIN_BYTES', 0)
+    monkeypatch.setattr(app, 'ANALYSIS_PROCESS_WORKERS', 3)
+    result = app.analyze_log_file(str(log_file))
+    assert result['chunks'] == 3
+    expected = app.analyze_logs_for_siem(log_file.read_text(encoding='utf-8'))
+    assert {key: result[key] for key in expected} == expected
+
+
+def test_gzip_file_matches_the_plain_file(log_file, tmp_path):
+    compressed = tmp_path / 'app.log.gz'
+    compressed.write_bytes(gzip.compress(log_file.read_bytes()))
+    plain = app.analyze_log_file(str(log_file))
+    result = app.analyze_log_file(str(compressed))
+    assert result['compressed'] and not plain['compressed']
+    assert result['bytes'] == compressed.stat().st_size
+    volatile = ('bytes', 'compressed', 'chunks', 'elapsed')
+    assert {k: v for k, v in result.items() if k not in volatile} == {k: v for k, v in plain.items() if k not in volatile}
+
+
+def test_endpoint_keeps_the_legacy_fields(log_file):
+    client = app.app.test_client()
+    logs = log_file.read_text(encoding='utf-8')
+    expected = legacy_siem(logs.replace('\r\n', '\n'))
+    uploaded = client.post('/log_analysis', data={'log_file': (io.BytesIO(log_file.read_bytes()), 'app.log')},
+                           content_type='multipart/form-data')
+    assert uploaded.status_code == 200
+    form = client.post('/log_analysis', data={'logs': logs.replace('\r\n', '\n')})
+    assert form.status_code == 200
+    for response in (uploaded, form):
+        body = response.get_json()
+        assert {key: body[key] for key in expected} == expected
+        assert isinstance(body['level_counts'], dict) and isinstance(body['top_templates'], list)
+    assert client.post('/log_analysis', data={}).status_code == 400
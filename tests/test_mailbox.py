@@ -0,0 +1,138 @@
+import base64
+import io
+import os
+import tarfile
+import zipfile
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+
+import pytest
+
+import app
+
+MESSAGE = b"From: a@example.com\nSubject: %s\n\ncorpo %s\n"
+MBOX = (b"From a@example.com Mon Jan  1 00:00:00 2024\n" + MESSAGE % (b'um', b'um') +
+        b">From the archive\nnot a From separator\n\n"
+        b"From b@example.com Mon Jan  1 00:00:00 2024\n" + MESSAGE % (b'dois', b'dois') + b"\n")
+
+
+def messages(entries):
+    return [(source, raw, error) for source, raw, error in entries]
+
+
+def test_mbox_is_split_per_message_with_offsets():
+    entries = messages(app.iter_mbox_messages(io.BytesIO(MBOX), 'caixa'))
+    assert [source for source, _, _ in entries] == ['caixa@0', f'caixa@{MBOX.index(b"From b@")}']
+    first = entries[0][1]
+    assert b"\nFrom the archive\n" in first  # mboxrd: um '>' a menos
+    assert b"not a From separator" in first
+    assert b"Subject: dois" in entries[1][1]
+    assert all(error is None for _, _, error in entries)
+
+
+def test_oversized_mbox_message_is_reported_without_content(monkeypatch):
+    monkeypatch.setattr(app, 'EMAIL_BULK_MAX_MESSAGE_BYTES', 40)
+    entries = messages(app.iter_mbox_messages(io.BytesIO(MBOX)))
+    assert len(entries) == 2
+    assert all(raw is None and error for _, raw, error in entries)
+
+
+def zip_mailbox():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('Maildir/cur/1', MESSAGE % (b'cur', b'cur'))
+        archive.writestr('Maildir/new/2', MESSAGE % (b'new', b'new'))
+        archive.writestr('Maildir/tmp/3', MESSAGE % (b'tmp', b'tmp'))
+        archive.writestr('export/arquivo.mbox', MBOX)
+    buffer.seek(0)
+    return buffer
+
+
+def test_zip_maildir_skips_tmp_and_splits_nested_mbox():
+    buffer = zip_mailbox()
+    assert app.detect_mailbox_format(buffer) == 'zip'
+    sources = [source for source, _, _ in app.iter_mailbox_messages(buffer, 'zip')]
+    assert sources[:2] == ['Maildir/cur/1', 'Maildir/new/2']
+    assert sources[2:] == ['export/arquivo.mbox@0', f'export/arquivo.mbox@{MBOX.index(b"From b@")}']
+
+
+def test_tar_gz_is_read_as_a_stream():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for name, data in (('cur/1.eml', MESSAGE % (b'a', b'a')), ('tmp/2.eml', MESSAGE % (b'b', b'b'))):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    buffer.seek(0)
+    assert app.detect_mailbox_format(buffer) == 'tar'
+    entries = messages(app.iter_mailbox_messages(buffer, 'tar'))
+    assert [(source, raw) for source, raw, _ in entries] == [('cur/1.eml', MESSAGE % (b'a', b'a'))]
+
+
+def test_plain_message_and_mbox_are_detected():
+    assert app.detect_mailbox_format(io.BytesIO(MBOX)) == 'mbox'
+    assert app.detect_mailbox_format(io.BytesIO(MESSAGE % (b'x', b'x'))) == 'eml'
+
+
+def attachment_part(data, encoding):
+    message = EmailMessage()
+    message.set_content("corpo")
+    if encoding == 'quoted-printable':
+        message.add_attachment(data.decode('latin-1'), subtype='plain', charset='latin-1', cte=encoding,
+                               disposition='attachment', filename='a.txt')
+    else:
+        message.add_attachment(data, maintype='application', subtype='octet-stream', cte=encoding,
+                               filename='a.bin')
+    parsed = BytesParser(policy=policy.default).parsebytes(message.as_bytes())
+    return [part for part in parsed.walk() if part.get_filename()][0]
+
+
+@pytest.mark.parametrize('encoding', ['base64', 'quoted-printable'])
+@pytest.mark.parametrize('chunk_chars', [7, 76, 4096])
+def test_payload_chunks_match_the_standard_decoder(monkeypatch, encoding, chunk_chars):
+    monkeypatch.setattr(app, 'EMAIL_DECODE_CHUNK_CHARS', chunk_chars)
+    data = os.urandom(3000) if encoding == 'base64' else (b"linha com acento \xe9 e = sinal\n" * 120)
+    part = attachment_part(data, encoding)
+    assert b''.join(app._iter_payload_bytes(part)) == part.get_payload(decode=True)
+
+
+@pytest.mark.parametrize('cut', [1, 2])
+def test_truncated_base64_is_padded_like_the_standard_decoder(monkeypatch, cut):
+    monkeypatch.setattr(app, 'EMAIL_DECODE_CHUNK_CHARS', 5)
+    part = truncated_base64_part(base64.b64encode(b"conteudo truncado!")[:-cut])
+    assert b''.join(app._iter_payload_bytes(part)) == part.get_payload(decode=True)
+
+
+def test_single_dangling_base64_character_is_dropped(monkeypatch):
+    monkeypatch.setattr(app, 'EMAIL_DECODE_CHUNK_CHARS', 5)
+    encoded = base64.b64encode(b"conteudo truncado!")
+    part = truncated_base64_part(encoded[:-3])
+    assert b''.join(app._iter_payload_bytes(part)) == base64.b64decode(encoded[:-4])
+
+
+def truncated_base64_part(encoded):
+    raw = (b"From: a@example.com\nContent-Type: application/octet-stream\n"
+           b"Content-Transfer-Encoding: base64\nContent-Disposition: attachment; filename=x\n\n" + encoded + b"\n")
+    return BytesParser(policy=policy.default).parsebytes(raw)
+
+
+def test_unsupported_format_is_rejected_before_copying_the_body(monkeypatch):
+    created = []
+    temporary_file = app.tempfile.TemporaryFile
+
+    def recording_temporary_file(*args, **kwargs):
+        created.append(temporary_file(*args, **kwargs))
+        return created[-1]
+
+    monkeypatch.setattr(app.tempfile, 'TemporaryFile', recording_temporary_file)
+    client = app.app.test_client()
+    response = client.post('/email_forensics/bulk?format=pst', data=MBOX)
+    assert response.status_code == 400
+    assert 'pst' in response.get_json()['error']
+    assert created == []
+    response = client.post('/email_forensics/bulk?format=mbox', data=MBOX)
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(created) == 1 and created[0].closed
+    assert sum('"type": "message"' in line for line in lines) == 2
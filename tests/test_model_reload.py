@@ -0,0 +1,97 @@
+import threading
+import time
+
+import app
+
+
+def unchanged_count() -> float:
+    return app.MODEL_RELOADS.labels('unchanged')._value.get()
+
+
+def wait_idle(scheduler, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while scheduler._reload_target is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert scheduler._reload_target is None
+
+
+def started_scheduler(swaps: list, gate: threading.Event = None) -> app.InferenceScheduler:
+    scheduler = app.InferenceScheduler(num_workers=1)
+    scheduler.started = True
+    scheduler.workers = ['geração atual']
+    scheduler.model_config = {'gpu_layers': None, 'n_batch': None}
+
+    def swap(model_config):
+        swaps.append(model_config)
+        if gate is not None:
+            gate.wait(5)
+        with scheduler._lock:
+            scheduler.model_config = model_config
+            scheduler.workers = [f"geração {len(swaps)}"]
+
+    scheduler._swap_generation = swap
+    return scheduler
+
+
+def test_unchanged_config_keeps_the_current_generation():
+    swaps = []
+    scheduler = started_scheduler(swaps)
+    before = unchanged_count()
+    threads = threading.active_count()
+    scheduler.reconfigure(None, None)
+    assert swaps == []
+    assert scheduler.workers == ['geração atual']
+    assert scheduler._reload_target is None
+    assert threading.active_count() == threads
+    assert unchanged_count() == before + 1
+
+
+def test_changed_config_swaps_once():
+    swaps = []
+    scheduler = started_scheduler(swaps)
+    scheduler.reconfigure(10, 256)
+    wait_idle(scheduler)
+    assert swaps == [{'gpu_layers': 10, 'n_batch': 256}]
+    assert scheduler.workers == ['geração 1']
+    scheduler.reconfigure(10, 256)
+    assert len(swaps) == 1
+
+
+def test_requests_during_a_swap_are_coalesced():
+    swaps, gate = [], threading.Event()
+    scheduler = started_scheduler(swaps, gate)
+    scheduler.reconfigure(10, 256)
+    while not swaps:
+        time.sleep(0.01)
+    before = unchanged_count()
+    scheduler.reconfigure(10, 256)  # igual à troca em andamento
+    assert unchanged_count() == before + 1
+    scheduler.reconfigure(20, 512)
+    scheduler.reconfigure(30, 512)
+    gate.set()
+    wait_idle(scheduler)
+    assert swaps == [{'gpu_layers': 10, 'n_batch': 256}, {'gpu_layers': 30, 'n_batch': 512}]
+    assert scheduler.model_config == {'gpu_layers': 30, 'n_batch': 512}
+
+
+def test_reverting_during_a_swap_restores_the_previous_config():
+    swaps, gate = [], threading.Event()
+    scheduler = started_scheduler(swaps, gate)
+    scheduler.reconfigure(10, 256)
+    while not swaps:
+        time.sleep(0.01)
+    scheduler.reconfigure(None, None)
+    gate.set()
+    wait_idle(scheduler)
+    assert swaps == [{'gpu_layers': 10, 'n_batch': 256}, {'gpu_layers': None, 'n_batch': None}]
+    assert scheduler.model_config == {'gpu_layers': None, 'n_batch': None}
+
+
+def test_before_start_only_the_config_changes():
+    swaps = []
+    scheduler = app.InferenceScheduler(num_workers=1)
+    scheduler._swap_generation = swaps.append
+    scheduler.reconfigure(5, 128)
+    assert scheduler.model_config == {'gpu_layers': 5, 'n_batch': 128}
+    assert scheduler._reload_target is None
+    assert scheduler.workers == [] and swaps == []
@@ -0,0 +1,121 @@
+import struct
+
+import numpy as np
+import pytest
+
+import app
+
+MAC = b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb'
+CLIENT, SERVER, RESOLVER = bytes([192, 168, 0, 10]), bytes([93, 184, 216, 34]), bytes([8, 8, 8, 8])
+
+
+def ipv4(src, dst, proto, payload):
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, 0, 64, proto, 0, src, dst) + payload
+
+
+def tcp(sport, dport, payload=b''):
+    return struct.pack('!HHIIBBHHH', sport, dport, 1, 0, 5 << 4, 0x18, 65535, 0, 0) + payload
+
+
+def udp(sport, dport, payload):
+    return struct.pack('!HHHH', sport, dport, 8 + len(payload), 0) + payload
+
+
+def dns_query(name):
+    labels = b''.join(bytes([len(part)]) + part.encode() for part in name.split('.')) + b'\x00'
+    return struct.pack('!HHHHHH', 1, 0x0100, 1, 0, 0, 0) + labels + struct.pack('!HH', 1, 1)
+
+
+def ethernet(ethertype, payload):
+    return MAC + struct.pack('!H', ethertype) + payload
+
+
+HTTP = b'GET / HTTP/1.1\r\nHost: example.com\r\nUser-Agent: curl/8.4.0\r\n\r\n'
+FRAMES = [
+    ethernet(0x0800, ipv4(CLIENT, SERVER, 6, tcp(50000, 80, HTTP))),
+    ethernet(0x0800, ipv4(CLIENT, RESOLVER, 17, udp(50001, 53, dns_query('Malware.RU')))),
+    ethernet(0x0800, ipv4(CLIENT, RESOLVER, 17, udp(50002, 53, dns_query('example.com')))),
+    # TLS com uma tag VLAN
+    MAC + struct.pack('!HHH', 0x8100, 10, 0x0800) + ipv4(CLIENT, SERVER, 6, tcp(50003, 443)),
+    ethernet(0x86DD, struct.pack('!IHBB', 6 << 28, 8 + 4, 17, 64) + b'\xfe\x80' + b'\x00' * 13 + b'\x01'
+             + b'\xfe\x80' + b'\x00' * 13 + b'\x02' + udp(5353, 5353, b'\x00' * 4)),
+    ethernet(0x0806, b'\x00\x01\x08\x00\x06\x04\x00\x01' + b'\x00' * 20),
+]
+
+
+def pcap_bytes(frames):
+    data = struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1)
+    for i, frame in enumerate(frames):
+        data += struct.pack('<IIII', 1700000000 + i, 500000, len(frame), len(frame)) + frame
+    return data
+
+
+def pcapng_bytes(frames):
+    def block(block_type, body):
+        body += b'\x00' * (-len(body) % 4)
+        return struct.pack('<II', block_type, len(body) + 12) + body + struct.pack('<I', len(body) + 12)
+    # Interface com if_tsresol = 10^-3 (milissegundos)
+    options = struct.pack('<HHB3x', 9, 1, 3) + struct.pack('<HH', 0, 0)
+    data = block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1)) + block(1, struct.pack('<HHI', 1, 0, 65535) + options)
+    for i, frame in enumerate(frames):
+        ts = (1700000000 + i) * 1000 + 500
+        data += block(6, struct.pack('<IIIII', 0, ts >> 32, ts & 0xFFFFFFFF, len(frame), len(frame)) + frame)
+    return data
+
+
+@pytest.fixture(params=['pcap', 'pcapng'])
+def capture(request, tmp_path):
+    path = tmp_path / f'capture.{request.param}'
+    path.write_bytes(pcap_bytes(FRAMES) if request.param == 'pcap' else pcapng_bytes(FRAMES))
+    return request.param, str(path)
+
+
+def test_native_engine_counts_protocols_addresses_and_queries(capture):
+    fmt, path = capture
+    result = app.analyze_pcap_file(path)
+    assert result['format'] == fmt
+    assert result['total_packets'] == len(FRAMES)
+    assert result['total_bytes'] == sum(len(frame) for frame in FRAMES)
+    assert result['truncated_bytes'] == 0
+    assert result['protocol_count'] == {'DNS': 2, 'HTTP': 1, 'TLS': 1, 'MDNS': 1, 'ARP': 1}
+    assert result['top_ip_addresses']['192.168.0.10'] == 4
+    assert result['top_ip_addresses']['8.8.8.8'] == 2
+    assert result['top_ip_addresses']['fe80::1'] == 1
+    assert result['top_dns_queries'] == {'malware.ru': 1, 'example.com': 1}
+    assert result['capture_start'] == pytest.approx(1700000000.5)
+    assert result['capture_duration'] == pytest.approx(len(FRAMES) - 1)
+    alerts = "\n".join(result['alerts'])
+    assert '192.168.0.10' in alerts and 'curl/8.4.0' in alerts and 'malware.ru' in alerts
+
+
+@pytest.mark.parametrize('writer', [pcap_bytes, pcapng_bytes])
+def test_indexer_resumes_on_a_growing_buffer(writer):
+    data = writer(FRAMES)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    indexer, aggregates = app.PcapIndexer(), app.PcapAggregates()
+    position = 0
+    # Cada leitura termina no meio de um registro; o indexador para antes dele e retoma depois
+    for end in list(range(17, len(data), 37)) + [len(data)]:
+        block, position = indexer.index(data, position, end, max_packets=2)
+        while len(block.offsets):
+            aggregates.add_block(buffer, block)
+            block, position = indexer.index(data, position, end, max_packets=2)
+    assert position == len(data)
+    whole = app.PcapAggregates()
+    full_indexer = app.PcapIndexer()
+    whole.add_block(buffer, full_indexer.index(data, 0, len(data))[0])
+    assert aggregates.to_dict(indexer) == whole.to_dict(full_indexer)
+
+
+def test_corrupted_record_is_reported(tmp_path):
+    data = bytearray(pcap_bytes(FRAMES))
+    struct.pack_into('<I', data, 24 + 8, app.PCAP_MAX_CAPLEN + 1)
+    path = tmp_path / 'broken.pcap'
+    path.write_bytes(bytes(data))
+    assert 'corrompido' in app.analyze_pcap_file(str(path))['error']
+
+
+def test_unknown_format_is_rejected(tmp_path):
+    path = tmp_path / 'not.pcap'
+    path.write_bytes(b'\x00' * 64)
+    assert 'error' in app.analyze_pcap_file(str(path))
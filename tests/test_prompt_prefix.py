@@ -0,0 +1,99 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+MIN = app.PROMPT_PREFIX_MIN_TOKENS
+
+
+class FakeLlama:
+    # Um token por byte (BOS = 1); save_state devolve snapshots com tamanho fixo
+    def __init__(self, state_size: int = 100):
+        self.state_size = state_size
+        self.evaluated = []
+        self.loaded = None
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list:
+        return ([1] if add_bos else []) + list(text)
+
+    def n_ctx(self) -> int:
+        return 4096
+
+    def reset(self) -> None:
+        self.evaluated = []
+
+    def eval(self, tokens: list) -> None:
+        self.evaluated = list(tokens)
+
+    def save_state(self):
+        return SimpleNamespace(tokens=tuple(self.evaluated), llama_state_size=self.state_size)
+
+    def load_state(self, state) -> None:
+        self.loaded = state
+
+
+def prompt_tokens(system: str, user: str = "pergunta") -> list:
+    prompt = app.format_chat_prompt([{'role': 'system', 'content': system}, {'role': 'user', 'content': user}])
+    return FakeLlama().tokenize(prompt.encode('utf-8'))
+
+
+def test_longest_prefix_wins():
+    base = list(range(100, 100 + MIN))
+    prefixes = [base, base + [7, 8, 9], base + [7, 5]]
+    assert app._match_prefix(prefixes, base + [7, 8, 9, 10, 11]) == (1, MIN + 3)
+    assert app._match_prefix(prefixes, base + [7, 5, 0]) == (2, MIN + 2)
+    assert app._match_prefix(prefixes, base + [3]) == (0, MIN)
+
+
+def test_short_matches_do_not_count():
+    prefixes = [list(range(MIN + 5))]
+    assert app._match_prefix(prefixes, list(range(MIN - 1)) + [999, 1000]) == (None, 0)
+    assert app._match_prefix([], list(range(50))) == (None, 0)
+
+
+def test_last_prompt_token_is_always_left_to_evaluate():
+    prefix = list(range(MIN + 4))
+    assert app._match_prefix([prefix], prefix) == (0, MIN + 3)
+    assert app._match_prefix([prefix], prefix + [1]) == (0, MIN + 4)
+
+
+def test_formatted_prompts_start_with_the_cached_prefix():
+    for system in app.known_system_prompts():
+        llm = FakeLlama()
+        prefix = llm.tokenize(app.system_prompt_prefix(system).encode('utf-8'))
+        tokens = prompt_tokens(system)
+        assert tokens[:len(prefix)] == prefix
+
+
+def test_restore_loads_the_matching_snapshot():
+    systems = ["Você é um analista de segurança. " * 3, "You are a security analyst. " * 3]
+    llm = FakeLlama()
+    cache = app.PromptStateCache(llm, systems)
+    assert len(cache.prefix_tokens) == 2
+    tokens = prompt_tokens(systems[1])
+    reused = cache.restore(tokens)
+    assert reused == len(cache.prefix_tokens[1])
+    assert llm.loaded.tokens == tuple(cache.prefix_tokens[1])
+    llm.loaded = None
+    assert cache.restore(FakeLlama().tokenize(b"[INST] sem instrucao de sistema [/INST]")) == 0
+    assert llm.loaded is None
+
+
+def test_evicted_snapshot_is_a_miss():
+    # Cabem dois snapshots: o primeiro prefixo é descartado ao guardar o terceiro
+    shared = "Instrucoes comuns a todos os modos. " * 2
+    systems = [shared + "Modo A.", shared + "Modo B.", shared + "Modo C."]
+    llm = FakeLlama(state_size=100)
+    cache = app.PromptStateCache(llm, systems, capacity_bytes=200)
+    assert len(cache.states.cache_state) == 2
+    assert cache.restore(prompt_tokens(systems[0])) == 0
+    assert llm.loaded is None
+    assert cache.restore(prompt_tokens(systems[2])) == len(cache.prefix_tokens[2])
+    assert llm.loaded.tokens == tuple(cache.prefix_tokens[2])
+
+
+@pytest.mark.parametrize('n_reused', [0, 42])
+def test_prefix_stats(n_reused):
+    stats = app._prefix_stats(n_reused, 0.01)
+    assert stats == {'prefix_hit': n_reused > 0, 'prefix_tokens': n_reused, 'seconds_saved': pytest.approx(n_reused * 0.01)}
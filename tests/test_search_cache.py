@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+KEY = ('static', 'alvo', 'web', 3)
+RESULTS = [{'title': 'a', 'href': 'https://a.example.com', 'body': 'x'}]
+
+
+class FakeClock:
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class BlockingBackend(app.StaticSearchBackend):
+    # Segura a atualização em segundo plano até o teste liberar
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.finished = threading.Event()
+
+    def search(self, query, search_type, max_results):
+        self.release.wait(5)
+        try:
+            return super().search(query, search_type, max_results)
+        finally:
+            self.finished.set()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return app.SearchResultCache(str(tmp_path / 'search.sqlite3'), ttl=600, negative_ttl=60, stale_ttl=3600,
+                                 max_entries=100, clock=clock)
+
+
+def test_empty_results_expire_sooner_and_are_never_stale(cache, clock):
+    cache.set(*KEY, RESULTS)
+    cache.set('static', 'nada', 'web', 3, [])
+    clock.advance(59)
+    assert cache.get('static', 'nada', 'web', 3) == ([], 'fresh')
+    clock.advance(2)
+    assert cache.get('static', 'nada', 'web', 3) == (None, None)
+    assert cache.get(*KEY) == (RESULTS, 'fresh')
+
+
+def test_stale_window_after_the_ttl(cache, clock):
+    cache.set(*KEY, RESULTS)
+    clock.advance(601)
+    assert cache.get(*KEY) == (RESULTS, 'stale')
+    clock.advance(3600)
+    assert cache.get(*KEY) == (None, None)
+
+
+def test_entries_survive_reopening_the_file(cache, clock):
+    cache.set(*KEY, RESULTS)
+    reopened = app.SearchResultCache(cache.path, ttl=600, negative_ttl=60, stale_ttl=3600, max_entries=100, clock=clock)
+    assert reopened.get(*KEY) == (RESULTS, 'fresh')
+    clock.advance(601)
+    assert reopened.get(*KEY) == (RESULTS, 'stale')
+
+
+def test_stale_entry_is_served_while_one_refresh_runs(cache, clock, monkeypatch):
+    monkeypatch.setattr(app, 'search_cache', cache)
+    backend = BlockingBackend()
+    key = (backend.name, app.normalize_query('alvo'), 'web', 3)
+    cache.set(*key, RESULTS)
+    clock.advance(601)
+    for _ in range(5):
+        assert app.lookup_cached_search('alvo', 'web', 3, backend) == (RESULTS, key)
+    backend.release.set()
+    assert backend.finished.wait(5)
+    for _ in range(50):
+        with app.search_revalidations_lock:
+            if key not in app.search_revalidations:
+                break
+        time.sleep(0.02)
+    assert backend.calls == 1
+    refreshed, state = cache.get(*key)
+    assert state == 'fresh' and refreshed != RESULTS and len(refreshed) == 3
+
+
+def test_token_bucket_allows_a_burst_then_one_per_second(clock):
+    bucket = app.TokenBucket(rate=1.0, capacity=3, clock=clock)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait_time() == pytest.approx(1.0)
+    clock.advance(0.5)
+    assert not bucket.try_acquire()
+    assert bucket.wait_time() == pytest.approx(0.5)
+    clock.advance(0.5)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    # Ociosidade não acumula mais que a rajada
+    clock.advance(60)
+    assert bucket.available_within(0) == 3
+    assert bucket.available_within(2) == 5
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
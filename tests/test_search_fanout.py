@@ -0,0 +1,69 @@
+import time
+
+import app
+
+
+class LimitedBackend(app.StaticSearchBackend):
+    name = "static-limited"
+    rate_limited = True
+
+
+def collect(*args, **kwargs):
+    return [(search_type, query, outcome, len(found)) for search_type, query, outcome, found in app.iter_searches(*args, **kwargs)]
+
+
+def test_results_for_every_query_and_type(search_env):
+    backend = search_env(app.StaticSearchBackend())
+    events = collect(['alvo', 'apelido'], ['web', 'news'], 3)
+    assert sorted(events) == sorted((t, q, 'ok', 3) for t in ('web', 'news') for q in ('alvo', 'apelido'))
+    assert backend.calls == 4
+    # Segunda rodada sai do cache, sem chamar o backend
+    assert sorted(collect(['alvo', 'apelido'], ['web', 'news'], 3)) == sorted(events)
+    assert backend.calls == 4
+
+
+def test_slow_source_times_out_within_its_limit(search_env):
+    search_env(app.StaticSearchBackend(delays={'news': 1.0}))
+    started = time.monotonic()
+    events = collect(['alvo'], ['web', 'news'], 2, deadline=5.0, source_timeouts={'web': 2.0, 'news': 0.2})
+    assert time.monotonic() - started < 0.9
+    assert ('web', 'alvo', 'ok', 2) in events
+    assert ('news', 'alvo', 'timeout', 0) in events
+
+
+def test_global_deadline_caps_source_timeouts(search_env):
+    search_env(app.StaticSearchBackend(delays={'web': 1.0}))
+    started = time.monotonic()
+    events = collect(['alvo'], ['web'], 2, deadline=0.2, source_timeouts={'web': 5.0})
+    assert time.monotonic() - started < 0.9
+    assert events == [('web', 'alvo', 'timeout', 0)]
+
+
+def test_failing_source_is_reported_as_error(search_env):
+    search_env(app.StaticSearchBackend(failures={'leaked'}))
+    events = collect(['alvo'], ['web', 'leaked'], 1)
+    assert ('leaked', 'alvo', 'error', 0) in events
+    assert ('web', 'alvo', 'ok', 1) in events
+
+
+def test_rate_limited_searches_beyond_budget(search_env, monkeypatch):
+    backend = search_env(LimitedBackend())
+    monkeypatch.setattr(app, 'search_rate_limiter', app.TokenBucket(rate=1.0, capacity=2))
+    queries = [f"alvo {i}" for i in range(6)]
+    started = time.monotonic()
+    events = collect(queries, ['web'], 1, deadline=1.5, source_timeouts={'web': 1.5})
+    assert time.monotonic() - started < 1.4
+    outcomes = [outcome for _, _, outcome, _ in events]
+    assert outcomes.count('ok') == 3
+    assert outcomes.count('rate_limited') == 3
+    assert backend.calls == 3
+    # A primeira variação é atendida antes das demais
+    assert ('web', 'alvo 0', 'ok', 1) in events
+
+
+def test_token_bucket_never_blocks_on_try_acquire():
+    bucket = app.TokenBucket(rate=10.0, capacity=1)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert 0 < bucket.wait_time() <= 0.1
+    assert bucket.available_within(1.0) in (9, 10)
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import app
+
+
+def training_columns(n=500):
+    rng = np.random.default_rng(0)
+    records = [{'logins': int(rng.integers(1, 6)), 'country': 'BR' if i % 10 else 'US'} for i in range(n)]
+    return app.uba_columns(records)
+
+
+@pytest.fixture
+def model():
+    columns, n = training_columns()
+    return app.UBAModel('tenant', 'entity').fit(columns, n)
+
+
+def test_reservoir_is_bounded_and_counts_everything(model, monkeypatch):
+    monkeypatch.setattr(app, 'UBA_RESERVOIR_SIZE', 100)
+    columns, n = training_columns(250)
+    model.observe(columns, n)
+    model.observe(columns, n)
+    sample, rows = model.reservoir_columns()
+    assert rows == 100
+    assert model.seen == 500
+    assert set(sample) == {'logins', 'country'}
+    assert len(sample['logins']) == 100
+    assert set(np.unique(sample['country'])) <= {'BR', 'US'}
+
+
+def test_state_round_trip_keeps_scores_and_reservoir(model):
+    columns, n = training_columns(300)
+    model.observe(columns, n)
+    restored = app.UBAModel.from_state(model.to_state())
+    np.testing.assert_allclose(restored.score(columns, n)[0], model.score(columns, n)[0])
+    assert restored.seen == model.seen
+    assert restored.since_fit == model.since_fit
+    assert restored.reservoir_rows == model.reservoir_rows
+    original, _ = model.reservoir_columns()
+    copied, _ = restored.reservoir_columns()
+    np.testing.assert_array_equal(original['logins'], copied['logins'])
+
+
+def test_non_numeric_value_in_numeric_column(model):
+    columns, n = app.uba_columns([{'logins': 'x', 'country': 'BR'}, {'logins': 3, 'country': 'BR'},
+                                  {'logins': 1000, 'country': 'BR'}])
+    encoded = model.encode(columns, n)
+    assert encoded[0, 0] == pytest.approx(model.medians['logins'])
+    assert encoded[1, 0] == 3
+    assert encoded[2, 0] == 1000
+    model.observe(columns, n)
+    sample, rows = model.reservoir_columns()
+    assert np.isnan(sample['logins'][rows - 3])
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'uba_models', app.UBAModelStore(str(tmp_path)))
+    return app.app.test_client()
+
+
+def test_csv_stream_without_model_is_rejected(client):
+    response = client.post('/user_behavior?entity=none&train=false', data='logins,country\n1,BR\n',
+                           content_type='text/csv')
+    assert response.status_code == 409
+    assert 'error' in response.get_json()
+
+
+def test_csv_stream_without_header_is_rejected(client):
+    response = client.post('/user_behavior?entity=empty', data='', content_type='text/csv')
+    assert response.status_code == 400
+
+
+def test_csv_stream_error_after_start_ends_with_marker(client, monkeypatch):
+    body = 'logins,country\n' + ''.join(f'{i % 5 + 1},BR\n' for i in range(50))
+    assert client.post('/user_behavior?entity=csv', data=body, content_type='text/csv').status_code == 200
+
+    def broken(self, columns, n):
+        raise RuntimeError('falha')
+    monkeypatch.setattr(app.UBAModel, 'score', broken)
+    response = client.post('/user_behavior?entity=csv&train=false', data=body, content_type='text/csv')
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0] == 'logins,country,anomaly_score,is_anomaly'
+    assert lines[-1].startswith('#error,falha')